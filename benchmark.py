@@ -0,0 +1,491 @@
+#!/bin/usr/python3
+"""
+Benchmarks for the chat.
+
+Every benchmark is a function named benchmark_<name> and is run with
+'python3 benchmark.py <name>'. Running the script without a name runs all of
+the benchmarks.
+"""
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import typing
+import client
+import database
+import protocol
+import server
+import server_main
+
+
+def _run_server(mode: str,
+                address: typing.Tuple[str, int],
+                write_behind: bool,
+                database_path: str) -> None:
+    """
+    Runs a server in the mode specified, is the target of a server process.
+    
+    :param mode: "asyncio" or "blocking"
+    :param address: the address that the server should open at
+    :param write_behind: True if chat messages should be written in batches
+    :param database_path: path to the database file of the server, or
+                          ":memory:"
+    :return: None
+    """
+    sys.stdout = open(os.devnull, "w")
+    server_main.WRITE_BEHIND = write_behind
+    db_handler = server.ServerDBHandler(database_path,
+                                        server_main.READER_AMOUNT)
+    if mode == "asyncio":
+        server_main.open_async_connection(address, db_handler)
+    else:
+        server_main.open_connection(address, db_handler)
+
+
+def _free_address() -> typing.Tuple[str, int]:
+    """Returns a local address with a port that is currently not in use."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()
+
+
+def _start_server_process(mode: str,
+                          write_behind: bool = server_main.WRITE_BEHIND,
+                          database_path: str = ":memory:"
+                          ) -> typing.Tuple[multiprocessing.Process,
+                                            typing.Tuple[str, int]]:
+    """
+    Starts a server in its own process and waits until it accepts connections.
+    
+    :param mode: "asyncio" or "blocking"
+    :param write_behind: True if chat messages should be written in batches,
+                         by default as the server writes them
+    :param database_path: path to the database file of the server, or
+                          ":memory:"
+    :return: the process that runs the server and the address of the server
+    """
+    address = _free_address()
+    process = multiprocessing.Process(target=_run_server,
+                                      args=(mode, address, write_behind,
+                                            database_path),
+                                      daemon=True)
+    process.start()
+    while True:
+        try:
+            socket.create_connection(address).close()
+            return process, address
+        except ConnectionRefusedError:
+            if not process.is_alive():
+                raise RuntimeError("The server process did not start.")
+            time.sleep(0.05)
+
+
+def _exchange(address: typing.Tuple[str, int], serialized_message: bytes) -> bytes:
+    """
+    Sends a message on a new connection and reads until the server closes it.
+    
+    :param address: the address of the server
+    :param serialized_message: the message that should be sent
+    :return: everything the server sent back
+    """
+    with socket.create_connection(address) as s:
+        s.sendall(serialized_message)
+        buffer = b''
+        while True:
+            data = s.recv(4096)
+            if not data:
+                return buffer
+            buffer += data
+
+
+def _chat_client(address: typing.Tuple[str, int],
+                 user_name: str,
+                 message_amount: int) -> None:
+    """
+    Sends chat messages and asks for new messages, one connection per message
+    the same way the chat client does.
+    
+    :param address: the address of the server
+    :param user_name: the name of the user sending the messages
+    :param message_amount: the amount of chat messages to send
+    :return: None
+    """
+    chat_message = protocol.serialize_message(protocol.Message(
+        protocol.Message.CHAT_MESSAGE, "benchmark message", user_name, "bench"))
+    for i in range(message_amount):
+        _exchange(address, chat_message)
+        request = protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES,
+                                   i, user_name, "bench")
+        _exchange(address, protocol.serialize_message(request))
+
+
+def _stalled_client(address: typing.Tuple[str, int],
+                    stall_time: float,
+                    stop: threading.Event) -> None:
+    """
+    Keeps opening connections that stay silent for a while before they send
+    their message, like a client on a bad network does.
+    
+    :param address: the address of the server
+    :param stall_time: seconds every connection stays silent
+    :param stop: event that stops the client when set
+    :return: None
+    """
+    request = protocol.serialize_message(protocol.Message(
+        protocol.Message.REQUEST_NEW_MESSAGES, 0, "stalled", "bench"))
+    while not stop.is_set():
+        with socket.create_connection(address) as s:
+            stop.wait(stall_time)
+            s.sendall(request)
+
+
+def benchmark_server() -> None:
+    """
+    Measures how many messages per second the blocking and the asyncio server
+    handle with an increasing amount of concurrent clients.
+    
+    Every client sends a chat message followed by a request for new messages,
+    and both are counted as handled messages. The runs with a stalled client
+    also have a client that keeps a connection silent for 100 ms at a time.
+    """
+    messages_per_client = 100
+    print("server: messages handled per second")
+    print("{:>10} {:>10} {:>10} {:>12}".format(
+        "mode", "clients", "stalled", "messages/s"))
+    for mode in ("blocking", "asyncio"):
+        process, address = _start_server_process(mode)
+        for stalled in (False, True):
+            stop = threading.Event()
+            if stalled:
+                threading.Thread(target=_stalled_client,
+                                 args=(address, 0.1, stop)).start()
+            for client_amount in (1, 8, 32):
+                clients = [
+                    threading.Thread(
+                        target=_chat_client,
+                        args=(address,
+                              "user{}x{}x{}".format(stalled, client_amount, i),
+                              messages_per_client))
+                    for i in range(client_amount)]
+                start = time.perf_counter()
+                for each in clients:
+                    each.start()
+                for each in clients:
+                    each.join()
+                elapsed = time.perf_counter() - start
+                handled = 2 * messages_per_client * client_amount
+                print("{:>10} {:>10} {:>10} {:>12.0f}".format(
+                    mode, client_amount, str(stalled), handled / elapsed))
+            stop.set()
+        process.terminate()
+        process.join()
+
+
+def benchmark_session() -> None:
+    """
+    Measures the round trip time of a chat message sent on a connection of
+    its own compared to one sent in a session.
+    """
+    message_amount = 2000
+    process, address = _start_server_process("asyncio")
+    message = protocol.Message(protocol.Message.CHAT_MESSAGE,
+                               "benchmark message", "session", "bench")
+    serialized_message = protocol.serialize_message(message)
+    print("session: microseconds per chat message")
+    
+    start = time.perf_counter()
+    for _ in range(message_amount):
+        _exchange(address, serialized_message)
+    elapsed = time.perf_counter() - start
+    print("{:>22} {:>8.1f}".format("connection per message",
+                                   elapsed / message_amount * 10**6))
+    
+    server_connection = client.ServerConnection(address, sessions=True)
+    start = time.perf_counter()
+    for _ in range(message_amount):
+        server_connection.request(message)
+    elapsed = time.perf_counter() - start
+    server_connection.close()
+    print("{:>22} {:>8.1f}".format("session",
+                                   elapsed / message_amount * 10**6))
+    process.terminate()
+    process.join()
+
+
+def _session_chat_client(address: typing.Tuple[str, int],
+                         user_name: str,
+                         message_amount: int) -> None:
+    """
+    Sends chat messages in a session and waits for every acknowledgement.
+    
+    :param address: the address of the server
+    :param user_name: the name of the user sending the messages
+    :param message_amount: the amount of chat messages to send
+    :return: None
+    """
+    server_connection = client.ServerConnection(address, sessions=True)
+    message = protocol.Message(protocol.Message.CHAT_MESSAGE,
+                               "benchmark message", user_name, "bench")
+    for _ in range(message_amount):
+        server_connection.request(message)
+    server_connection.close()
+
+
+def benchmark_write_behind() -> None:
+    """
+    Measures how many chat messages per second the asyncio server stores when
+    they are written one at a time compared to written in batches, with an
+    increasing amount of clients sending messages in sessions, for a database
+    in RAM and one on disk.
+    """
+    messages_per_client = 500
+    print("write_behind: chat messages stored per second")
+    print("{:>8} {:>14} {:>10} {:>12}".format("database", "write behind",
+                                               "clients", "messages/s"))
+    for on_disk in (False, True):
+        for write_behind in (False, True):
+            database_path = ":memory:"
+            if on_disk:
+                database_path = os.path.join(tempfile.mkdtemp(), "server.db")
+            process, address = _start_server_process("asyncio",
+                                                     write_behind,
+                                                     database_path)
+            for client_amount in (1, 8, 32):
+                clients = [
+                    threading.Thread(
+                        target=_session_chat_client,
+                        args=(address,
+                              "user{}x{}".format(client_amount, i),
+                              messages_per_client))
+                    for i in range(client_amount)]
+                start = time.perf_counter()
+                for each in clients:
+                    each.start()
+                for each in clients:
+                    each.join()
+                elapsed = time.perf_counter() - start
+                stored = messages_per_client * client_amount
+                print("{:>8} {:>14} {:>10} {:>12.0f}".format(
+                    "disk" if on_disk else "memory", str(write_behind),
+                    client_amount, stored / elapsed))
+            process.terminate()
+            process.join()
+
+
+def benchmark_chat_message_batch() -> None:
+    """
+    Measures how many chat messages per second the asyncio server stores when
+    a client in a session sends them one at a time compared to in
+    CHAT_MESSAGE_BATCH messages of 100 chat messages for 10 chats, for a
+    database in RAM and one on disk.
+    """
+    message_amount = 5000
+    batch_size = 100
+    chat_messages = [
+        protocol.Message(protocol.Message.CHAT_MESSAGE,
+                         "benchmark message", "relay", "chat{}".format(i % 10))
+        for i in range(message_amount)]
+    print("chat_message_batch: chat messages stored per second")
+    print("{:>8} {:>12} {:>12}".format("database", "batch size", "messages/s"))
+    for on_disk in (False, True):
+        database_path = ":memory:"
+        if on_disk:
+            database_path = os.path.join(tempfile.mkdtemp(), "server.db")
+        process, address = _start_server_process("asyncio",
+                                                 False,
+                                                 database_path)
+        server_connection = client.ServerConnection(address, sessions=True)
+        server_connection.request(protocol.Message(protocol.Message.KEEPALIVE))
+        for size in (1, batch_size):
+            start = time.perf_counter()
+            for i in range(0, message_amount, size):
+                if size == 1:
+                    server_connection.request(chat_messages[i])
+                else:
+                    server_connection.request(protocol.Message(
+                        protocol.Message.CHAT_MESSAGE_BATCH,
+                        batch=chat_messages[i:i + size]))
+            elapsed = time.perf_counter() - start
+            print("{:>8} {:>12} {:>12.0f}".format(
+                "disk" if on_disk else "memory", size,
+                message_amount / elapsed))
+        server_connection.close()
+        process.terminate()
+        process.join()
+
+
+def benchmark_pipelining() -> None:
+    """
+    Measures the time per request of a client that asks for the new messages
+    of many chats through one session, with the requests sent one at a time
+    compared to pipelined, for a database in RAM and one on disk.
+    """
+    chat_amount = 300
+    repetitions = 5
+    print("pipelining: microseconds per request for new messages")
+    print("{:>8} {:>12} {:>12}".format("database", "pipelining", "request"))
+    for on_disk in (False, True):
+        database_path = ":memory:"
+        if on_disk:
+            database_path = os.path.join(tempfile.mkdtemp(), "server.db")
+        process, address = _start_server_process("asyncio",
+                                                 False,
+                                                 database_path)
+        chats = ["chat{}".format(i) for i in range(chat_amount)]
+        client.ServerConnection(address, sessions=True).request_many(
+            [protocol.Message(protocol.Message.CHAT_MESSAGE,
+                              "benchmark message", "pipelining", chat)
+             for chat in chats])
+        requests = [protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES,
+                                     0, "pipelining", chat)
+                    for chat in chats]
+        for pipelining in (False, True):
+            server_connection = client.ServerConnection(address, pipelining,
+                                                        sessions=True)
+            server_connection.request(
+                protocol.Message(protocol.Message.KEEPALIVE))
+            start = time.perf_counter()
+            for _ in range(repetitions):
+                server_connection.request_many(requests)
+            elapsed = time.perf_counter() - start
+            server_connection.close()
+            print("{:>8} {:>12} {:>12.1f}".format(
+                "disk" if on_disk else "memory", str(pipelining),
+                elapsed / (repetitions * chat_amount) * 10**6))
+        process.terminate()
+        process.join()
+
+
+def benchmark_protocol() -> None:
+    """
+    Measures the cost of encoding and decoding messages, and their size on
+    the wire, in every version of the protocol and in the batch format of
+    version 1.
+    
+    Decoding a NEW_MESSAGES message includes decoding its chat messages.
+    """
+    repetitions = 2000
+    chat_messages = [
+        protocol.Message(protocol.Message.CHAT_MESSAGE,
+                         "benchmark message number {}".format(i),
+                         "alice",
+                         "bob")
+        for i in range(50)]
+    new_messages = protocol.Message(protocol.Message.NEW_MESSAGES,
+                                    batch=chat_messages)
+    messages = [
+        ("CHAT_MESSAGE", chat_messages[0]),
+        ("REQUEST_NEW_MESSAGES",
+         protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES, 1234,
+                          "alice", "bob", wait_timeout=25000)),
+        ("NEW_MESSAGES x50", new_messages)]
+    print("protocol: microseconds and bytes per message")
+    print("{:>20} {:>8} {:>10} {:>10} {:>8}".format(
+        "msg_type", "version", "encode", "decode", "bytes"))
+    formats = [(str(version), version, False) for version in protocol.VERSIONS]
+    formats.insert(1, ("1 batch", protocol.VERSION_1, True))
+    for name, message in messages:
+        for format_name, version, batch_format in formats:
+            serialized = protocol.serialize_message(
+                message, version, protocol.HEADER_SIZE, batch_format)
+            encode_time = timeit.timeit(
+                lambda: protocol.serialize_message(
+                    message, version, protocol.HEADER_SIZE, batch_format),
+                number=repetitions)
+            decode_time = timeit.timeit(
+                lambda: _decode(serialized),
+                number=repetitions)
+            print("{:>20} {:>8} {:>10.2f} {:>10.2f} {:>8}".format(
+                name, format_name, encode_time / repetitions * 10**6,
+                decode_time / repetitions * 10**6, len(serialized)))
+
+
+def benchmark_memory() -> None:
+    """
+    Measures the memory held by 1 000 000 chat messages read from database
+    rows, the way the client keeps the messages of a chat.
+    
+    Every row has strings of its own, like the rows sqlite returns, and the
+    messages are between 10 users.
+    """
+    message_amount = 10**6
+    rows = ((i,
+             "benchmark message number {}".format(i),
+             "user{}".format(i % 10),
+             "user{}".format((i + 1) % 10))
+            for i in range(message_amount))
+    tracemalloc.start()
+    messages = [database.table_row_to_msg(row) for row in rows]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("memory: bytes held by chat messages")
+    print("{:>10} {:>10} {:>16}".format("messages", "MiB", "bytes/message"))
+    print("{:>10} {:>10.1f} {:>16.1f}".format(
+        len(messages), used / 2**20, used / len(messages)))
+
+
+def benchmark_client_ingest() -> None:
+    """
+    Measures how many chat messages per second the client stores, when 100 000
+    messages of 10 chats arrive in NEW_MESSAGES messages of 1000 messages, with
+    every message stored on its own compared to every NEW_MESSAGES message in
+    one transaction.
+    """
+    message_amount = 10**5
+    page_size = 1000
+    pages = []
+    for i in range(0, message_amount, page_size):
+        elements = [protocol.encode_new_messages_element(
+                        protocol.Message(protocol.Message.CHAT_MESSAGE,
+                                         "benchmark message number {}".format(j),
+                                         "relay", "chat{}".format(j % 10)),
+                        protocol.VERSION_2, True)
+                    for j in range(i, i + page_size)]
+        page = protocol.serialize_new_messages(elements,
+                                               protocol.VERSION_2,
+                                               protocol.HEADER_SIZE,
+                                               True)
+        pages.append(protocol.deserialize_message(
+            page.serialized[protocol.HEADER_SIZE:]))
+    print("client_ingest: chat messages stored per second")
+    print("{:>14} {:>12}".format("stored", "messages/s"))
+    for name in ("one at a time", "transaction"):
+        db_handler = client.DBHandler(
+            os.path.join(tempfile.mkdtemp(), "client.db"))
+        start = time.perf_counter()
+        for page in pages:
+            messages = protocol.unpack_new_messages(page)
+            if name == "transaction":
+                db_handler.store_new_messages(messages)
+                continue
+            for message in messages:
+                db_handler.add_chat_message_to_database(db_handler.connection,
+                                                        message)
+        elapsed = time.perf_counter() - start
+        print("{:>14} {:>12.0f}".format(name, message_amount / elapsed))
+
+
+def _decode(serialized_message: bytes) -> None:
+    """Decodes a serialized message the way a client or the server does."""
+    message = protocol.deserialize_message(serialized_message[2:])
+    if message.msg_type == protocol.Message.NEW_MESSAGES:
+        protocol.unpack_new_messages(message)
+
+
+def main() -> None:
+    """Runs the benchmarks named on the command line, or all of them."""
+    names = sys.argv[1:] or [name[len("benchmark_"):]
+                             for name in globals()
+                             if name.startswith("benchmark_")]
+    for name in names:
+        globals()["benchmark_" + name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
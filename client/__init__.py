@@ -1,89 +1,146 @@
 import json
+import random
+import select
 import socket
 import threading
 import time
 import database
 import protocol
 import sqlite3
-import subprocess
 import typing
 
 
 class DBHandler(database.Handler):
+    """
+    Class that handles the clients database, a cache of the chats of the
+    server.
+    
+    The database is kept across runs of the client, so that only the messages
+    that are new since the last run are received from the server. A database
+    of an older version of the specification is migrated, a database of an
+    unknown version is set up again from scratch. Every access goes through
+    one long-lived connection in WAL mode, shared by the threads of the
+    client. The id of the database of the server the chats came from is kept
+    as well, and the chats are deleted when the server has another one.
+    """
     def __init__(self, db_path):
         super().__init__()
         self.db_path = db_path
-        self._setup_sqlite_db()
+        self.connection = self._setup_sqlite_db()
+        row = self.connection.execute(
+            "SELECT database_id FROM server_database_id").fetchone()
+        self._server_database_id = None if row is None else row[0]
     
-    def open_connection(self) -> sqlite3.Connection:
-        pwd = subprocess.run("pwd", stdout=subprocess.PIPE).stdout.decode().strip()
-        # print(pwd + self.db_path)
-        connection = sqlite3.connect(self.db_path)
+    def _setup_sqlite_db(self) -> sqlite3.Connection:
+        """
+        Opens, or creates, the sqlite3 database with the specifications of the
+        database in the database_handler module.
+        
+        :return: the connection to the database
+        """
+        # the lock serializes all access, so the connection may be shared by
+        # the threads of the client
+        connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self.database_lock:
+            connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode a commit is only synced at checkpoints, the latest
+            # messages may be lost on power loss but are then received again
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA temp_store=MEMORY")
+            try:
+                self._setup_tables(connection)
+            except sqlite3.DatabaseError:
+                # the cache is of no use, everything is received again
+                connection.rollback()
+                self.clean_up_tables(connection)
+                self._setup_tables(connection)
+            connection.execute("""CREATE TABLE IF NOT EXISTS
+                               server_database_id
+                               (database_id VARCHAR NOT NULL)""")
+            connection.commit()
         return connection
     
-    def _setup_sqlite_db(self):
+    def server_database_id(self) -> typing.Optional[str]:
+        """
+        Returns the id of the database of the server the chats came from, None
+        if it is not known.
+        """
+        return self._server_database_id
+    
+    def reset(self, server_database_id: str) -> None:
         """
-        Creates an sqlite3 database with the specifications of the database in the database_handler module.
+        Deletes every chat, since the server has lost the history they came
+        from, and keeps the id of the database of the server they come from
+        from now on.
         
-        :return: the connection to the created database
+        :param server_database_id: the id of the database of the server
+        :return: None
         """
-        connection = self.open_connection()
-        cursor = connection.cursor()
         with self.database_lock:
-            if self._table_exists(connection, "chat_message_amount"):
-                self.clean_up_chat_message_amount(connection)
-                self._setup_chat_message_amount_table(cursor)
-            else:
-                self._setup_chat_message_amount_table(cursor)
-
-            if self._table_exists(connection, "chat_messages"):
-                self.clean_up_chat_messages(connection)
-                self._setup_chat_messages_table(cursor)
-            else:
-                self._setup_chat_messages_table(cursor)
-            connection.commit()
-        connection.close()
+            self.clean_up_tables(self.connection)
+            self._setup_tables(self.connection)
+            self._user_ids.clear()
+            self._chats.clear()
+            self._message_amounts.clear()
+            self.connection.execute("DELETE FROM server_database_id")
+            self.connection.execute(
+                "INSERT INTO server_database_id VALUES (?)",
+                (server_database_id,))
+            self.connection.commit()
+            self._server_database_id = server_database_id
     
     def new_messages(self,
                      chat_identifier: str,
                      last_message: int) -> typing.List[protocol.Message]:
-        con = self.open_connection()
-        message_list = []
-        msgs_avail_in_db = self.total_message_amount(con, chat_identifier)
-        if not last_message < msgs_avail_in_db:
-            return message_list
-        for i in range(last_message + 1, msgs_avail_in_db + 1):
-            msg_identifier = database.create_message_identifier(
-                chat_identifier, i)
-            msg_row = self._get_chat_message(con, msg_identifier)
-            msg = database.table_row_to_msg(msg_row)
-            message_list.append(msg)
-        return message_list
-
-    def _table_exists(self,
-                      connection: sqlite3.Connection,
-                      table_name: str) -> bool:
-        cmd = """
-        SELECT name FROM sqlite_master
-            WHERE type='table'
-            AND name=(?)
         """
-        cursor = connection.cursor()
-        cursor.execute(cmd, (table_name,))
-        status = cursor.fetchone()
-        if status is None:
-            return False
-        else:
-            return True
+        Reads the messages of a chat that come after the last message.
+        
+        :param chat_identifier: the chats identifier
+        :param last_message: number of the last message that is not read
+        :return: the messages, ordered by message number
+        """
+        return self.messages(chat_identifier,
+                             last_message + 1,
+                             self.message_amount(chat_identifier))
     
-    def clean_up_chat_messages(self, connection: sqlite3.Connection,):
-        cursor = connection.cursor()
-        cursor.execute("DROP TABLE chat_messages")
-        connection.commit()
+    def messages(self,
+                 chat_identifier: str,
+                 first_message: int,
+                 last_message: int) -> typing.List[protocol.Message]:
+        """
+        Reads a contiguous range of the messages of a chat.
+        
+        :param chat_identifier: the chats identifier
+        :param first_message: number of the first message in the range
+        :param last_message: number of the last message in the range
+        :return: the messages, ordered by message number
+        """
+        msg_rows = self.get_chat_messages(self.connection,
+                                          chat_identifier,
+                                          first_message,
+                                          last_message)
+        return [database.table_row_to_msg(msg_row) for msg_row in msg_rows]
+    
+    def message_amount(self, chat_identifier: str) -> int:
+        """Returns the amount of messages of a chat that are stored."""
+        return self.total_message_amount(self.connection, chat_identifier)
+    
+    def store_new_messages(self, messages: typing.List[protocol.Message]
+                           ) -> None:
+        """
+        Stores the chat messages of NEW_MESSAGES messages in one transaction.
+        
+        :param messages: the chat messages, in the order they were received
+        :return: None
+        """
+        self.add_chat_messages_to_database(self.connection, messages)
 
-    def clean_up_chat_message_amount(self, connection: sqlite3.Connection,):
+    def clean_up_tables(self, connection: sqlite3.Connection):
         cursor = connection.cursor()
-        cursor.execute("DROP TABLE chat_message_amount")
+        for table_name in ("chat_messages", "chat_message_amount", "chats",
+                           "users"):
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table_name))
+        cursor.execute("PRAGMA user_version = 0")
         connection.commit()
 
 
@@ -92,6 +149,399 @@ class ThreadKillFlag:
         self.kill = False
 
 
+class ServerConnection:
+    """
+    Class that keeps a long-lived session connection to the server.
+    
+    Sessions are only opened if asked for, since a server from before
+    sessions fails on the OPEN_SESSION message instead of ignoring it,
+    otherwise every request is sent on a connection of its own. The session
+    carries many requests and their responses, one request at a
+    time, or many at a time if the session is pipelined. A lost session is
+    reconnected when the next request is sent, and a server that does not
+    support sessions is sent every request on a connection of its own. The
+    version of the protocol, the size of the header, the page size, the batch
+    format and compression are negotiated when the session is opened, and
+    pipelining if it was asked for, without a session the defaults of the
+    protocol are used. A pipelined session cannot subscribe.
+    
+    Attributes
+        KEEPALIVE_INTERVAL -- seconds a session may stay idle before a
+        KEEPALIVE message is sent by keep_alive\n
+        RECONNECT_ATTEMPTS -- the amount of times a request is tried before
+        giving up\n
+        TIMEOUT -- seconds to wait for the server before the connection is
+        seen as lost\n
+        PAGE_SIZE -- bytes of new messages asked for per NEW_MESSAGES message
+        in a session\n
+        PIPELINE_WINDOW -- the amount of requests of a pipelined session that
+        are sent before their responses are received\n
+    """
+    KEEPALIVE_INTERVAL = 20
+    RECONNECT_ATTEMPTS = 3
+    TIMEOUT = 10
+    PAGE_SIZE = 2**20
+    PIPELINE_WINDOW = 32
+    
+    def __init__(self,
+                 server_address: typing.Tuple[str, int],
+                 pipelining: bool = False,
+                 sessions: bool = False):
+        """
+        Initializes the connection, without connecting yet.
+        
+        :param server_address: the address of the server
+        :param pipelining: True if the session should be pipelined
+        :param sessions: True if the server supports sessions and they should
+                         be used
+        """
+        self.server_address = server_address
+        self.session_supported = sessions
+        # the id of the database of the server, confirmed with the session
+        self.database_id = None
+        self.version = protocol.VERSION_1
+        self.header_size = protocol.HEADER_SIZE
+        self.batch_format = False
+        self.pipelining = False
+        self.keepalive_interval = self.KEEPALIVE_INTERVAL
+        self._ask_for_pipelining = pipelining
+        self._socket = None
+        self._decoder = None
+        self._subscribed = False
+        self._request_id = 0
+        self._lock = threading.Lock()
+        self._last_used = time.monotonic()
+    
+    def request(self, message: protocol.Message
+                ) -> typing.Optional[protocol.Message]:
+        """
+        Sends a message to the server and receives the response.
+        
+        :raises OSError: if the server could not be reached
+        :param message: the message that should be sent
+        :return: the response of the server, None if the server sent no
+                 response, which only happens when sessions are not supported
+        """
+        return self.request_many([message])[0]
+    
+    def request_many(self, messages: typing.List[protocol.Message]
+                     ) -> typing.List[typing.Optional[protocol.Message]]:
+        """
+        Sends messages to the server and receives their responses.
+        
+        In a pipelined session up to PIPELINE_WINDOW messages are sent without
+        waiting for the responses to the ones before, so that they take about
+        one round trip together instead of one each, otherwise the messages
+        are sent one at a time. A message is sent again after a reconnect only
+        if it was not answered, a chat message the server did not store is
+        answered with a REJECTED message and is not sent again.
+        :raises OSError: if the server could not be reached
+        :param messages: the messages that should be sent
+        :return: the responses of the server in the order of the messages,
+                 None for a message the server sent no response to, which only
+                 happens when sessions are not supported
+        """
+        # a long poll may be held by the server for its whole wait timeout
+        timeout = self.TIMEOUT + max(
+            (message.wait_timeout for message in messages), default=0) / 1000
+        responses = [None] * len(messages)
+        with self._lock:
+            attempt = 0
+            while self.session_supported:
+                try:
+                    if self._socket is None:
+                        self._open_session()
+                        continue
+                    self._socket.settimeout(timeout)
+                    unanswered = [index for index, response
+                                  in enumerate(responses) if response is None]
+                    if self.pipelining:
+                        self._pipeline(messages, unanswered, responses)
+                    else:
+                        for index in unanswered:
+                            responses[index] = self._exchange(messages[index])
+                    self._last_used = time.monotonic()
+                    return responses
+                except OSError:
+                    self._close_socket()
+                    attempt += 1
+                    if attempt == self.RECONNECT_ATTEMPTS:
+                        raise
+                    time.sleep(0.1 * 2**attempt)
+            return [self._request_without_session(
+                        protocol.serialize_message(message),
+                        message.msg_type,
+                        timeout)
+                    for message in messages]
+    
+    def _exchange(self, message: protocol.Message) -> protocol.Message:
+        """
+        Sends a message in the session and receives its response.
+        
+        :raises OSError: if the session was lost
+        :param message: the message that should be sent
+        :return: the response of the server
+        """
+        self._socket.sendall(protocol.serialize_message(
+            message, self.version, self.header_size, self.batch_format))
+        response = self._decoder.receive_message(self._socket)
+        if response is None:
+            raise ConnectionResetError("The session was closed by the server.")
+        return response
+    
+    def _pipeline(self,
+                  messages: typing.List[protocol.Message],
+                  unanswered: typing.List[int],
+                  responses: typing.List[typing.Optional[protocol.Message]]
+                  ) -> None:
+        """
+        Sends messages in the pipelined session and receives their responses,
+        which may arrive in any order.
+        
+        :raises OSError: if the session was lost
+        :param messages: the messages of the request
+        :param unanswered: the indexes of the messages that should be sent
+        :param responses: the responses, by the index of the message they
+                          answer, where the received responses are stored
+        :return: None
+        """
+        # the index of the message, by the request id it was sent with
+        in_flight = dict()
+        sent = 0
+        while sent < len(unanswered) or in_flight:
+            if sent < len(unanswered) and \
+                    len(in_flight) < self.PIPELINE_WINDOW:
+                sending = unanswered[
+                    sent:sent + self.PIPELINE_WINDOW - len(in_flight)]
+                serialized_messages = []
+                for index in sending:
+                    self._request_id = \
+                        self._request_id % protocol.MAX_REQUEST_ID + 1
+                    in_flight[self._request_id] = index
+                    serialized_messages.append(protocol.add_request_id(
+                        protocol.serialize_message(messages[index],
+                                                   self.version,
+                                                   self.header_size,
+                                                   self.batch_format),
+                        self.header_size,
+                        self._request_id))
+                self._socket.sendall(b"".join(serialized_messages))
+                sent += len(sending)
+                continue
+            response = self._decoder.receive_message(self._socket)
+            if response is None:
+                raise ConnectionResetError(
+                    "The session was closed by the server.")
+            index = in_flight.pop(self._decoder.request_id, None)
+            if index is None:
+                raise ConnectionError(
+                    "The server answered a request that was not sent.")
+            responses[index] = response
+    
+    def keep_alive(self) -> None:
+        """
+        Sends a KEEPALIVE message if the session has been idle for too long.
+        
+        :raises OSError: if the server could not be reached
+        :return: None
+        """
+        idle_time = time.monotonic() - self._last_used
+        if self._socket is not None and idle_time >= self.keepalive_interval:
+            self.request(protocol.Message(protocol.Message.KEEPALIVE))
+    
+    def subscribe(self, message: protocol.Message) -> bool:
+        """
+        Turns the session into a subscription to the new messages of a chat.
+        
+        The connection can after that no longer be used for requests, the
+        pushed messages are received with receive_pushed_message. More chats
+        are subscribed to by calling subscribe again.
+        :raises OSError: if the server could not be reached
+        :param message: message of msg_type SUBSCRIBE
+        :return: True if the subscription is confirmed, False if the server
+                 does not support subscriptions
+        """
+        with self._lock:
+            subscribed = self._socket is not None and self._subscribed
+            if self._socket is None and self.session_supported:
+                self._open_session()
+            if not self.session_supported or self.pipelining:
+                return False
+            try:
+                self._socket.sendall(protocol.serialize_message(
+                    message, self.version, self.header_size))
+                if subscribed:
+                    return True
+                confirmation = self._decoder.receive_message(self._socket)
+            except OSError:
+                self._close_socket()
+                raise
+            if confirmation is None or \
+                    confirmation.msg_type != protocol.Message.SUBSCRIBE:
+                self._close_socket()
+                return False
+            self._subscribed = True
+            return True
+    
+    def wait_for_push(self, timeout: float) -> bool:
+        """
+        Waits until a pushed message is available on a subscription.
+        
+        :param timeout: seconds to wait at most
+        :return: True if a message, or the end of the subscription, can be
+                 received without waiting
+        """
+        if self._decoder.has_frame():
+            return True
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        return len(readable) > 0
+    
+    def receive_pushed_message(self) -> typing.Optional[protocol.Message]:
+        """
+        Receives a message pushed on a subscription.
+        
+        :raises OSError: if the connection was lost
+        :return: the pushed message, None if the server ended the subscription
+        """
+        try:
+            message = self._decoder.receive_message(self._socket)
+        except (OSError, protocol.ProtocolViolationError):
+            message = None
+        if message is None:
+            self.close()
+        return message
+    
+    def close(self) -> None:
+        """Closes the session."""
+        with self._lock:
+            self._close_socket()
+    
+    def _open_session(self) -> None:
+        """
+        Connects to the server and opens a session.
+        
+        If the server closes the connection instead of confirming the session
+        then sessions are not supported by the server. The session uses the
+        version of the protocol and the size of the header confirmed by the
+        server, or the defaults of the protocol if the server did not confirm
+        them.
+        :raises OSError: if the server could not be reached
+        :return: None
+        """
+        s = socket.create_connection(self.server_address, self.TIMEOUT)
+        decoder = protocol.FrameDecoder()
+        try:
+            session_options = {"versions": list(protocol.VERSIONS),
+                               "header_size": protocol.WIDE_HEADER_SIZE,
+                               "page_size": self.PAGE_SIZE,
+                               "batch": True,
+                               "compression": [protocol.COMPRESSION],
+                               "not_modified": True}
+            if self._ask_for_pipelining:
+                session_options["pipelining"] = True
+            s.sendall(protocol.serialize_message(
+                protocol.Message(protocol.Message.OPEN_SESSION,
+                                 json.dumps(session_options))))
+            confirmation = decoder.receive_message(s)
+        except OSError:
+            s.close()
+            raise
+        if confirmation is None or \
+                confirmation.msg_type != protocol.Message.OPEN_SESSION:
+            s.close()
+            self.session_supported = False
+            return
+        session_options = json.loads(confirmation.content)
+        version = session_options.get("version", protocol.VERSION_1)
+        self.version = version if version in protocol.VERSIONS \
+            else protocol.VERSION_1
+        header_size = session_options.get("header_size", protocol.HEADER_SIZE)
+        self.header_size = header_size if header_size in protocol.HEADER_SIZES \
+            else protocol.HEADER_SIZE
+        decoder.header_size = self.header_size
+        self.batch_format = session_options.get("batch") is True
+        self.pipelining = session_options.get("pipelining") is True
+        decoder.request_ids = self.pipelining
+        database_id = session_options.get("database_id")
+        self.database_id = database_id if isinstance(database_id, str) \
+            else None
+        idle_timeout = session_options.get("idle_timeout")
+        if idle_timeout is not None:
+            self.keepalive_interval = min(self.KEEPALIVE_INTERVAL,
+                                          idle_timeout / 2)
+        self._socket = s
+        self._decoder = decoder
+        self._last_used = time.monotonic()
+    
+    def _request_without_session(self,
+                                 serialized_message: bytes,
+                                 msg_type: int,
+                                 timeout: float
+                                 ) -> typing.Optional[protocol.Message]:
+        """
+        Sends a message on a connection of its own.
+        
+        :raises OSError: if the server could not be reached
+        :param serialized_message: the message that should be sent
+        :param msg_type: msg_type of the message that should be sent
+        :param timeout: seconds to wait for the server
+        :return: the response of the server, if any
+        """
+        with socket.create_connection(self.server_address, timeout) as s:
+            s.sendall(serialized_message)
+            if msg_type in (protocol.Message.CHAT_MESSAGE,
+                            protocol.Message.CHAT_MESSAGE_BATCH):
+                return None
+            return receive_message(s)
+    
+    def _close_socket(self) -> None:
+        """Closes the socket of the session, if there is one."""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            self._decoder = None
+            self._subscribed = False
+
+
+class ConnectionKeepalive(threading.Thread):
+    """
+    Class that keeps the session of a ServerConnection open while it is idle.
+    """
+    def __init__(self,
+                 server_connection: ServerConnection,
+                 kill_flag: ThreadKillFlag):
+        threading.Thread.__init__(self, daemon=True)
+        self.server_connection = server_connection
+        self.kill_flag = kill_flag
+    
+    def run(self):
+        while not self.kill_flag.kill:
+            time.sleep(1)
+            try:
+                self.server_connection.keep_alive()
+            except OSError:
+                # reconnected by the next request
+                pass
+
+
+def receive_message(s: socket.socket,
+                    fixed_header_size: int = protocol.HEADER_SIZE
+                    ) -> typing.Optional[protocol.Message]:
+    """
+    Receives one message from a connection that carries only that message.
+    
+    Anything received after the message is dropped, a connection that
+    carries many messages is read by a protocol.FrameDecoder of its own.
+    :raises protocol.ProtocolViolationError: if the connection is closed in
+            the middle of a message
+    :param s: the socket that the message is received from
+    :param fixed_header_size: the size of the fixed length header
+    :return: the received message, None if the connection was closed before
+             anything of a message was received
+    """
+    return protocol.FrameDecoder(fixed_header_size).receive_message(s)
+
+
 class RefresherObserver:
     """
     Class that observes to the BackgroundDatabaseRefresher.
@@ -99,74 +549,375 @@ class RefresherObserver:
     def new_messages_found(self):
         raise NotImplementedError
     
-class NoMessageReceived(Exception):
-    pass
 
 class BackgroundDatabaseRefresher(threading.Thread):
+    """
+    Class that keeps the clients database up to date with the server, for
+    every open chat of a user.
+    
+    One refresher serves all the chats of a user. New messages are pushed by
+    the server through a single subscription to all the chats, or polled for
+    if sessions are not used or the server does not support subscriptions.
+    The new messages are stored and the observers of their chat are told.
+    
+    Every chat is polled at an interval of its own, the chats that are due are
+    polled together in one pipelined round of requests. A poll is still a
+    request for new messages per chat, since a server without sessions sends
+    nothing back for a message type it does not know, the same as for a chat
+    without new messages. Without sessions every one of them takes a
+    connection of its own, with sessions they share a round trip.
+    
+    The interval of a chat drops to MIN_POLL_INTERVAL when it has new
+    messages, or when the user sends a message in it, and is multiplied by
+    POLL_BACKOFF, up to MAX_POLL_INTERVAL, every time it has none. The
+    intervals vary by POLL_JITTER so that idle clients do not poll in step. A
+    subscription that ends is renewed after an interval that backs off the
+    same way, so that a server that keeps ending it is not subscribed to again
+    and again.
+    
+    Attributes
+        SUBSCRIPTION_TIMEOUT -- seconds without anything pushed by the server
+        before the subscription is seen as lost and is renewed\n
+        POLL_INTERVAL -- seconds to wait before trying again when the server
+        could not be reached\n
+        MIN_POLL_INTERVAL -- seconds between two polls of an active chat\n
+        MAX_POLL_INTERVAL -- seconds between two polls of an idle chat at
+        most\n
+        POLL_BACKOFF -- factor the interval of a chat grows by with every poll
+        that finds no new messages\n
+        POLL_JITTER -- the fraction an interval is made longer or shorter by
+        at random\n
+        IDLE_INTERVAL -- seconds to wait for a chat to be opened while there
+        is none\n
+    """
+    SUBSCRIPTION_TIMEOUT = 60
+    POLL_INTERVAL = 2
+    MIN_POLL_INTERVAL = 0.5
+    MAX_POLL_INTERVAL = 30
+    POLL_BACKOFF = 2
+    POLL_JITTER = 0.1
+    IDLE_INTERVAL = 1
+    
     def __init__(self,
                  server_address: typing.Tuple[str, int],
                  db_handler: DBHandler,
                  user_name: str,
-                 other_user: str,
-                 kill_flag: ThreadKillFlag):
+                 kill_flag: ThreadKillFlag,
+                 sessions: bool = False):
+        """
+        Initializes the refresher.
+        
+        :param server_address: the address of the server
+        :param db_handler: the database handler of the client
+        :param user_name: user name of the user whose chats are refreshed
+        :param kill_flag: flag that stops the refresher when set
+        :param sessions: True if the server supports sessions, without them
+                         the chats are polled on a connection per request
+        """
         threading.Thread.__init__(self)
         self.server_address = server_address
         self.db_handler = db_handler
         self.user_name = user_name
-        self.other_user = other_user
         self.kill_flag = kill_flag
-        self.refresher_observers = []
+        self.sessions = sessions
+        self.server_connection = ServerConnection(server_address,
+                                                  sessions=sessions)
+        self.push_supported = sessions
+        # chat identifier -> (other user, observers of the chat)
+        self._chats = {}
+        self._chats_lock = threading.Lock()
+        # chat identifier -> seconds between its polls, and when it is due
+        self._poll_intervals = {}
+        self._next_polls = {}
+        # chats whose user sent a message since they were last polled
+        self._active_chats = set()
+        # seconds between the end of a subscription and the next one, and
+        # when the next one is due
+        self._subscription_interval = self.MIN_POLL_INTERVAL
+        self._next_subscription = 0
     
-    def run(self):
+    def add_chat(self,
+                 other_user: str,
+                 refresher_observer: typing.Optional[RefresherObserver] = None
+                 ) -> None:
+        """
+        Starts refreshing the chat with the other user.
+        
+        :param other_user: user name of the other user of the chat
+        :param refresher_observer: observer that is told about the new
+               messages of the chat, if any
+        :return: None
+        """
+        chat_identifier = database.create_chat_identifier(self.user_name,
+                                                          other_user)
+        with self._chats_lock:
+            if chat_identifier not in self._chats:
+                self._chats[chat_identifier] = (other_user, [])
+            if refresher_observer is not None:
+                self._chats[chat_identifier][1].append(refresher_observer)
+    
+    def remove_chat(self, other_user: str) -> None:
+        """
+        Stops refreshing the chat with the other user.
+        
+        The server may still push messages of the chat until the subscription
+        is renewed, they are stored but nobody is told.
+        :param other_user: user name of the other user of the chat
+        :return: None
+        """
         chat_identifier = database.create_chat_identifier(self.user_name,
-                                                 self.other_user)
+                                                          other_user)
+        with self._chats_lock:
+            self._chats.pop(chat_identifier, None)
+    
+    def chat_active(self, other_user: str) -> None:
+        """
+        Tells the refresher that the user sent a message in the chat with the
+        other user, so that the chat is polled soon for an answer.
+        
+        :param other_user: user name of the other user of the chat
+        :return: None
+        """
+        chat_identifier = database.create_chat_identifier(self.user_name,
+                                                          other_user)
+        with self._chats_lock:
+            self._active_chats.add(chat_identifier)
+    
+    def chat_amount(self) -> int:
+        """Returns the amount of chats that are refreshed."""
+        with self._chats_lock:
+            return len(self._chats)
+    
+    def run(self):
         while not self.kill_flag.kill:
-            con = self.db_handler.open_connection()
-            last_message = self.db_handler.total_message_amount(
-                con,
-                chat_identifier)
-            query_msg = protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES,
-                                last_message,
-                                self.user_name,
-                                self.other_user)
-            con.close()
-            ser_msg = protocol.serialize_message(query_msg)
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect(self.server_address)
-                    s.sendall(ser_msg)
-                    buffer = b''
-                    while True:
-                        data = s.recv(4096)
-                        if not data:
-                            if len(buffer) == 0:
-                                raise NoMessageReceived
-                            break
-                        buffer += data
-                    des_msg = protocol.reassemble_message(
-                        protocol.deserialize_json_object(buffer[2:]))
-                    
-                    if len(buffer) > 0:
-                        con = self.db_handler.open_connection()
-                        list_of_msgs = json.loads(des_msg.content)
-                        for each in list_of_msgs:
-                            msg_cont = protocol.deserialize_json_object(each)
-                            rec_msg = protocol.reassemble_message(msg_cont)
-                            self.db_handler.add_chat_message_to_database(con, rec_msg)
-                        # tell observers that new messages have been fetched and added
-                        self.update_observers()
-                        con.close()
-                except NoMessageReceived:
-                    pass
-                finally:
-                    s.close()
-            time.sleep(2)
-            # self.kill_flag.kill = True
-            
-    def add_observer(self, refresher_observer: RefresherObserver):
-        self.refresher_observers.append(refresher_observer)
-    
-    def update_observers(self):
-        for observer in self.refresher_observers:
+            wait_time = self.IDLE_INTERVAL
+            try:
+                if self.push_supported and self.chat_amount() > 0:
+                    if time.monotonic() >= self._next_subscription:
+                        self._schedule_subscription(
+                            self._receive_pushed_messages())
+                    wait_time = min(self.IDLE_INTERVAL,
+                                    max(0, self._next_subscription -
+                                        time.monotonic()))
+                if not self.push_supported:
+                    wait_time = self._poll_new_messages()
+            except OSError:
+                # the server could not be reached, try again next time
+                wait_time = self.POLL_INTERVAL
+            time.sleep(wait_time)
+        self.server_connection.close()
+    
+    def _open_chats(self) -> typing.Dict[str, str]:
+        """Returns the other user of every chat, by chat identifier."""
+        with self._chats_lock:
+            return {chat_identifier: other_user for chat_identifier,
+                    (other_user, _) in self._chats.items()}
+    
+    def _last_messages(self, chat_identifiers: typing.Iterable[str]
+                       ) -> typing.Dict[str, int]:
+        """
+        Returns the number of the last message in the clients database of
+        every chat, by chat identifier.
+        """
+        return {chat_identifier: self.db_handler.total_message_amount(
+                    self.db_handler.connection, chat_identifier)
+                for chat_identifier in chat_identifiers}
+    
+    def _poll_new_messages(self) -> float:
+        """
+        Asks the server for the new messages of every chat that is due to be
+        polled, stores them and schedules the next poll of those chats.
+        
+        The requests are pipelined if the server supports it, so that all the
+        due chats take about one round trip.
+        :raises OSError: if the server could not be reached
+        :return: seconds until the next chat is due, at most IDLE_INTERVAL
+        """
+        chats = self._open_chats()
+        with self._chats_lock:
+            active_chats = self._active_chats
+            self._active_chats = set()
+        for chat_identifier in list(self._next_polls):
+            if chat_identifier not in chats:
+                del self._poll_intervals[chat_identifier]
+                del self._next_polls[chat_identifier]
+        now = time.monotonic()
+        # chats that are due shortly are polled early, in the same round
+        due_time = now + self.MIN_POLL_INTERVAL
+        due_chats = {chat_identifier: other_user for chat_identifier,
+                     other_user in chats.items()
+                     if chat_identifier in active_chats or
+                     self._next_polls.get(chat_identifier, now) <= due_time}
+        if len(due_chats) > 0:
+            last_messages = self._last_messages(due_chats)
+            query_msgs = [
+                protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES,
+                                 last_messages[chat_identifier],
+                                 self.user_name,
+                                 other_user)
+                for chat_identifier, other_user in due_chats.items()]
+            des_msgs = self.server_connection.request_many(query_msgs)
+            if self._server_database_reset():
+                # the messages are numbered after messages that are gone, the
+                # chats are polled again from their start
+                return 0
+            updated_chats = self._store_new_messages(
+                [des_msg for des_msg in des_msgs if des_msg is not None])
+            for chat_identifier in due_chats:
+                self._schedule_poll(chat_identifier,
+                                    chat_identifier in updated_chats or
+                                    chat_identifier in active_chats)
+        next_poll = min(self._next_polls.values(),
+                        default=now + self.IDLE_INTERVAL)
+        return min(self.IDLE_INTERVAL, max(0, next_poll - time.monotonic()))
+    
+    def _schedule_poll(self, chat_identifier: str, active: bool) -> None:
+        """
+        Schedules the next poll of a chat after it has been polled.
+        
+        :param chat_identifier: the chats identifier
+        :param active: True if the poll found new messages, or the user sent
+                       a message in the chat
+        :return: None
+        """
+        poll_interval = self.MIN_POLL_INTERVAL
+        if not active:
+            poll_interval = min(self.MAX_POLL_INTERVAL,
+                                self._poll_intervals.get(chat_identifier,
+                                                         poll_interval)
+                                * self.POLL_BACKOFF)
+        self._poll_intervals[chat_identifier] = poll_interval
+        jitter = random.uniform(-self.POLL_JITTER, self.POLL_JITTER)
+        self._next_polls[chat_identifier] = \
+            time.monotonic() + poll_interval * (1 + jitter)
+    
+    def _subscribe(self, chats: typing.Dict[str, str]) -> bool:
+        """
+        Subscribes to chats on the subscription of the refresher.
+        
+        Sets push_supported to False if the server does not support it, and
+        makes later polls pipelined.
+        :raises OSError: if the server could not be reached
+        :param chats: the other user of every chat, by chat identifier
+        :return: True if the chats are subscribed to
+        """
+        last_messages = self._last_messages(chats)
+        for chat_identifier, other_user in chats.items():
+            subscribe_msg = protocol.Message(protocol.Message.SUBSCRIBE,
+                                             last_messages[chat_identifier],
+                                             self.user_name,
+                                             other_user)
+            if not self.server_connection.subscribe(subscribe_msg):
+                self.push_supported = False
+                self.server_connection.close()
+                self.server_connection = ServerConnection(
+                    self.server_address,
+                    pipelining=True,
+                    sessions=self.sessions)
+                return False
+        return True
+    
+    def _receive_pushed_messages(self) -> bool:
+        """
+        Subscribes to the chats and stores the messages pushed by the server
+        until the subscription ends or the thread is killed.
+        
+        Chats that are added in the meantime are subscribed to on the same
+        subscription.
+        :raises OSError: if the server could not be reached
+        :return: True if the server pushed anything on the subscription
+        """
+        received = False
+        subscribed = set()
+        last_received = time.monotonic()
+        while not self.kill_flag.kill:
+            chats = self._open_chats()
+            new_chats = {chat_identifier: other_user for chat_identifier,
+                         other_user in chats.items()
+                         if chat_identifier not in subscribed}
+            if len(new_chats) > 0:
+                if not self._subscribe(new_chats):
+                    return received
+                if self._server_database_reset():
+                    # subscribed again from the start of the chats
+                    self.server_connection.close()
+                    return True
+                subscribed.update(new_chats)
+            if not self.server_connection.wait_for_push(self.IDLE_INTERVAL):
+                idle_time = time.monotonic() - last_received
+                if idle_time > self.SUBSCRIPTION_TIMEOUT:
+                    self.server_connection.close()
+                    return received
+                continue
+            pushed_msg = self.server_connection.receive_pushed_message()
+            if pushed_msg is None:
+                return received
+            received = True
+            last_received = time.monotonic()
+            if pushed_msg.msg_type == protocol.Message.NEW_MESSAGES:
+                self._store_new_messages([pushed_msg])
+        return received
+    
+    def _server_database_reset(self) -> bool:
+        """
+        Deletes the chats in the clients database if the server has another
+        database than the one they came from, which happens when a server that
+        keeps its database in RAM is restarted.
+        
+        :return: True if the chats were deleted
+        """
+        database_id = self.server_connection.database_id
+        if database_id is None or \
+                database_id == self.db_handler.server_database_id():
+            return False
+        self.db_handler.reset(database_id)
+        return True
+    
+    def _schedule_subscription(self, received: bool) -> None:
+        """
+        Schedules the next subscription after a subscription has ended.
+        
+        :param received: True if the server pushed anything on the
+                         subscription
+        :return: None
+        """
+        subscription_interval = self.MIN_POLL_INTERVAL
+        if not received:
+            subscription_interval = min(self.MAX_POLL_INTERVAL,
+                                        self._subscription_interval
+                                        * self.POLL_BACKOFF)
+        self._subscription_interval = subscription_interval
+        jitter = random.uniform(-self.POLL_JITTER, self.POLL_JITTER)
+        self._next_subscription = \
+            time.monotonic() + subscription_interval * (1 + jitter)
+    
+    def _store_new_messages(self, des_msgs: typing.List[protocol.Message]
+                            ) -> typing.Set[str]:
+        """
+        Stores the messages of NEW_MESSAGES messages and tells the observers
+        of the chats that got new messages.
+        
+        :param des_msgs: messages of msg_type NEW_MESSAGES, or NOT_MODIFIED
+                         which are skipped
+        :return: the chat identifiers of the chats that got new messages
+        """
+        list_of_msgs = [rec_msg for des_msg in des_msgs
+                        if des_msg.msg_type == protocol.Message.NEW_MESSAGES
+                        for rec_msg in protocol.unpack_new_messages(des_msg)]
+        if len(list_of_msgs) == 0:
+            return set()
+        self.db_handler.store_new_messages(list_of_msgs)
+        updated_chats = {database.create_chat_identifier(rec_msg.sender,
+                                                         rec_msg.receiver)
+                         for rec_msg in list_of_msgs}
+        # tell observers that new messages have been fetched and added
+        self.update_observers(updated_chats)
+        return updated_chats
+    
+    def update_observers(self, chat_identifiers: typing.Iterable[str]):
+        with self._chats_lock:
+            observers = [observer for chat_identifier in chat_identifiers
+                         if chat_identifier in self._chats
+                         for observer in self._chats[chat_identifier][1]]
+        for observer in observers:
             observer.new_messages_found()
-
@@ -1,9 +1,11 @@
 #!/bin/usr/python
+import collections
 import subprocess
+import sys
+import threading
 import typing
 import database
 import client
-import os
 import protocol
 import socket
 
@@ -11,6 +13,10 @@ import socket
 PATH_TO_DATABASE = "./cl1db/client1.db"
 # PATH_TO_DATABASE = "./cl2db/client2.db"
 
+# sessions, with pushed messages and pipelining, need a server that supports
+# them, a server from before them fails when it is sent one
+SESSIONS = False
+
 
 class ClientSession:
     """
@@ -18,9 +24,15 @@ class ClientSession:
     """
     def __init__(self,
                  db_handler: client.DBHandler,
-                 server_address: typing.Tuple[str, int]):
+                 server_address: typing.Tuple[str, int],
+                 sessions: bool = False):
         self.db_handler = db_handler
         self.server_address = server_address
+        self.sessions = sessions
+        self.server_connection = client.ServerConnection(server_address,
+                                                         sessions=sessions)
+        self.keepalive_kill_flag = client.ThreadKillFlag()
+        self.refresher = None
     
     def _log_in_user(self,  user_name: str):
         self.user_name = user_name
@@ -32,21 +44,24 @@ class ClientSession:
             self, refresher_observer: client.RefresherObserver
                                           ) -> client.ThreadKillFlag:
         """
-        Dispatches a thread that updates the clients database by continuously
-        sending query messages to the server.
+        Adds the chat with the other user to the thread that updates the
+        clients database by continuously sending query messages to the server.
         
+        A single thread updates every open chat of the user, it is dispatched
+        when the first chat is opened.
         :param refresher_observer: observer that should be added to the thread.
         :return: a flag that kill the background thread if set to true
         """
-        kill_flag = client.ThreadKillFlag()
-        bg_thread = client.BackgroundDatabaseRefresher(self.server_address,
-                                                       self.db_handler,
-                                                       self.user_name,
-                                                       self.other_user,
-                                                       kill_flag)
-        bg_thread.add_observer(refresher_observer)
-        bg_thread.start()
-        return kill_flag
+        if self.refresher is None or not self.refresher.is_alive():
+            self.refresher = client.BackgroundDatabaseRefresher(
+                self.server_address,
+                self.db_handler,
+                self.user_name,
+                client.ThreadKillFlag(),
+                self.sessions)
+            self.refresher.start()
+        self.refresher.add_chat(self.other_user, refresher_observer)
+        return self.refresher.kill_flag
     
     def log_in(self, user_name: str):
         """Logs the user name for the chat session."""
@@ -66,17 +81,27 @@ class ClientSession:
         self._test_connection()
         self._add_other_user(other_user)
         kill_flag = self._dispatch_background_update_thread(refresher_observer)
+        self.keepalive_kill_flag = client.ThreadKillFlag()
+        client.ConnectionKeepalive(self.server_connection,
+                                   self.keepalive_kill_flag).start()
         return kill_flag
     
     def close_chat(self, bg_update_db_kill_flag: client.ThreadKillFlag) -> None:
         """
         Closes the chat.
         
+        The thread that updates the database in the background is killed once
+        no chat of the user is open anymore.
         :param bg_update_db_kill_flag: kill flag of the thread that updates the database in the background.
         :return: None
         """
+        if self.refresher is not None:
+            self.refresher.remove_chat(self.other_user)
+            if self.refresher.chat_amount() > 0:
+                return
         bg_update_db_kill_flag.kill = True
-        # TODO: anything else?
+        self.keepalive_kill_flag.kill = True
+        self.server_connection.close()
     
     def _test_connection(self):
         """Crude test if there is a connection available to the server."""
@@ -92,24 +117,56 @@ class ClientSession:
                 self.server_address[0], self.server_address[1]))
             raise timeout
  
-    def send_chat_message(self, text: str) -> None:
+    def send_chat_message(self, text: str) -> bool:
         """
         Sends a chat message to the other party in the chat.
+        :raises OSError: if the server could not be reached
         :param text: text of the text message
-        :return: None
+        :return: False if the server rejected the message, otherwise True
         """
         message = protocol.Message(protocol.Message.CHAT_MESSAGE,
                                    text,
                                    self.user_name,
                                    self.other_user)
-        serialized_message = protocol.serialize_message(message)
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(self.server_address)
-                s.sendall(serialized_message)
-        
-        finally:
-            s.close()
+        return self._send(message)
+    
+    def send_chat_messages(self, texts: typing.List[str]) -> bool:
+        """
+        Sends many chat messages to the other party in the chat at once, in a
+        single message that the server stores in one go.
+        :raises OSError: if the server could not be reached
+        :param texts: texts of the text messages, in the order they are sent
+        :return: False if the server rejected the messages, otherwise True
+        """
+        chat_messages = [protocol.Message(protocol.Message.CHAT_MESSAGE,
+                                          text,
+                                          self.user_name,
+                                          self.other_user)
+                         for text in texts]
+        message = protocol.Message(protocol.Message.CHAT_MESSAGE_BATCH,
+                                   batch=chat_messages)
+        return self._send(message)
+    
+    def _send(self, message: protocol.Message) -> bool:
+        """
+        Sends a message with chat messages to the server.
+        :raises OSError: if the server could not be reached
+        :param message: message of msg_type CHAT_MESSAGE or CHAT_MESSAGE_BATCH
+        :return: False if the server rejected the message, otherwise True
+        """
+        response = self.server_connection.request(message)
+        # a server without sessions sends no response and is trusted to
+        # store the message
+        if response is not None and \
+                response.msg_type == protocol.Message.REJECTED:
+            return False
+        self._chat_active()
+        return True
+    
+    def _chat_active(self) -> None:
+        """Tells the refresher that the user sent a message in the chat."""
+        if self.refresher is not None:
+            self.refresher.chat_active(self.other_user)
     
     def fetch_new_messages(self, last_message: int) -> typing.List[protocol.Message]:
         """
@@ -121,15 +178,68 @@ class ClientSession:
             self.user_name, self.other_user)
         new_msgs = self.db_handler.new_messages(chat_identifier, last_message)
         return new_msgs
+    
+    def fetch_messages(self,
+                       first_message: int,
+                       last_message: int) -> typing.List[protocol.Message]:
+        """
+        Collects a contiguous range of messages from the client database.
+        :param first_message: number of the first message in the range
+        :param last_message: number of the last message in the range
+        :return: list of the messages in the range
+        """
+        chat_identifier = database.create_chat_identifier(
+            self.user_name, self.other_user)
+        return self.db_handler.messages(chat_identifier,
+                                        first_message,
+                                        last_message)
+    
+    def message_amount(self) -> int:
+        """Returns the amount of messages of the chat in the client database."""
+        chat_identifier = database.create_chat_identifier(
+            self.user_name, self.other_user)
+        return self.db_handler.message_amount(chat_identifier)
 
 
 class ClientViewPrinter(client.RefresherObserver):
     """
     Class that handles any standard output of the user interaction.
+    
+    In append only mode new messages are written below the ones already
+    shown, instead of clearing the terminal and writing every message of the
+    chat again. Notifications that arrive while new messages are written are
+    coalesced into writing once more.
+    
+    Only a window of at most WINDOW_SIZE messages of the chat is kept in
+    memory, the rest stays in the client database. The window follows the
+    latest messages, unless it is scrolled back to older ones a page at a
+    time, then new messages are collected once it is scrolled to the latest
+    messages again.
+    
+    Attributes
+        CLEAR_SEQUENCE -- the escape sequence that clears the terminal and
+        moves the cursor to the top\n
+        WINDOW_SIZE -- the amount of messages kept in memory at most\n
+        SCROLL_PAGE_SIZE -- the amount of older messages loaded when the
+        window is scrolled back\n
     """
-    def __init__(self, client_session: ClientSession):
+    CLEAR_SEQUENCE = "\033[2J\033[H"
+    WINDOW_SIZE = 200
+    SCROLL_PAGE_SIZE = 50
+    
+    def __init__(self, client_session: ClientSession, append_only: bool = True):
         self.client_session = client_session
-        self.chat_messages_of_session = []
+        self.append_only = append_only
+        self.chat_messages_of_session = collections.deque(
+            maxlen=self.WINDOW_SIZE)
+        # number of the first message in the window, and of the last message
+        # that has been collected
+        self.first_message = 1
+        self.last_message = 0
+        self._window_lock = threading.Lock()
+        self._rendering = False
+        self._render_pending = False
+        self._render_lock = threading.Lock()
     
     def _add_usernames(self, username, chat_with):
         self.username = username
@@ -140,12 +250,8 @@ class ClientViewPrinter(client.RefresherObserver):
         Clears the terminal from output.
         :return:
         """
-        cmd = ""
-        if os.name == "posix":
-            cmd = "clear"
-        else:
-            cmd = "clr"
-        os.system(cmd)
+        sys.stdout.write(self.CLEAR_SEQUENCE)
+        sys.stdout.flush()
     
     def print_welcome_message(self, username, chat_with):
         self._add_usernames(username, chat_with)
@@ -167,12 +273,18 @@ class ClientViewPrinter(client.RefresherObserver):
     def print_username_invalid(self):
         print("Username invalid.")
     
+    def print_message_not_sent(self):
+        print("The message could not be sent.")
+    
     def print_chat_messages(self):
         self.clear_terminal()
         print("============= Messages in chat with: {} =============")
         # print("============= Messages in chat with: {} =============".format(
         #     self.chat_with))
-        for msg in self.chat_messages_of_session:
+        # the refresher thread extends the window meanwhile
+        with self._window_lock:
+            chat_messages = list(self.chat_messages_of_session)
+        for msg in chat_messages:
             print("{} said: {}".format(msg.sender, msg.content))
         print("============= End of messages ============")
         self.print_enter_message_prompt()
@@ -182,7 +294,9 @@ class ClientViewPrinter(client.RefresherObserver):
         help_msg = "You have a few options:\n" \
                    "1. Send message: enter message and press return.\n" \
                    "2. Show this help message: enter 'help()' and press return" \
-                   "3. Exit session: enter 'exit()' and press return"
+                   "3. Show older messages: enter 'back()' and press return\n" \
+                   "4. Show the latest messages: enter 'latest()' and press return\n" \
+                   "5. Exit session: enter 'exit()' and press return"
         print(help_msg)
     
     def print_enter_message_prompt(self):
@@ -190,15 +304,74 @@ class ClientViewPrinter(client.RefresherObserver):
                   "(For help enter: 'help()' and press return)"
         print(message)
     
-    def collect_new_messages(self):
+    def collect_new_messages(self) -> typing.List[protocol.Message]:
         """
         Collects the new chat messages and stores them for output to the user.
+        
+        Only the latest WINDOW_SIZE new messages are read, and nothing is
+        read while the window is scrolled back.
+        :return: the new chat messages
+        """
+        with self._window_lock:
+            if not self.window_at_latest():
+                return []
+            amount = self.client_session.message_amount()
+            skip_to = max(self.last_message, amount - self.WINDOW_SIZE)
+            new_msgs = self.client_session.fetch_new_messages(skip_to)
+            self.last_message = skip_to + len(new_msgs)
+            self.chat_messages_of_session.extend(new_msgs)
+            self.first_message = \
+                self.last_message - len(self.chat_messages_of_session) + 1
+            return new_msgs
+    
+    def window_at_latest(self) -> bool:
+        """Returns True if the window ends with the last collected message."""
+        return self.first_message + len(self.chat_messages_of_session) - 1 \
+            == self.last_message
+    
+    def scroll_back(self) -> bool:
+        """
+        Loads the page of messages before the window into it, the latest
+        messages of the window are dropped to keep it within WINDOW_SIZE.
+        :return: True if there were older messages
+        """
+        with self._window_lock:
+            if self.first_message <= 1:
+                return False
+            first_older = max(1, self.first_message - self.SCROLL_PAGE_SIZE)
+            older_msgs = self.client_session.fetch_messages(
+                first_older, self.first_message - 1)
+            self.chat_messages_of_session.extendleft(reversed(older_msgs))
+            self.first_message -= len(older_msgs)
+            return len(older_msgs) > 0
+    
+    def scroll_to_latest(self) -> None:
+        """
+        Loads the latest messages into the window, after which new messages
+        are collected again.
+        :return: None
+        """
+        with self._window_lock:
+            amount = self.client_session.message_amount()
+            first_latest = max(1, amount - self.WINDOW_SIZE + 1)
+            self.chat_messages_of_session.clear()
+            self.chat_messages_of_session.extend(
+                self.client_session.fetch_messages(first_latest, amount))
+            self.first_message = first_latest
+            self.last_message = \
+                first_latest + len(self.chat_messages_of_session) - 1
+    
+    def print_new_messages(self, new_msgs: typing.List[protocol.Message]):
+        """
+        Prints new chat messages below the ones already printed.
+        :param new_msgs: the new chat messages
         :return: None
         """
-        new_msgs = self.client_session.fetch_new_messages(
-            len(self.chat_messages_of_session))
-        for each in new_msgs:
-            self.chat_messages_of_session.append(each)
+        if len(new_msgs) == 0:
+            return
+        sys.stdout.write("".join("{} said: {}\n".format(msg.sender, msg.content)
+                                 for msg in new_msgs))
+        self.print_enter_message_prompt()
     
     def print_newest_messages(self):
         """
@@ -210,11 +383,31 @@ class ClientViewPrinter(client.RefresherObserver):
     def new_messages_found(self):
         """
         When called will fetch all new messages and print them to the user.
+        
+        Returns at once if another thread is printing new messages, that
+        thread fetches and prints once more when it is done.
         :return:
         """
-        self.collect_new_messages()
-        self.clear_terminal()
-        self.print_chat_messages()
+        with self._render_lock:
+            if self._rendering:
+                self._render_pending = True
+                return
+            self._rendering = True
+        while True:
+            self._render()
+            with self._render_lock:
+                if not self._render_pending:
+                    self._rendering = False
+                    return
+                self._render_pending = False
+    
+    def _render(self):
+        """Fetches the new messages and prints them in the current mode."""
+        new_msgs = self.collect_new_messages()
+        if self.append_only:
+            self.print_new_messages(new_msgs)
+        else:
+            self.print_chat_messages()
 
 
 class UserInteraction:
@@ -262,6 +455,9 @@ class UserInteraction:
         self.view_printer.print_welcome_message(username, chat_with)
         
         bg_thread_kill_flag = self.client_session.open_chat(chat_with, refresher_observer)
+        # the history stored by earlier runs, the refresher only tells about
+        # messages that are new
+        self.view_printer.print_newest_messages()
         
         chat_messages = []
         chat_open = True
@@ -275,12 +471,23 @@ class UserInteraction:
                 self.view_printer.print_help_message()
             elif user_input == "fetch()":
                 self.view_printer.print_chat_messages()
+            elif user_input == "back()":
+                self.view_printer.scroll_back()
+                self.view_printer.print_chat_messages()
+            elif user_input == "latest()":
+                self.view_printer.scroll_to_latest()
+                self.view_printer.print_chat_messages()
             elif user_input == "exit()":
                 # close chat and shutdown background refresh thread
                 chat_open = False
-                bg_thread_kill_flag.kill = True
+                self.client_session.close_chat(bg_thread_kill_flag)
             else:
-                self.client_session.send_chat_message(user_input)
+                try:
+                    sent = self.client_session.send_chat_message(user_input)
+                except OSError:
+                    sent = False
+                if not sent:
+                    self.view_printer.print_message_not_sent()
 
 
 def main() -> None:
@@ -293,7 +500,7 @@ def main() -> None:
     server_address = (hostname, port_number)
     
     chat_db = client.DBHandler(PATH_TO_DATABASE)
-    client_session = ClientSession(chat_db, server_address)
+    client_session = ClientSession(chat_db, server_address, SESSIONS)
     view_printer = ClientViewPrinter(client_session)
     user_interaction = UserInteraction(client_session, view_printer)
     user_interaction.start(view_printer)
@@ -6,54 +6,82 @@ specifications described further down.
 
 Database specification:
 
-The database consist of two tables. The first (1) is named 'chat_message_amount'
-and the second (2) is named 'chat_messages'.
+The database consist of four tables. The first (1) is named 'users', the
+second (2) is named 'chats', the third (3) is named 'chat_message_amount' and
+the fourth (4) is named 'chat_messages'. Users and chats are referred to by
+integer identifiers everywhere but in tables 1 and 2, so no names are repeated
+in the rows of the messages.
+
+The version of the specification is stored in the user_version of the
+database. A database with the tables of version 0, where the messages were
+keyed by strings in the format '<user-name>:<user-name>:number', is migrated
+to the current version when it is set up.
 
 Table 1
-    Consist of three columns, the first named 'message_identifier' consists of a
-    concatenation of the senders name, the receivers name and the number of the
-    message in the chat. The number is received from the 'total_message_amount'
-    table. The concatenation is in the format '<user-name>:<user-name>:number',
-    and the order of the senders and the receivers name is the name with the
-    smaller string value first and then the name with the larger string value.
-    The first column 'message_identifier' is also a primary key. The second
-    column contains the message. The third column contains the user name of the
-    sender.\n
+    Consist of two columns, the first named 'user_id' is an integer primary
+    key and the second named 'user_name' is the unique name of the user.\n
     
     Table layout: \n
-    .. table:: total_message_amount
-    :widths: 20 15 15
+    .. table:: users
+    :widths: 10 15
     
-    +-------------------+------------+--------+
-    |message_identifier | message    | sender |
-    +-------------------+------------+--------+
-    |user1:user2:1      | hello!     | user2  |
-    +-------------------+------------+--------+
-    |user1:user2:2      | hi there!  | user1  |
-    +-------------------+------------+--------+
-    |user3:user5:1      | good day   | user3  |
-    +-------------------+------------+--------+
+    +---------+-----------+
+    | user_id | user_name |
+    +---------+-----------+
+    | 1       | user1     |
+    +---------+-----------+
+    | 2       | user2     |
+    +---------+-----------+
 
-    
 Table 2
-    Consist of two columns, the first named 'chat_identifier' consist of a
-    concatenation of the senders name and the receivers name, where the name
-    with the smallest string value comes first and in the format
-    '<user-name>:<user-name>'. The column is also a primary key. The second
-    column named 'total_message_amount' holds the amount of messages that are in
-    the database in the chat.\n
+    Consist of three columns, the first named 'chat_id' is an integer primary
+    key. The second and third named 'first_user_id' and 'second_user_id' are
+    the users of the chat, where the user with the smaller name is the first
+    user. Every pair of users has a single chat.\n
+    
+    Table layout: \n
+    .. table:: chats
+    :widths: 10 15 15
+    
+    +---------+---------------+----------------+
+    | chat_id | first_user_id | second_user_id |
+    +---------+---------------+----------------+
+    | 1       | 1             | 2              |
+    +---------+---------------+----------------+
+
+Table 3
+    Consist of two columns, the first named 'chat_id' is the primary key. The
+    second column named 'total_message_amount' holds the amount of messages
+    that are in the database in the chat.\n
     
     Table layout: \n
-    .. table:: total_message_amount
-    :widths: 20 25
+    .. table:: chat_message_amount
+    :widths: 10 25
     
-    +----------------+----------------------+
-    |chat_identifier | total_message_amount |
-    +----------------+----------------------+
-    |user1:user2     | 2                    |
-    +----------------+----------------------+
-    |user3:user5     | 1                    |
-    +----------------+----------------------+
+    +---------+----------------------+
+    | chat_id | total_message_amount |
+    +---------+----------------------+
+    | 1       | 2                    |
+    +---------+----------------------+
+
+Table 4
+    Consist of four columns. The first named 'chat_id' and the second named
+    'message_number', the number of the message in the chat starting from 1,
+    are together the primary key. The table is created WITHOUT ROWID so the
+    messages are stored in the order of the primary key. The third column
+    contains the user identifier of the sender and the fourth the message.\n
+    
+    Table layout: \n
+    .. table:: chat_messages
+    :widths: 10 15 10 15
+    
+    +---------+----------------+-----------+-----------+
+    | chat_id | message_number | sender_id | message   |
+    +---------+----------------+-----------+-----------+
+    | 1       | 1              | 2         | hello!    |
+    +---------+----------------+-----------+-----------+
+    | 1       | 2              | 1         | hi there! |
+    +---------+----------------+-----------+-----------+
 
 """
 import sqlite3
@@ -62,67 +90,180 @@ import threading
 import protocol
 
 
+# version of the database specification, stored as the user_version
+SCHEMA_VERSION = 1
+
+
+class Chat(typing.NamedTuple):
+    """
+    A chat as it is stored in the database.
+    """
+    chat_id: int
+    first_user_id: int
+    first_user: str
+    second_user_id: int
+    second_user: str
+
+
 class Handler:
     """
     Class that handles the database.
+    
+    The identifiers of users and chats are cached once they have been looked
+    up, since they never change. The message amount of every chat is cached
+    as well, the cache is written through whenever messages are added.
     """
     def __init__(self):
         self.database_lock = threading.Lock()
-
-    def _add_chat_message_row(self,
-                              connection: sqlite3.Connection,
-                              message_identifier: str,
-                              message: str,
-                              sender: str) -> None:
+        self._user_ids = dict()
+        self._chats = dict()
+        self._message_amounts = dict()
+    
+    def _connection_lock(self, connection: sqlite3.Connection
+                         ) -> typing.ContextManager:
         """
-        Inserts a new row in the chat_messages table.
+        Returns the lock that has to be held while reading with a connection.
         
         :param connection: the connection to the database.
-        :param message_identifier: the message identifier in the database
-        :param message: message that should be added to the database
-        :param sender: sender of the message
-        :return: None
+        :return: the lock of the connection
+        """
+        return self.database_lock
+    
+    def _user_id(self,
+                 connection: sqlite3.Connection,
+                 user_name: str,
+                 create: bool) -> typing.Optional[int]:
         """
+        Looks up the identifier of a user.
+        
+        Does not commit any change to the database.
+        Is not thread safe, the caller should hold the database_lock.
+        :param connection: the connection to the database.
+        :param user_name: the name of the user
+        :param create: True if the user should be added if not present
+        :return: the identifier of the user, None if the user is not present
+                 and should not be created
+        """
+        user_id = self._user_ids.get(user_name)
+        if user_id is not None:
+            return user_id
         cursor = connection.cursor()
-        with self.database_lock:
+        cursor.execute("SELECT user_id FROM users WHERE user_name =(?)",
+                       (user_name,))
+        row = cursor.fetchone()
+        if row is not None:
+            user_id = row[0]
+        elif create:
+            cursor.execute("INSERT INTO users (user_name) VALUES (?)",
+                           (user_name,))
+            user_id = cursor.lastrowid
+        else:
+            return None
+        self._user_ids[user_name] = user_id
+        return user_id
+    
+    def _chat(self,
+              connection: sqlite3.Connection,
+              chat_identifier: str,
+              create: bool) -> typing.Optional[Chat]:
+        """
+        Looks up the chat with a chat identifier.
+        
+        Does not commit any change to the database.
+        Is not thread safe, the caller should hold the database_lock.
+        :param connection: the connection to the database.
+        :param chat_identifier: the chats identifier
+        :param create: True if the chat and its users should be added if not
+                       present
+        :return: the chat, None if the chat is not present and should not be
+                 created, or its user names are not valid
+        """
+        chat = self._chats.get(chat_identifier)
+        if chat is not None:
+            return chat
+        users = chat_identifier.split(protocol.USER_NAME_SEPARATOR)
+        if len(users) != 2:
+            # not a chat of valid user names
+            return None
+        first_user, second_user = users
+        first_user_id = self._user_id(connection, first_user, create)
+        second_user_id = self._user_id(connection, second_user, create)
+        if first_user_id is None or second_user_id is None:
+            return None
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT
+                chat_id
+            FROM
+                chats
+            WHERE
+                first_user_id =(?) AND second_user_id =(?)
+            """,
+            (first_user_id, second_user_id))
+        row = cursor.fetchone()
+        if row is not None:
+            chat_id = row[0]
+        elif create:
             cursor.execute(
-                "INSERT INTO chat_messages values (?, ?, ?)",
-                (message_identifier, message, sender))
-            connection.commit()
+                """
+                INSERT INTO chats (first_user_id, second_user_id)
+                    VALUES (?, ?)
+                """,
+                (first_user_id, second_user_id))
+            chat_id = cursor.lastrowid
+        else:
+            return None
+        chat = Chat(chat_id, first_user_id, first_user, second_user_id,
+                    second_user)
+        self._chats[chat_identifier] = chat
+        return chat
 
-    def _get_chat_message(self,
+    def get_chat_messages(self,
                           connection: sqlite3.Connection,
-                          message_identifier: str
-                          ) -> typing.Tuple[str, str, str]:
+                          chat_identifier: str,
+                          first_message: int,
+                          last_message: int
+                          ) -> typing.List[typing.Tuple[int, str, str, str]]:
         """
-        Queries the database for a specific chat message.
+        Queries the database for a contiguous range of messages in a chat.
         
-        :raises NotPresentInDatabase: Raised when the specified message does not
-                                      exist in the database.
+        The range is fetched with a single query on the primary key while
+        holding the lock once.
         :param connection: the connection to the database.
-        :param message_identifier: the message identifier
-        :return: a tuple of the row containing the specific chat message
+        :param chat_identifier: the chats identifier
+        :param first_message: number of the first message in the range
+        :param last_message: number of the last message in the range
+        :return: the rows of the messages in the range that are present in the
+                 database, ordered by message number, in the format
+                 (message_number, message, sender, receiver)
         """
+        if last_message < first_message:
+            return []
         cursor = connection.cursor()
-        row = None
-        with self.database_lock:
+        with self._connection_lock(connection):
+            chat = self._chat(connection, chat_identifier, create=False)
+            if chat is None:
+                return []
             cursor.execute(
                 """
                 SELECT
-                    message_identifier,
+                    message_number,
                     message,
-                    sender
+                    CASE sender_id WHEN (?1) THEN (?2) ELSE (?3) END,
+                    CASE sender_id WHEN (?1) THEN (?3) ELSE (?2) END
                 FROM
                     chat_messages
                 WHERE
-                    message_identifier =(?)
+                    chat_id =(?4) AND message_number BETWEEN (?5) AND (?6)
+                ORDER BY
+                    message_number
                 """,
-                (message_identifier,))
-            row = cursor.fetchone()
-        if row is None:
-            raise NotPresentInDatabase
-        return row
-
+                (chat.first_user_id, chat.first_user, chat.second_user,
+                 chat.chat_id, first_message, last_message))
+            rows = cursor.fetchall()
+        return rows
+    
     def total_message_amount(self,
                              connection: sqlite3.Connection,
                              chat_identifier: str) -> int:
@@ -134,49 +275,47 @@ class Handler:
         :param chat_identifier: the chats identifier
         :return: the number of messages that are in the chat
         """
-        total_message_amount = 0
-        with self.database_lock:
-            cursor = connection.cursor()
-            cursor.execute(
-                """
-                SELECT
-                    total_message_amount
-                FROM
-                    chat_message_amount
-                WHERE
-                    chat_identifier =(?)
-                """, (chat_identifier,))
-            stored_amount = cursor.fetchone()
-            # if the query returns None then the value was not found in the column
-            if stored_amount is not None:
-                total_message_amount = stored_amount[0]  # returns a 1-tuple
-        return total_message_amount
+        with self._connection_lock(connection):
+            chat = self._chat(connection, chat_identifier, create=False)
+            if chat is None:
+                return 0
+            total_message_amount = self._message_amounts.get(chat.chat_id)
+            if total_message_amount is None:
+                total_message_amount = self._stored_message_amount(
+                    connection, chat.chat_id)
+                # a writer may have cached a newer amount meanwhile
+                total_message_amount = self._message_amounts.setdefault(
+                    chat.chat_id, total_message_amount)
+            return total_message_amount
     
-    def _increment_total_message_amount(self,
-                                        connection: sqlite3.Connection,
-                                        chat_identifier: str) -> None:
+    def _stored_message_amount(self,
+                               connection: sqlite3.Connection,
+                               chat_id: int) -> int:
         """
-        Increments the total message amount in the database for the chat.
+        Queries the database how many messages are saved to a chat.
+        
+        Is not thread safe, the caller should hold the database_lock.
         :param connection: the connection to the database.
-        :param chat_identifier: the chat identifier of the chat to increment
-        :return: None
-        """
-        sql_cmd = """
-                INSERT
-                    INTO chat_message_amount
-                        (chat_identifier, total_message_amount)
-                    VALUES
-                        ((?), 1)
-                ON CONFLICT
-                    (chat_identifier)
-                DO UPDATE SET
-                    total_message_amount=total_message_amount+1
+        :param chat_id: the identifier of the chat
+        :return: the number of messages that are in the chat
         """
+        total_message_amount = 0
         cursor = connection.cursor()
-        with self.database_lock:
-            cursor.execute(sql_cmd, (chat_identifier,))
-        connection.commit()
-
+        cursor.execute(
+            """
+            SELECT
+                total_message_amount
+            FROM
+                chat_message_amount
+            WHERE
+                chat_id =(?)
+            """, (chat_id,))
+        stored_amount = cursor.fetchone()
+        # if the query returns None then the value was not found in the column
+        if stored_amount is not None:
+            total_message_amount = stored_amount[0]  # returns a 1-tuple
+        return total_message_amount
+    
     def add_chat_message_to_database(self,
                                      connection: sqlite3.Connection,
                                      message: protocol.Message) -> None:
@@ -187,29 +326,208 @@ class Handler:
         :param message: the message that should be saved
         :return: None
         """
-        if not protocol.valid_content_format(message) or \
-                not protocol.valid_receiver_format(message) or\
-                not protocol.valid_sender_format(message):
-            # TODO: log error
-            print("Message not added to database, incorrect format, message:",
-                  message)
+        self.add_chat_messages_to_database(connection, [message])
+    
+    def add_chat_messages_to_database(
+            self,
+            connection: sqlite3.Connection,
+            messages: typing.Iterable[protocol.Message]
+    ) -> typing.List[typing.Tuple[str, int, protocol.Message]]:
+        """
+        Stores chat messages in the database in a single transaction.
+        
+        The messages are numbered in the order given, and messages with an
+        incorrect format are left out. The numbers of every chat are allocated
+        with a single statement that increments its message amount and
+        returns the result, so no message amount has to be read first.
+        :param connection: the connection to the database.
+        :param messages: the messages that should be saved
+        :return: the messages that were stored, in the format
+                 (chat_identifier, message_number, message), ordered by
+                 message number within every chat
+        """
+        # the chat identifier of every chat in the batch, with the sender
+        # identifier and message of each of its messages
+        chat_rows = dict()
+        stored_messages = []
+        message_rows = []
+        # the new message amount of every chat with messages in the batch
+        message_amounts = dict()
+        cursor = connection.cursor()
+        with self.database_lock:
+            try:
+                for message in messages:
+                    if not protocol.valid_content_format(message) or \
+                            not protocol.valid_receiver_format(message) or\
+                            not protocol.valid_sender_format(message):
+                        # TODO: log error
+                        print("Message not added to database, incorrect "
+                              "format, message:", message)
+                        continue
+                    chat_identifier = create_chat_identifier(message.sender,
+                                                             message.receiver)
+                    chat = self._chat(connection, chat_identifier, create=True)
+                    sender_id = chat.first_user_id \
+                        if message.sender == chat.first_user \
+                        else chat.second_user_id
+                    chat_rows.setdefault(
+                        chat.chat_id, (chat_identifier, []))[1].append(
+                        (sender_id, message))
+                for chat_id, (chat_identifier, rows) in chat_rows.items():
+                    cursor.execute(
+                        """
+                        INSERT
+                            INTO chat_message_amount
+                                (chat_id, total_message_amount)
+                            VALUES
+                                ((?), (?))
+                        ON CONFLICT
+                            (chat_id)
+                        DO UPDATE SET
+                            total_message_amount=total_message_amount
+                                + excluded.total_message_amount
+                        RETURNING
+                            total_message_amount
+                        """,
+                        (chat_id, len(rows)))
+                    message_amounts[chat_id] = cursor.fetchone()[0]
+                    first_number = message_amounts[chat_id] - len(rows) + 1
+                    for number, (sender_id, message) in enumerate(
+                            rows, first_number):
+                        message_rows.append((chat_id, number, sender_id,
+                                             message.content))
+                        stored_messages.append((chat_identifier, number,
+                                                message))
+                cursor.executemany(
+                    "INSERT INTO chat_messages values (?, ?, ?, ?)",
+                    message_rows)
+                connection.commit()
+            except sqlite3.Error:
+                connection.rollback()
+                # users and chats added in the transaction are gone
+                self._user_ids.clear()
+                self._chats.clear()
+                self._message_amounts.clear()
+                raise
+            self._message_amounts.update(message_amounts)
+        return stored_messages
+    
+    def _setup_tables(self, connection: sqlite3.Connection) -> None:
+        """
+        Creates the tables of the database if they are not present, and
+        migrates tables of an older version of the specification.
+        
+        Commits the changes to the database.
+        Is not thread safe.
+        :param connection: the connection to the database
+        :return: None
+        """
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        if version == SCHEMA_VERSION:
             return
+        if version != 0:
+            raise sqlite3.DatabaseError(
+                "Unknown database version {}.".format(version))
+        legacy = _table_exists(cursor, "chat_messages")
+        if legacy:
+            cursor.execute(
+                "ALTER TABLE chat_messages RENAME TO legacy_chat_messages")
+        # the amounts are counted again from the migrated messages
+        cursor.execute("DROP TABLE IF EXISTS chat_message_amount")
+        self._setup_users_table(cursor)
+        self._setup_chats_table(cursor)
+        self._setup_chat_message_amount_table(cursor)
+        self._setup_chat_messages_table(cursor)
+        if legacy:
+            self._migrate_legacy_chat_messages(connection)
+            cursor.execute("DROP TABLE legacy_chat_messages")
+        cursor.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        connection.commit()
+    
+    def _migrate_legacy_chat_messages(self,
+                                      connection: sqlite3.Connection) -> int:
+        """
+        Copies the messages of a version 0 chat_messages table, renamed to
+        legacy_chat_messages, into the current tables.
         
-        msg = message.content
-        sender = message.sender
-        receiver = message.receiver
+        The message numbers are kept, and the message amounts are counted from
+        the copied messages. The messages of chats with a user name that is
+        no longer valid are left out, and how many were is reported.
+        Does not commit the change to the database.
+        Is not thread safe.
+        :param connection: the connection to the database
+        :return: the amount of messages that were left out
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT message_identifier, message, sender "
+            "FROM legacy_chat_messages")
+        rows = []
+        skipped_amount = 0
+        for message_identifier, message, sender in cursor.fetchall():
+            chat_identifier, _, message_number = \
+                message_identifier.rpartition(":")
+            chat = self._chat(connection, chat_identifier, create=True)
+            if chat is None:
+                # a user name of an older version that is no longer valid
+                skipped_amount += 1
+                continue
+            sender_id = chat.first_user_id if sender == chat.first_user \
+                else chat.second_user_id
+            rows.append((chat.chat_id, int(message_number), sender_id, message))
+        cursor.executemany("INSERT INTO chat_messages values (?, ?, ?, ?)",
+                           rows)
+        cursor.execute(
+            """
+            INSERT INTO chat_message_amount (chat_id, total_message_amount)
+                SELECT chat_id, MAX(message_number)
+                FROM chat_messages
+                GROUP BY chat_id
+            """)
+        if skipped_amount > 0:
+            # TODO: log error
+            print("Left out {} messages of the old database, their chats "
+                  "have user names that are no longer valid."
+                  .format(skipped_amount))
+        return skipped_amount
+    
+    def _setup_users_table(self, cursor: sqlite3.Cursor) -> None:
+        """
+        Create a new users table with user_id as primary key
         
-        chat_id = create_chat_identifier(sender, receiver)
-        # + 1 so that messages identifier match the queries
-        msg_number = self.total_message_amount(connection, chat_id) + 1
-        msg_id = create_message_identifier(chat_id, msg_number)
-        self._add_chat_message_row(connection, msg_id, msg, sender)
-        self._increment_total_message_amount(connection, chat_id)
-
+        Does not commit the change to the database.
+        Is not thread safe.
+        :param cursor: cursor from the connection of sqlite3 database
+        :return: None
+        """
+        cursor.execute(
+            """CREATE TABLE users
+            (user_id INTEGER PRIMARY KEY,
+            user_name VARCHAR UNIQUE NOT NULL)""")
+        return
+    
+    def _setup_chats_table(self, cursor: sqlite3.Cursor) -> None:
+        """
+        Create a new chats table with chat_id as primary key
+        
+        Does not commit the change to the database.
+        Is not thread safe.
+        :param cursor: cursor from the connection of sqlite3 database
+        :return: None
+        """
+        cursor.execute(
+            """CREATE TABLE chats
+            (chat_id INTEGER PRIMARY KEY,
+            first_user_id INTEGER NOT NULL REFERENCES users,
+            second_user_id INTEGER NOT NULL REFERENCES users,
+            UNIQUE (first_user_id, second_user_id))""")
+        return
 
     def _setup_chat_message_amount_table(self, cursor: sqlite3.Cursor) -> None:
         """
-        Create a new chat message amount table with chat_identifier as primary key
+        Create a new chat message amount table with chat_id as primary key
         
         Does not commit the change to the database.
         Is not thread safe.
@@ -219,13 +537,13 @@ class Handler:
         # with self.database_lock:
         cursor.execute(
             """CREATE TABLE chat_message_amount
-            (chat_identifier VARCHAR PRIMARY KEY NOT NULL,
-            total_message_amount INTEGER)""")
+            (chat_id INTEGER PRIMARY KEY REFERENCES chats,
+            total_message_amount INTEGER NOT NULL)""")
         return
     
     def _setup_chat_messages_table(self, cursor: sqlite3.Cursor) -> None:
         """
-        Create a new message table with message_identifier as primary key
+        Create a new message table with (chat_id, message_number) as primary key
         
         Does not commit the change to the database.
         Is not thread safe.
@@ -235,9 +553,12 @@ class Handler:
         # with self.database_lock:
         cursor.execute(
             """CREATE TABLE chat_messages
-            (message_identifier VARCHAR PRIMARY KEY NOT NULL ,
+            (chat_id INTEGER NOT NULL REFERENCES chats,
+            message_number INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL REFERENCES users,
             message VARCHAR,
-            sender VARCHAR)""")
+            PRIMARY KEY (chat_id, message_number))
+            WITHOUT ROWID""")
         return
 
 
@@ -258,41 +579,37 @@ def create_chat_identifier(first_user: str, second_user: str) -> str:
     return combined
 
 
-def create_message_identifier(chat_identifier: str,
-                              message_number: int) -> str:
-    """
-    Creates a message identifier.
-    
-    :param chat_identifier: the chats identifier
-    :param message_number: the message number
-    :return: a message identifier
-    """
-    msg_id = "{}:{}".format(chat_identifier, message_number)
-    return msg_id
-
-
-def table_row_to_msg(row: typing.Tuple[str, str, str]) -> protocol.Message:
+def table_row_to_msg(row: typing.Tuple[int, str, str, str]) -> protocol.Message:
     """
-    Translates a row of the chat messages table into a Message object.
+    Translates a row returned by Handler.get_chat_messages into a Message object.
     :param row: the row that should be translated
     :return: the row as a Message object.
     """
-    message_identifier = row[0]
-    content = row[1]
-    sender = row[2]
-    first_user, second_user = message_identifier.split(":")[:2]
-    if first_user != sender:
-        receiver = first_user
-    else:
-        receiver = second_user
-    
     message = protocol.Message(protocol.Message.CHAT_MESSAGE,
-                      content,
-                      sender,
-                      receiver)
+                               row[1],
+                               row[2],
+                               row[3])
     return message
 
 
+def _table_exists(cursor: sqlite3.Cursor, table_name: str) -> bool:
+    """
+    Checks if a table is present in the database.
+    
+    :param cursor: cursor from the connection of sqlite3 database
+    :param table_name: the name of the table
+    :return: True if the table is present
+    """
+    cursor.execute(
+        """
+        SELECT name FROM sqlite_master
+            WHERE type='table'
+            AND name=(?)
+        """,
+        (table_name,))
+    return cursor.fetchone() is not None
+
+
 class NotPresentInDatabase(Exception):
     """
     Exception that signals that something is not present in the database.
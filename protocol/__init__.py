@@ -7,20 +7,148 @@ Specification of a serialized message.
     A serialized message shall be composed of two parts, (1) a fixed length
     header and (2) the message. There shall be nothing between the parts.
     
-    The message (2) cannot be longer than 2^16 bytes since that is the biggest
-    number that the fixed length header can represent.
+    The message (2) cannot be longer than 2^16 - 1 bytes since that is the
+    biggest number that the fixed length header can represent.
     
     1. Fixed length header
         * An integer that denotes the length of (2) the variable length header.
-        * Shall be two bytes long, in big-endian/network byteorder.
+        * Shall be two bytes long, in big-endian/network byteorder, or four
+          bytes long in a session where that was negotiated.
     2. The message
         * JSON object
         * Shall contain key "msg_type": non-empty string denoting the message msg_type value.
         * Shall contain key "content", string containing the message content.
+        * May contain key "wait_timeout", a non-negative integer of at most
+          MAX_WAIT_TIMEOUT, which is left out when it is 0.
         * Is of variable length.
+
+Versions.
+    The message (2) described above is version 1 of the protocol. A message
+    of version 2 is binary instead, and starts with the byte 0x02 where a
+    message of version 1 starts with '{'. The fields of a version 2 message,
+    all integers unsigned and in big-endian byteorder:
+        * version, 1 byte, always 2.
+        * msg_type, 1 byte.
+        * flags, 1 byte, bit 0 is set if a wait_timeout follows.
+        * length of the content, 4 bytes.
+        * length of the sender, 2 bytes.
+        * length of the receiver, 2 bytes.
+        * wait_timeout, 4 bytes, only present if its flag is set.
+        * content, sender and receiver, as UTF-8 of the lengths above.
+    The content of a NEW_MESSAGES or CHAT_MESSAGE_BATCH message of version 2
+    is its chat messages, each a version 2 message of its own, one after the
+    other.
+    
+    Version 2 is only used in a session in which it was negotiated. The
+    client lists the versions it supports under "versions" in the options of
+    OPEN_SESSION, and the server picks one and confirms it under "version".
+    The OPEN_SESSION messages themselves are of version 1.
+
+Batches.
+    The content of a NEW_MESSAGES or CHAT_MESSAGE_BATCH message of version 1
+    is a JSON list of serialized chat messages, that is serialized once more
+    as the string in the content. In a session where "batch" was negotiated, the content is
+    empty instead, and the message has the key "batch" with a list of the
+    chat messages as JSON objects, so that the whole message is decoded at
+    once. The client asks for it with "batch": true in the options of
+    OPEN_SESSION, and the server confirms it the same way. Version 2 always
+    has its chat messages in a batch.
+
+Compression.
+    In a session where compression was negotiated, a message of any version
+    may be compressed with zlib. The compressed message starts with the byte
+    0x01, followed by the message compressed, which decompresses to at most
+    2^24 bytes. The client lists the compressions it supports under
+    "compression" in the options of OPEN_SESSION, and the server confirms
+    the one it uses under "compression". The server only compresses the
+    messages that are long enough for it to pay off.
+
+Paging.
+    A client that is far behind receives its new messages in pages, one
+    NEW_MESSAGES message at a time. A page holds as many messages as fit in
+    its page size, but always at least one message. In the options of
+    OPEN_SESSION the client may ask for a "header_size" of 4, which the
+    server confirms if supported, so that the messages after the OPEN_SESSION
+    messages can be longer than 2^16 - 1 bytes. The client may then also ask
+    for a "page_size" in bytes, and the server confirms the page size it
+    uses, which may be smaller.
+
+Sessions.
+    A connection carries a single message, and the server closes it after
+    replying, unless the first message on it is of msg_type OPEN_SESSION. The
+    connection is then a session that carries any amount of messages in both
+    directions, where the server answers every message of the client with
+    exactly one message. A chat message, or a batch of them, that the server
+    does not store is answered with a message of msg_type REJECTED, and the
+    session stays open.
+    
+    A session in which the client sends a message of msg_type SUBSCRIBE turns
+    into a subscription. The client may then only send more SUBSCRIBE messages,
+    which are not confirmed, and the server pushes a NEW_MESSAGES message as
+    soon as there are new messages in a subscribed chat. The server sends
+    KEEPALIVE messages while a subscription is idle.
+    
+    In a session where "pipelining" was negotiated, the client may send
+    messages without waiting for the responses to the ones before, and the
+    server answers them in any order. Every message of such a session has a
+    request id of 4 bytes, in big-endian byteorder, between the fixed length
+    header and the message, which the header does not count. The server
+    answers a message with the request id of the message. The client asks
+    for it with "pipelining": true in the options of OPEN_SESSION, and the
+    server confirms it the same way. A pipelined session cannot turn into a
+    subscription.
+    
+    The server confirms every session with the id of its database under
+    "database_id". The id changes when the server loses the history of its
+    chats, so that the client knows to receive them again from the start.
+    
+    In a session where "not_modified" was negotiated, the server answers a
+    REQUEST_NEW_MESSAGES message with a NOT_MODIFIED message, instead of an
+    empty NEW_MESSAGES message, when there are no new messages. The client
+    asks for it with "not_modified": true in the options of OPEN_SESSION, and
+    the server confirms it the same way.
 """
-from typing import Dict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import json
+import socket
+import struct
+import sys
+import zlib
+
+
+# the sizes of the fixed length header, the wide header has to be negotiated
+HEADER_SIZE = 2
+WIDE_HEADER_SIZE = 4
+HEADER_SIZES = (HEADER_SIZE, WIDE_HEADER_SIZE)
+
+VERSION_1 = 1
+VERSION_2 = 2
+# the versions of the protocol that are supported
+VERSIONS = (VERSION_1, VERSION_2)
+
+# the fixed fields of a version 2 message: version, msg_type, flags and the
+# lengths of the content, the sender and the receiver
+_V2_HEADER = struct.Struct("!BBBIHH")
+_V2_WAIT_TIMEOUT = struct.Struct("!I")
+_V2_FLAG_WAIT_TIMEOUT = 0x01
+# the longest wait timeout, the largest that fits in its field in version 2
+MAX_WAIT_TIMEOUT = 2**(8 * _V2_WAIT_TIMEOUT.size) - 1
+
+# the compression a session may negotiate, which is only used for messages of
+# at least COMPRESSION_THRESHOLD bytes
+COMPRESSION = "zlib"
+COMPRESSION_THRESHOLD = 2**10
+COMPRESSION_LEVEL = 1
+MAX_DECOMPRESSED_LENGTH = 2**24
+_COMPRESSED_MARKER = b"\x01"
+
+# separates the user names in a chat identifier, so it may not be part of one
+USER_NAME_SEPARATOR = ":"
+
+# the size of the request id that follows the fixed length header in a
+# pipelined session
+REQUEST_ID_SIZE = 4
+MAX_REQUEST_ID = 2**(8 * REQUEST_ID_SIZE) - 1
 
 
 class InvalidMessageFormatError(Exception):
@@ -41,8 +169,30 @@ class Message:
             * content:      non-empty string, id of last number received
             * sender:       non-empty string
             * receiver:     non-empty string
+            * wait_timeout: optional, milliseconds the server may wait for a
+                            new message before answering that there is none
         NEW_MESSAGES
             * content:      non-empty sting, serialized list containing serialized messages
+            * batch:        the chat messages instead of the content, when
+                            received in a batch
+        OPEN_SESSION
+            * content:      JSON object with the options of the session
+        KEEPALIVE
+            * content:      empty string
+        ACKNOWLEDGE
+            * content:      empty string
+        SUBSCRIBE
+            * content:      non-empty string, id of last number received
+            * sender:       non-empty string
+            * receiver:     non-empty string
+        CHAT_MESSAGE_BATCH
+            * content:      non-empty sting, serialized list containing serialized messages
+            * batch:        the chat messages instead of the content, when
+                            sent in a batch
+        NOT_MODIFIED
+            * content:      empty string
+        REJECTED
+            * content:      empty string
     
     Attributes
         CHAT_MESSAGE -- message msg_type used when message is a chat message
@@ -50,15 +200,55 @@ class Message:
         messages that are available on server\n
         NEW_MESSAGES -- message msg_type used when sending new messages from the
         server, sent as a response to type REQUEST_NEW_MESSAGES\n
+        OPEN_SESSION -- message msg_type used by a client to turn its connection
+        into a session that carries many messages, the server confirms the
+        session with a message of the same msg_type\n
+        KEEPALIVE -- message msg_type used to keep an idle session open, the
+        server answers with a message of the same msg_type\n
+        ACKNOWLEDGE -- message msg_type used by the server in a session to
+        confirm that a chat message has been stored\n
+        SUBSCRIBE -- message msg_type used in a session to subscribe to the new
+        messages of a chat, the server confirms the subscription with a message
+        of the same msg_type and then pushes NEW_MESSAGES messages\n
+        CHAT_MESSAGE_BATCH -- message msg_type used when sending many chat
+        messages at once, of one or more chats, which are stored together\n
+        NOT_MODIFIED -- message msg_type used by the server in a session to
+        answer a REQUEST_NEW_MESSAGES message when there are no new messages,
+        if the session negotiated it\n
+        REJECTED -- message msg_type used by the server in a session to answer
+        a CHAT_MESSAGE or CHAT_MESSAGE_BATCH message that it did not store,
+        because it was malformed or too long\n
+    
+    A message has slots instead of a __dict__, and the names of its sender and
+    receiver are interned, so that the many messages held by the clients and
+    the server share the strings of the few users that sent them.
     """
+    __slots__ = ("msg_type",
+                 "content",
+                 "sender",
+                 "receiver",
+                 "wait_timeout",
+                 "batch",
+                 "version")
+    
     CHAT_MESSAGE = 0
     REQUEST_NEW_MESSAGES = 1
     NEW_MESSAGES = 2
+    OPEN_SESSION = 3
+    KEEPALIVE = 4
+    ACKNOWLEDGE = 5
+    SUBSCRIBE = 6
+    CHAT_MESSAGE_BATCH = 7
+    NOT_MODIFIED = 8
+    REJECTED = 9
     
     def __init__(self, msg_type: int,
                  content="",
                  sender="",
-                 receiver=""):
+                 receiver="",
+                 wait_timeout=0,
+                 batch: Optional[List["Message"]] = None,
+                 version=VERSION_1):
         """
         Initializes a Message object.
         
@@ -68,12 +258,20 @@ class Message:
         :param content: content of the message
         :param sender: name of sender
         :param receiver: name of receiver
+        :param wait_timeout: milliseconds the server may wait for new messages
+        :param batch: the chat messages of a NEW_MESSAGES or
+                      CHAT_MESSAGE_BATCH message, if they are not serialized
+                      in its content
+        :param version: the version of the protocol the message was received in
         """
         
         self.msg_type = msg_type
         self.content = str(content)
-        self.sender = str(sender)
-        self.receiver = str(receiver)
+        self.sender = sys.intern(str(sender))
+        self.receiver = sys.intern(str(receiver))
+        self.wait_timeout = wait_timeout
+        self.batch = batch
+        self.version = version
         
         if msg_type is Message.CHAT_MESSAGE and content == "":
             raise InvalidMessageFormatError("Chat message text is missing.")
@@ -87,6 +285,55 @@ class Message:
                               receiver=self.receiver)
 
 
+# the msg_types of the messages that carry chat messages
+_CHAT_MESSAGES_TYPES = (Message.NEW_MESSAGES, Message.CHAT_MESSAGE_BATCH)
+
+
+class SerializedMessage(Message):
+    """
+    A message that has been serialized in advance, see serialize_new_messages.
+    
+    serialize_message returns the serialized message as it is when asked for
+    its version, header size and batch format, and if it is compressed for
+    compression. The other attributes of a Message are deserialized from it
+    the first time one is used.
+    """
+    __slots__ = ("serialized", "header_size", "batch_format", "compressed")
+    
+    def __init__(self,
+                 serialized: bytes,
+                 version: int = VERSION_1,
+                 header_size: int = HEADER_SIZE,
+                 batch_format: bool = False,
+                 compressed: bool = False):
+        """
+        Initializes a SerializedMessage object.
+        
+        :param serialized: the message serialized according to the protocol
+                           specification
+        :param version: the version of the protocol it is serialized in
+        :param header_size: the size of its fixed length header
+        :param batch_format: True if it is serialized in the batch format
+        :param compressed: True if it is compressed
+        """
+        self.serialized = serialized
+        self.version = version
+        self.header_size = header_size
+        self.batch_format = batch_format or version == VERSION_2
+        self.compressed = compressed
+    
+    def __getattr__(self, name: str):
+        # only called for attributes that are not set, which the attributes of
+        # a Message are until they are deserialized
+        if name not in Message.__slots__ or name == "version":
+            raise AttributeError(name)
+        message = deserialize_message(self.serialized[self.header_size:])
+        for slot in Message.__slots__:
+            if slot != "version":
+                setattr(self, slot, getattr(message, slot))
+        return getattr(message, name)
+
+
 class ProtocolViolationError(Exception):
     """
     Class signaling that the message protocol was violated.
@@ -103,37 +350,424 @@ class MessageCorruptError(Exception):
         self.msg = msg
 
 
-def serialize_message(message: Message) -> bytes:
+def serialize_message(message: Message,
+                      version: int = VERSION_1,
+                      header_size: int = HEADER_SIZE,
+                      batch_format: bool = False,
+                      compression: bool = False) -> bytes:
     """
     Takes a message and serializes it according to the protocol specification.
     
+    :raises ProtocolViolationError: if the message is too long
     :param message: the message that should be serialized
+    :param version: the version of the protocol to serialize the message in
+    :param header_size: the size of the fixed length header
+    :param batch_format: True if the chat messages of a NEW_MESSAGES or
+                         CHAT_MESSAGE_BATCH message should be serialized in a
+                         batch
+    :param compression: True if the message may be compressed
     :return: the serialized message
     """
-    encoding = "UTF-8"
-    msg_content_serialized = serialize_message_content(message).encode(encoding)
+    batch_format = batch_format or version == VERSION_2
+    if isinstance(message, SerializedMessage) and \
+            message.version == version and \
+            message.header_size == header_size and \
+            message.batch_format == batch_format and \
+            (compression or not message.compressed):
+        return message.serialized
+    if version == VERSION_2:
+        msg_content_serialized = _serialize_v2_body(message)
+    else:
+        encoding = "UTF-8"
+        msg_content_serialized = serialize_message_content(
+            message, batch_format).encode(encoding)
+    if compression:
+        msg_content_serialized = _compress(msg_content_serialized)
+    return _frame(msg_content_serialized, header_size)
+
+
+def max_message_length(header_size: int) -> int:
+    """
+    Returns the length of the longest message a fixed length header can
+    denote.
+    
+    :param header_size: the size of the fixed length header
+    :return: the maximum length in bytes
+    """
+    # max unsigned integer in header_size bytes
+    return 2**(8 * header_size) - 1
+
+
+def _frame(msg_content_serialized: bytes, header_size: int) -> bytes:
+    """
+    Puts the fixed length header in front of a serialized message.
+    
+    :raises ProtocolViolationError: if the message is too long
+    :param msg_content_serialized: the serialized message
+    :param header_size: the size of the fixed length header
+    :return: the serialized message with its header
+    """
     msg_len = len(msg_content_serialized)
-    if msg_len > 2**16:  # max unsigned integer in 2 bytes
+    if msg_len > max_message_length(header_size):
         raise ProtocolViolationError("Message is too long.")
-    serialized_message = msg_len.to_bytes(2,"big") + msg_content_serialized
+    serialized_message = msg_len.to_bytes(header_size, "big") + \
+        msg_content_serialized
     return serialized_message
 
 
-def serialize_message_content(message) -> str:
+def _compress(msg_content_serialized: bytes) -> bytes:
+    """
+    Compresses a serialized message, without its header, if it is long enough
+    for it to pay off.
+    
+    :param msg_content_serialized: the serialized message
+    :return: the compressed message, or the message as it is
+    """
+    if len(msg_content_serialized) < COMPRESSION_THRESHOLD:
+        return msg_content_serialized
+    compressed = _COMPRESSED_MARKER + zlib.compress(msg_content_serialized,
+                                                    COMPRESSION_LEVEL)
+    if len(compressed) >= len(msg_content_serialized):
+        return msg_content_serialized
+    return compressed
+
+
+def _decompress(serialized_message: bytes) -> bytes:
+    """
+    Decompresses a compressed message, without its header.
+    
+    :raises ProtocolViolationError: if the message could not be decompressed,
+            or is too long decompressed
+    :param serialized_message: the compressed message
+    :return: the serialized message
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        decompressed = decompressor.decompress(
+            memoryview(serialized_message)[len(_COMPRESSED_MARKER):],
+            MAX_DECOMPRESSED_LENGTH)
+    except zlib.error:
+        raise ProtocolViolationError("The message could not be decompressed.")
+    if not decompressor.eof or decompressor.unconsumed_tail or \
+            decompressor.unused_data:
+        raise ProtocolViolationError(
+            "The message is too long or not compressed correctly.")
+    if decompressed[:1] == _COMPRESSED_MARKER:
+        raise ProtocolViolationError("The message is compressed twice.")
+    return decompressed
+
+
+def _serialize_v2_body(message: Message) -> bytes:
+    """
+    Serializes a message in version 2 of the protocol, without the header.
+    
+    :raises ProtocolViolationError: if a field is too long
+    :param message: the message that should be serialized
+    :return: the serialized message
+    """
+    if message.msg_type in _CHAT_MESSAGES_TYPES:
+        content = b"".join(_serialize_v2_body(each)
+                           for each in unpack_new_messages(message))
+    else:
+        content = message.content.encode("UTF-8")
+    sender = message.sender.encode("UTF-8")
+    receiver = message.receiver.encode("UTF-8")
+    flags = _V2_FLAG_WAIT_TIMEOUT if message.wait_timeout else 0
+    try:
+        header = _V2_HEADER.pack(VERSION_2, message.msg_type, flags,
+                                 len(content), len(sender), len(receiver))
+        if flags:
+            header += _V2_WAIT_TIMEOUT.pack(message.wait_timeout)
+    except struct.error:
+        raise ProtocolViolationError("A field of the message is too long.")
+    return b"".join((header, content, sender, receiver))
+
+
+def deserialize_message(serialized_message: bytes) -> Message:
+    """
+    Deserializes a message, without its header, of any version of the protocol.
+    
+    :raises ProtocolViolationError: if the message violates the protocol
+    :param serialized_message: the serialized message
+    :return: the deserialized message, with the version it was serialized in
+    """
+    if serialized_message[:1] == _COMPRESSED_MARKER:
+        serialized_message = _decompress(serialized_message)
+    if serialized_message[:1] == b"\x02":
+        message, end = _deserialize_v2_body(serialized_message, 0,
+                                            len(serialized_message))
+        if end != len(serialized_message):
+            raise ProtocolViolationError("The message has trailing bytes.")
+        return message
+    return reassemble_message(deserialize_json_object(serialized_message))
+
+
+def _deserialize_v2_body(serialized_message: bytes,
+                         offset: int,
+                         limit: int) -> Tuple[Message, int]:
+    """
+    Deserializes a message of version 2 of the protocol that starts at an
+    offset.
+    
+    The elements of the batch of a NEW_MESSAGES or CHAT_MESSAGE_BATCH message
+    have to be CHAT_MESSAGE messages, so the batch is decoded without
+    recursing into its elements.
+    :raises ProtocolViolationError: if the message violates the protocol
+    :param serialized_message: the bytes the message is part of
+    :param offset: where the message starts
+    :param limit: where the message has to end at the latest
+    :return: the deserialized message and where it ends
+    """
+    try:
+        msg_type, wait_timeout, content_start, content_end, sender, \
+            receiver, end = _deserialize_v2_fields(serialized_message,
+                                                   offset,
+                                                   limit)
+        content = ""
+        batch = None
+        if msg_type in _CHAT_MESSAGES_TYPES:
+            batch = []
+            offset = content_start
+            while offset < content_end:
+                element_type, element_wait_timeout, element_start, \
+                    element_end, element_sender, element_receiver, offset = \
+                    _deserialize_v2_fields(serialized_message,
+                                           offset,
+                                           content_end)
+                if element_type != Message.CHAT_MESSAGE:
+                    raise ProtocolViolationError(
+                        "A batch may only hold chat messages.")
+                batch.append(Message(
+                    element_type,
+                    serialized_message[element_start:element_end]
+                    .decode("UTF-8"),
+                    element_sender,
+                    element_receiver,
+                    element_wait_timeout,
+                    version=VERSION_2))
+        else:
+            content = serialized_message[content_start:content_end] \
+                .decode("UTF-8")
+        message = Message(msg_type,
+                          content,
+                          sender,
+                          receiver,
+                          wait_timeout,
+                          batch,
+                          VERSION_2)
+        return message, end
+    except (struct.error, UnicodeDecodeError, InvalidMessageFormatError):
+        raise ProtocolViolationError("The message is not valid.")
+
+
+def _deserialize_v2_fields(serialized_message: bytes,
+                           offset: int,
+                           limit: int
+                           ) -> Tuple[int, int, int, int, str, str, int]:
+    """
+    Deserializes the fields of a message of version 2 of the protocol that
+    starts at an offset, except its content.
+    
+    :raises ProtocolViolationError: if the message violates the protocol
+    :raises struct.error: if the fixed fields are cut off
+    :raises UnicodeDecodeError: if the sender or receiver is not UTF-8
+    :param serialized_message: the bytes the message is part of
+    :param offset: where the message starts
+    :param limit: where the message has to end at the latest
+    :return: the msg_type and wait_timeout of the message, where its content
+             starts and ends, its sender and receiver, and where it ends
+    """
+    version, msg_type, flags, content_len, sender_len, receiver_len = \
+        _V2_HEADER.unpack_from(serialized_message, offset)
+    offset += _V2_HEADER.size
+    wait_timeout = 0
+    if flags & _V2_FLAG_WAIT_TIMEOUT:
+        wait_timeout, = _V2_WAIT_TIMEOUT.unpack_from(serialized_message,
+                                                     offset)
+        offset += _V2_WAIT_TIMEOUT.size
+    content_end = offset + content_len
+    sender_end = content_end + sender_len
+    receiver_end = sender_end + receiver_len
+    if version != VERSION_2 or receiver_end > limit:
+        raise ProtocolViolationError("The message is not valid.")
+    return (msg_type,
+            wait_timeout,
+            offset,
+            content_end,
+            serialized_message[content_end:sender_end].decode("UTF-8"),
+            serialized_message[sender_end:receiver_end].decode("UTF-8"),
+            receiver_end)
+
+
+def unpack_new_messages(message: Message) -> List[Message]:
+    """
+    Returns the chat messages of a NEW_MESSAGES or CHAT_MESSAGE_BATCH message
+    of any version.
+    
+    :raises ProtocolViolationError: if the messages violate the protocol
+    :param message: message of msg_type NEW_MESSAGES or CHAT_MESSAGE_BATCH
+    :return: the chat messages
+    """
+    if message.batch is not None:
+        return message.batch
+    try:
+        serialized_messages = json.loads(message.content)
+        return _reassemble_chat_messages(
+            [deserialize_json_object(each) for each in serialized_messages])
+    except (ValueError, TypeError, RecursionError):
+        raise ProtocolViolationError("The messages are not valid.")
+
+
+def serialize_message_content(message, batch_format: bool = False) -> str:
     """
     Takes a message and serializes it according to the protocol specification.
     :param message: message to be serialized
+    :param batch_format: True if the chat messages of a NEW_MESSAGES or
+                         CHAT_MESSAGE_BATCH message should be serialized in a
+                         batch
     :return: serialized message
     """
+    message_content = _message_content(message)
+    if message.msg_type in _CHAT_MESSAGES_TYPES and batch_format:
+        message_content["content"] = ""
+        message_content["batch"] = [_message_content(each)
+                                    for each in unpack_new_messages(message)]
+    elif message.batch is not None:
+        message_content["content"] = json.dumps(
+            [serialize_message_content(each) for each in message.batch])
+    
+    msg_content_serialized = json.dumps(message_content)
+    return msg_content_serialized
+
+
+def _message_content(message: Message) -> Dict[str, Any]:
+    """
+    Puts the fields of a message in a dictionary that is serialized as the
+    JSON object of the message.
+    
+    :param message: the message
+    :return: the dictionary
+    """
     # message content
     message_content = dict()
     message_content["msg_type"] = message.msg_type
     message_content["content"] = message.content
     message_content["sender"] = message.sender
     message_content["receiver"] = message.receiver
+    if message.wait_timeout:
+        message_content["wait_timeout"] = message.wait_timeout
+    return message_content
+
+
+def encode_new_messages_element(message: Message,
+                                version: int = VERSION_1,
+                                batch_format: bool = False) -> bytes:
+    """
+    Encodes a chat message the way it appears in a serialized NEW_MESSAGES
+    message, as an element of the list in its content or of its batch.
     
-    msg_content_serialized = json.dumps(message_content)
-    return msg_content_serialized
+    The elements can be encoded once and then joined into any amount of
+    NEW_MESSAGES messages by serialize_new_messages.
+    :param message: the chat message that should be encoded
+    :param version: the version of the protocol to encode the message in
+    :param batch_format: True if the message should be encoded as an element
+                         of a batch
+    :return: the encoded chat message
+    """
+    if version == VERSION_2:
+        return _serialize_v2_body(message)
+    if batch_format:
+        return serialize_message_content(message).encode("UTF-8")
+    # the list in the content is JSON, and the content is a string in the JSON
+    # object of the message, so the element is escaped twice
+    return json.dumps(json.dumps(serialize_message_content(message)))[1:-1] \
+        .encode("UTF-8")
+
+
+# the serialized content of a NEW_MESSAGES message before and after the
+# elements of its list, which are marked by an escaped NUL character
+_NEW_MESSAGES_PREFIX, _NEW_MESSAGES_SUFFIX = serialize_message_content(
+    Message(Message.NEW_MESSAGES, "[\0]")).encode("UTF-8").split(b"\\u0000")
+# the same for a NEW_MESSAGES message in the batch format
+_NEW_MESSAGES_BATCH_PREFIX, _NEW_MESSAGES_BATCH_SUFFIX = \
+    serialize_message_content(Message(Message.NEW_MESSAGES, batch=[]),
+                              batch_format=True).encode("UTF-8").rsplit(b"[]")
+
+
+def serialize_new_messages(elements: Iterable[bytes],
+                           version: int = VERSION_1,
+                           header_size: int = HEADER_SIZE,
+                           batch_format: bool = False,
+                           compression: bool = False
+                           ) -> SerializedMessage:
+    """
+    Serializes a NEW_MESSAGES message by joining chat messages encoded by
+    encode_new_messages_element, without encoding anything again.
+    
+    The serialized message is the same as the one serialize_message returns
+    for the chat messages.
+    :raises ProtocolViolationError: if the message is too long
+    :param elements: the encoded chat messages
+    :param version: the version of the protocol the chat messages are
+                    encoded in
+    :param header_size: the size of the fixed length header
+    :param batch_format: True if the chat messages are encoded as elements
+                         of a batch
+    :param compression: True if the message may be compressed
+    :return: the serialized message
+    """
+    if version == VERSION_2:
+        content = b"".join(elements)
+        msg_content_serialized = _V2_HEADER.pack(
+            VERSION_2, Message.NEW_MESSAGES, 0, len(content), 0, 0) + content
+    elif batch_format:
+        msg_content_serialized = b"".join((_NEW_MESSAGES_BATCH_PREFIX,
+                                           b"[",
+                                           b", ".join(elements),
+                                           b"]",
+                                           _NEW_MESSAGES_BATCH_SUFFIX))
+    else:
+        msg_content_serialized = b"".join((_NEW_MESSAGES_PREFIX,
+                                           b", ".join(elements),
+                                           _NEW_MESSAGES_SUFFIX))
+    compressed = False
+    if compression:
+        msg_content_serialized = _compress(msg_content_serialized)
+        compressed = msg_content_serialized[:1] == _COMPRESSED_MARKER
+    return SerializedMessage(_frame(msg_content_serialized, header_size),
+                             version,
+                             header_size,
+                             batch_format,
+                             compressed)
+
+
+def new_messages_length(element_lengths: Iterable[int]) -> int:
+    """
+    Calculates the length of a NEW_MESSAGES message, without its header, that
+    serialize_new_messages serializes from elements of the lengths given.
+    
+    The length is at least the length of the message in any version and
+    format.
+    :param element_lengths: the lengths of the encoded chat messages
+    :return: the length of the message
+    """
+    length = max(len(_NEW_MESSAGES_PREFIX) + len(_NEW_MESSAGES_SUFFIX),
+                 len(_NEW_MESSAGES_BATCH_PREFIX) +
+                 len(_NEW_MESSAGES_BATCH_SUFFIX) + 2)
+    for i, element_length in enumerate(element_lengths):
+        # the elements are separated by ", "
+        length += element_length + (2 if i else 0)
+    return length
+
+
+def deserialize_header(serialized_fixed_header: bytes) -> int:
+    """
+    Deserialize a fixed length header of any size in big endian byteorder.
+    
+    :param serialized_fixed_header: the bytes that should be deserialized
+    :return: the integer value of the header
+    """
+    return int.from_bytes(serialized_fixed_header, "big")
 
 
 def deserialize_two_byte_header(serialized_fixed_header: bytes) -> int:
@@ -154,6 +788,206 @@ def deserialize_two_byte_header(serialized_fixed_header: bytes) -> int:
     return length
 
 
+def add_request_id(serialized_message: bytes,
+                   header_size: int,
+                   request_id: int) -> bytes:
+    """
+    Puts a request id between the fixed length header and the message, as
+    the messages of a pipelined session have it.
+    
+    :param serialized_message: the serialized message with its header
+    :param header_size: the size of the fixed length header
+    :param request_id: the request id
+    :return: the serialized message with its request id
+    """
+    return b"".join((serialized_message[:header_size],
+                     request_id.to_bytes(REQUEST_ID_SIZE, "big"),
+                     memoryview(serialized_message)[header_size:]))
+
+
+class FrameDecoder:
+    """
+    Class that splits the bytes received on a connection into the messages
+    they frame, however the bytes arrive.
+    
+    The bytes are received straight into a buffer that is reused for every
+    message, and that only grows when a message does not fit in it, so a
+    long message is not copied every time more of it arrives. The bytes of
+    the next messages that are received together with a message stay in the
+    buffer, which is why a connection that carries many messages should be
+    read by a single FrameDecoder. In a pipelined session the request id of
+    the message last taken is kept in request_id.
+    
+    Attributes
+        BUFFER_SIZE -- initial size of the buffer in bytes\n
+        RECEIVE_SIZE -- least amount of bytes asked for from a socket at a
+        time\n
+    """
+    BUFFER_SIZE = 2**16
+    RECEIVE_SIZE = 2**12
+    
+    def __init__(self,
+                 header_size: int = HEADER_SIZE,
+                 max_length: Optional[int] = None,
+                 request_ids: bool = False):
+        """
+        Initializes a FrameDecoder object.
+        
+        :param header_size: the size of the fixed length header, which may be
+                            changed between messages
+        :param max_length: the maximum length of a message, without its
+                           header, or None if only the header limits it
+        :param request_ids: True if a request id follows the header of every
+                            message, which may be changed between messages
+        """
+        self.header_size = header_size
+        self.max_length = max_length
+        self.request_ids = request_ids
+        self.request_id = 0
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        # the received bytes that are not decoded yet are _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+    
+    def feed(self, data: bytes) -> None:
+        """
+        Adds bytes received on the connection.
+        
+        :param data: the received bytes
+        :return: None
+        """
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+    
+    def receive_into(self, s: socket.socket) -> int:
+        """
+        Receives bytes from a socket straight into the buffer.
+        
+        Asks for at least the rest of the message being received.
+        :raises OSError: if the socket could not be read
+        :param s: the socket that the bytes are received from
+        :return: the amount of bytes received, 0 if the connection is closed
+        """
+        self._reserve(max(self.RECEIVE_SIZE,
+                          self._missing_length()))
+        with memoryview(self._buffer) as view:
+            received = s.recv_into(view[self._end:])
+        self._end += received
+        return received
+    
+    def next_frame(self) -> Optional[bytes]:
+        """
+        Takes the next message out of the received bytes.
+        
+        :raises ProtocolViolationError: if the message is longer than the
+                maximum length
+        :return: the message without its header, None if it has not been
+                 received completely yet
+        """
+        msg_len = self._message_length()
+        if msg_len is None:
+            return None
+        body_start = self._start + self._prefix_size()
+        frame_end = body_start + msg_len
+        if frame_end > self._end:
+            return None
+        if self.request_ids:
+            self.request_id = deserialize_header(
+                self._buffer[body_start - REQUEST_ID_SIZE:body_start])
+        body = bytes(self._buffer[body_start:frame_end])
+        self._start = frame_end
+        if self._start == self._end:
+            self._start = self._end = 0
+        return body
+    
+    def has_frame(self) -> bool:
+        """Returns True if a whole message has been received and not taken."""
+        msg_len = self._message_length()
+        return msg_len is not None and \
+            self._start + self._prefix_size() + msg_len <= self._end
+    
+    def receive_frame(self, s: socket.socket) -> Optional[bytes]:
+        """
+        Receives from a socket until the next message has been received
+        completely, and takes it out of the received bytes.
+        
+        :raises ProtocolViolationError: if the connection is closed in the
+                middle of a message, or the message is too long
+        :raises OSError: if the socket could not be read
+        :param s: the socket that the message is received from
+        :return: the message without its header, None if the connection was
+                 closed before anything of a message was received
+        """
+        body = self.next_frame()
+        while body is None:
+            if self.receive_into(s) == 0:
+                if self._end > self._start:
+                    raise ProtocolViolationError(
+                        "Message received not correct length.")
+                return None
+            body = self.next_frame()
+        return body
+    
+    def receive_message(self, s: socket.socket) -> Optional[Message]:
+        """
+        Receives the next message from a socket and deserializes it.
+        
+        :raises ProtocolViolationError: if the connection is closed in the
+                middle of a message, or the message does not follow protocol
+        :raises OSError: if the socket could not be read
+        :param s: the socket that the message is received from
+        :return: the message, None if the connection was closed before
+                 anything of a message was received
+        """
+        body = self.receive_frame(s)
+        if body is None:
+            return None
+        return deserialize_message(body)
+    
+    def _message_length(self) -> Optional[int]:
+        """
+        Returns the length of the message being received, None if its header
+        has not been received completely yet.
+        """
+        if self._end - self._start < self._prefix_size():
+            return None
+        msg_len = deserialize_header(
+            self._buffer[self._start:self._start + self.header_size])
+        if self.max_length is not None and msg_len > self.max_length:
+            raise ProtocolViolationError("Message is too long.")
+        return msg_len
+    
+    def _missing_length(self) -> int:
+        """Returns the amount of bytes of the message still to be received."""
+        msg_len = self._message_length()
+        if msg_len is None:
+            return self._prefix_size() - (self._end - self._start)
+        return self._start + self._prefix_size() + msg_len - self._end
+    
+    def _prefix_size(self) -> int:
+        """Returns the size of what comes before a message in a frame."""
+        if self.request_ids:
+            return self.header_size + REQUEST_ID_SIZE
+        return self.header_size
+    
+    def _reserve(self, amount: int) -> None:
+        """
+        Makes room for at least the amount of bytes after the received bytes,
+        by moving them to the start of the buffer or growing it.
+        """
+        if len(self._buffer) - self._end >= amount:
+            return
+        pending = self._end - self._start
+        if self._start > 0:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        if len(self._buffer) - self._end < amount:
+            self._buffer.extend(bytes(max(pending + amount,
+                                          2 * len(self._buffer)) -
+                                      len(self._buffer)))
+
+
 def deserialize_json_object(json_object: bytes) -> Dict[str, str]:
     """
     Deserializes a JSON object.
@@ -167,7 +1001,8 @@ def deserialize_json_object(json_object: bytes) -> Dict[str, str]:
     try:
         message_dictionary = json.loads(json_object)
         return message_dictionary
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, RecursionError):
+        # a JSON object nested too deep for the decoder is not valid either
         raise ProtocolViolationError("The JSON-object is not valid.")
 
 
@@ -188,23 +1023,62 @@ def reassemble_message(message_content: Dict[str, str]) -> Message:
         content = message_content["content"]
         sender = message_content["sender"]
         receiver = message_content["receiver"]
+        wait_timeout = message_content.get("wait_timeout", 0)
+        # a bool is an int as well, and a float or an infinite number is not
+        # accepted either
+        if type(wait_timeout) is not int or \
+                not 0 <= wait_timeout <= MAX_WAIT_TIMEOUT:
+            raise ProtocolViolationError(error_msg_format)
+        batch = message_content.get("batch")
+        if batch is not None:
+            # the chat messages were decoded together with the message
+            batch = _reassemble_chat_messages(batch)
         reassembled_msg = Message(
                 msg_type=int(msg_type),  # msg_type should be an integer
                 content=str(content),
                 sender=str(sender),
-                receiver=str(receiver))
+                receiver=str(receiver),
+                wait_timeout=wait_timeout,
+                batch=batch)
         return reassembled_msg
-    except (KeyError, TypeError) as exception:
+    except (KeyError, TypeError, ValueError) as exception:
         raise ProtocolViolationError(error_msg_format)
 
 
+def _reassemble_chat_messages(message_contents: List[Dict[str, str]]
+                              ) -> List[Message]:
+    """
+    Reassembles the chat messages of a NEW_MESSAGES or CHAT_MESSAGE_BATCH
+    message from python dictionaries.
+    
+    A chat message cannot have a batch of its own, so this does not recurse
+    any deeper.
+    :raises ProtocolViolationError: if an element is not a chat message
+    :param message_contents: the dictionaries of the chat messages
+    :return: the reassembled chat messages
+    """
+    chat_messages = []
+    for each in message_contents:
+        if not isinstance(each, dict) or "batch" in each:
+            raise ProtocolViolationError("A batch may only hold chat messages.")
+        chat_message = reassemble_message(each)
+        if chat_message.msg_type != Message.CHAT_MESSAGE:
+            raise ProtocolViolationError("A batch may only hold chat messages.")
+        chat_messages.append(chat_message)
+    return chat_messages
+
+
 def valid_sender_format(message: Message) -> bool:
     """
     Checks if the sender of the message is in a valid REQUEST_NEW_MESSAGES format.
+    
+    A user name may not contain the ':' that separates the users in a chat
+    identifier.
     :param message: message with the sender that should be validated
     :return: True if sender is valid, otherwise False
     """
-    if type(message.sender) is not str or len(message.sender) == 0:
+    if type(message.sender) is not str or len(message.sender) == 0 or \
+            USER_NAME_SEPARATOR in message.sender:
         return False
     return True
 
@@ -212,10 +1086,14 @@ def valid_sender_format(message: Message) -> bool:
 def valid_receiver_format(message: Message) -> bool:
     """
     Checks if the receiver of the message is in a valid REQUEST_NEW_MESSAGES format.
+    
+    A user name may not contain the ':' that separates the users in a chat
+    identifier.
     :param message: message with the receiver that should be validated
     :return: True if receiver is valid, otherwise False
     """
-    if type(message.receiver) is not str or len(message.receiver) == 0:
+    if type(message.receiver) is not str or len(message.receiver) == 0 or \
+            USER_NAME_SEPARATOR in message.receiver:
         return False
     return True
 
@@ -247,3 +1125,61 @@ def validate_request_message_format(message: Message) -> None:
             "Message does not conform to REQUEST_NEW_MESSAGES format," +
             " message:" + str(message))
 
+
+def validate_chat_message_format(message: Message) -> None:
+    """
+    Validates the format of a chat message.
+    
+    :raises MessageCorruptError: if the message has an incorrect format
+    :param message: message that should be validated
+    :return:
+    """
+    if not message.msg_type == Message.CHAT_MESSAGE or \
+            not valid_content_format(message) or \
+            not valid_sender_format(message) or \
+            not valid_receiver_format(message):
+        raise MessageCorruptError(
+            "Message does not conform to CHAT_MESSAGE format," +
+            " message:" + str(message))
+
+
+def validate_chat_message_batch_format(message: Message) -> None:
+    """
+    Validates the format of a message carrying many chat messages.
+    
+    :raises MessageCorruptError: if the message has an incorrect format
+    :param message: message that should be validated
+    :return:
+    """
+    try:
+        chat_messages = unpack_new_messages(message)
+    except ProtocolViolationError:
+        chat_messages = []
+    if not message.msg_type == Message.CHAT_MESSAGE_BATCH or \
+            not chat_messages or \
+            not all(each.msg_type == Message.CHAT_MESSAGE and
+                    valid_content_format(each) and
+                    valid_sender_format(each) and
+                    valid_receiver_format(each)
+                    for each in chat_messages):
+        raise MessageCorruptError(
+            "Message does not conform to CHAT_MESSAGE_BATCH format," +
+            " message:" + str(message))
+
+
+def validate_subscribe_message_format(message: Message) -> None:
+    """
+    Validates the format of a message subscribing to new messages.
+    
+    :param message: message that should be validated
+    :return:
+    """
+    if not message.msg_type == Message.SUBSCRIBE or \
+            not message.content.isdigit() or \
+            not valid_content_format(message) or \
+            not valid_sender_format(message) or \
+            not valid_receiver_format(message):
+        raise MessageCorruptError(
+            "Message does not conform to SUBSCRIBE format," +
+            " message:" + str(message))
+
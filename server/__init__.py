@@ -1,6 +1,15 @@
 # server.py
+import asyncio
+import collections
+import contextlib
+import os
+import queue
 import socket
 import threading
+import time
+import typing
+import urllib.request
+import uuid
 import database
 import sqlite3
 import protocol
@@ -10,11 +19,72 @@ import json
 class ServerDBHandler(database.Handler):
     """
     Class that handles the servers database.
+    
+    The database is either kept in RAM, where every access goes through one
+    connection, or stored on disk in WAL mode. On disk there is one connection
+    that writes and a pool of read only connections, so that reads run
+    concurrently with each other and with the writes.
+    
+    The database has an id that is made up when it is created, so that the
+    clients can tell when the server has lost the history of its chats, like
+    a database in RAM does on every restart.
+    
+    Attributes
+        READ_CHUNK_SIZE -- the amount of messages read from the database at a
+        time when a page of new messages is read\n
     """
-    def __init__(self):
+    READ_CHUNK_SIZE = 256
+    
+    def __init__(self,
+                 database_path: str = ":memory:",
+                 reader_amount: int = 4,
+                 hot_tail_size: int = 64,
+                 hot_tail_budget: int = 2**24):
+        """
+        Initializes the handler.
+        
+        :param database_path: path to the database file, or ":memory:" to keep
+                              the database in RAM
+        :param reader_amount: the amount of read only connections of a database
+                              on disk
+        :param hot_tail_size: the amount of recent messages of every chat that
+                              are kept in the hot tail cache, 0 turns it off
+        :param hot_tail_budget: the bytes the hot tail cache may use at most
+        """
         super().__init__()
         self.database_lock = threading.Lock()
-        self.connection = self._setup_ram_sqlite_db()
+        self.chat_message_observers = []
+        self.hot_tail_cache = HotTailCache(hot_tail_size, hot_tail_budget)
+        self.readers = queue.Queue()
+        self.reader_amount = 0
+        if database_path == ":memory:":
+            self.connection = self._setup_ram_sqlite_db()
+        else:
+            self.connection = self._setup_disk_sqlite_db(database_path)
+            for _ in range(reader_amount):
+                self.readers.put(self._open_reader(database_path))
+            self.reader_amount = reader_amount
+        self.database_id = self._database_id(self.connection)
+    
+    def _database_id(self, connection: sqlite3.Connection) -> str:
+        """
+        Returns the id of the database, and makes one up if it has none yet.
+        
+        :param connection: the connection that writes to the database
+        :return: the id of the database
+        """
+        with self.database_lock:
+            connection.execute("""CREATE TABLE IF NOT EXISTS database_id
+                               (database_id VARCHAR NOT NULL)""")
+            row = connection.execute(
+                "SELECT database_id FROM database_id").fetchone()
+            if row is not None:
+                return row[0]
+            database_id = uuid.uuid4().hex
+            connection.execute("INSERT INTO database_id VALUES (?)",
+                               (database_id,))
+            connection.commit()
+            return database_id
     
     def _setup_ram_sqlite_db(self) -> sqlite3.Connection:
         """
@@ -23,20 +93,136 @@ class ServerDBHandler(database.Handler):
         
         :return: the connection to the created database
         """
-        connection = sqlite3.connect(":memory:")
-        cursor = connection.cursor()
+        # the lock serializes all access, so the connection may be shared by
+        # the threads of the server
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
         with self.database_lock:
-            self._setup_chat_message_amount_table(cursor)
-            self._setup_chat_messages_table(cursor)
-            connection.commit()
+            self._setup_tables(connection)
         return connection
     
-    def get_new_messages(self, message: protocol.Message) -> protocol.Message:
+    def _setup_disk_sqlite_db(self, database_path: str) -> sqlite3.Connection:
+        """
+        Opens, or creates, an sqlite3 database on disk in WAL mode with the
+        specifications of the database in the database_handler module.
+        
+        :param database_path: path to the database file
+        :return: the connection that writes to the database
+        """
+        connection = sqlite3.connect(database_path, check_same_thread=False)
+        with self.database_lock:
+            connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode a commit is only synced at checkpoints, the database
+            # stays consistent but the latest commits may be lost on power loss
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._setup_tables(connection)
+        return connection
+    
+    def _open_reader(self, database_path: str) -> sqlite3.Connection:
+        """
+        Opens a read only connection to a database on disk.
+        
+        :param database_path: path to the database file
+        :return: the read only connection
+        """
+        uri = "file:{}?mode=ro".format(urllib.request.pathname2url(
+            os.path.abspath(database_path)))
+        # a reader is used by one thread at a time, but not always the same one
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    
+    @contextlib.contextmanager
+    def reader(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        Lends out a connection to read from the database with.
+        
+        Waits for a read only connection to be returned to the pool if all of
+        them are in use. A database in RAM lends out its only connection.
+        :return: the connection to read with
+        """
+        if self.reader_amount == 0:
+            yield self.connection
+            return
+        connection = self.readers.get()
+        try:
+            yield connection
+        finally:
+            self.readers.put(connection)
+    
+    def _connection_lock(self, connection: sqlite3.Connection
+                         ) -> typing.ContextManager:
+        """
+        Returns the lock that has to be held while reading with a connection.
+        
+        A read only connection is only used by the thread that borrowed it, so
+        it needs no lock.
+        :param connection: the connection to the database.
+        :return: the lock of the connection
+        """
+        if connection is self.connection:
+            return self.database_lock
+        return contextlib.nullcontext()
+    
+    def add_chat_message_observer(self,
+                                  observer: "ChatMessageObserver") -> None:
+        """
+        Adds an observer that is told about every chat message that is added
+        to the database.
+        
+        :param observer: the observer that should be added
+        :return: None
+        """
+        self.chat_message_observers.append(observer)
+    
+    def add_chat_messages_to_database(
+            self,
+            connection: sqlite3.Connection,
+            messages: typing.Iterable[protocol.Message],
+            encoded_messages: typing.Sequence[
+                typing.Optional[typing.Tuple[bytes, ...]]] = None
+    ) -> typing.List[typing.Tuple[str, int, protocol.Message]]:
+        """
+        Stores chat messages in the database in a single transaction, adds
+        them to the hot tail cache and then tells the observers.
+        
+        :param connection: the connection to the database.
+        :param messages: the messages that should be saved
+        :param encoded_messages: the messages encoded by encode_chat_message,
+                                 in the same order, if they were encoded
+                                 already, None for a message that was not
+        :return: the messages that were stored, in the format
+                 (chat_identifier, message_number, message)
+        """
+        messages = list(messages)
+        # the stored messages are the objects given, and messages is kept
+        # alive until the end, so their ids tell them apart
+        encodings = dict()
+        if encoded_messages is not None:
+            encodings = {id(message): encoded_message
+                         for message, encoded_message
+                         in zip(messages, encoded_messages)}
+        stored_messages = super().add_chat_messages_to_database(connection,
+                                                                messages)
+        chat_identifiers = []
+        for chat_identifier, message_number, message in stored_messages:
+            self.hot_tail_cache.add(chat_identifier, message_number, message,
+                                    encodings.get(id(message)))
+            if chat_identifier not in chat_identifiers:
+                chat_identifiers.append(chat_identifier)
+        for chat_identifier in chat_identifiers:
+            for observer in self.chat_message_observers:
+                observer.chat_message_added(chat_identifier)
+        return stored_messages
+    
+    def get_new_messages(self,
+                         message: protocol.Message,
+                         connection_format: "ConnectionFormat" = None
+                         ) -> protocol.Message:
         """
         Returns any messages in the database newer than the message specified.
         :raises database.NotPresentInDatabase: when no newer messages exist.
         :param message: message with type REQUEST_NEW_MESSAGES and its content
                         contains the number of the last message it has
+        :param connection_format: the format of the connection the messages
+                                  are sent on, the default format if None
         :return: a message containing serialized messages in its content
         """
         protocol.validate_request_message_format(message)
@@ -44,33 +230,606 @@ class ServerDBHandler(database.Handler):
         chat_identifier = database.create_chat_identifier(
             message.sender,
             message.receiver)
-        messages_available_in_db = self.total_message_amount(
-            self.connection,
-            chat_identifier)
-        
-        message_list = []
+        return_message, _ = self.new_messages_since(chat_identifier,
+                                                    clients_last_message,
+                                                    message.version,
+                                                    connection_format)
+        return return_message
+    
+    def new_messages_since(self,
+                           chat_identifier: str,
+                           clients_last_message: int,
+                           version: int = protocol.VERSION_1,
+                           connection_format: "ConnectionFormat" = None
+                           ) -> typing.Tuple[protocol.Message, int]:
+        """
+        Returns any messages in the chat newer than the message number given.
         
-        if clients_last_message >= messages_available_in_db:
+        Returns as many messages as fit in the page size of the connection, but
+        at least one.
+        :raises database.NotPresentInDatabase: when no newer messages exist.
+        :param chat_identifier: the chats identifier
+        :param clients_last_message: number of the last message the client has
+        :param version: the version of the protocol the message should be
+                        serialized in
+        :param connection_format: the format of the connection the message is
+                                  sent on, the default format if None
+        :return: a message containing serialized messages in its content and
+                 the number of the newest message in it
+        """
+        if connection_format is None:
+            connection_format = ConnectionFormat()
+        index = encoding_index(version, connection_format.batch_format)
+        new_msgs = self.hot_tail_cache.messages_since(chat_identifier,
+                                                      clients_last_message)
+        if new_msgs is None:
+            new_msgs = self._stored_messages_since(
+                chat_identifier,
+                clients_last_message,
+                index,
+                connection_format.page_size)
+        if not new_msgs:
             raise database.NotPresentInDatabase(
                 "There are no new messages in the database.")
         
-        # send maximum of 50 messages per request message
-        if clients_last_message + 50 + 1 < messages_available_in_db:
-            messages_available_in_db = clients_last_message + 50 + 1
-        
-        for i in range(clients_last_message + 1, messages_available_in_db + 1):
-            message_identifier = database.create_message_identifier(
-                chat_identifier, i)
-            msg_row = self._get_chat_message(self.connection, message_identifier)
-            msg = database.table_row_to_msg(msg_row)
-            msg_serialized = protocol.serialize_message_content(msg)
-            message_list.append(msg_serialized)
-        
-        ser_msg_list = json.dumps(message_list)
-        return_message = protocol.Message(
-            protocol.Message.NEW_MESSAGES,
-            ser_msg_list)
-        return return_message
+        new_msgs = _page(new_msgs, index, connection_format.page_size)
+        return_message = protocol.serialize_new_messages(
+            (encoded_msgs[index] for _, encoded_msgs in new_msgs),
+            version,
+            connection_format.header_size,
+            connection_format.batch_format,
+            connection_format.compression)
+        return return_message, new_msgs[-1][0]
+    
+    def _stored_messages_since(self,
+                               chat_identifier: str,
+                               clients_last_message: int,
+                               index: int,
+                               page_size: int
+                               ) -> typing.List[typing.Tuple[
+                                   int, typing.Tuple[bytes, ...]]]:
+        """
+        Reads the messages in the chat newer than the message number given
+        from the database, until there are enough of them to fill a page.
+        
+        If every newer message was read the hot tail cache is filled with them.
+        :param chat_identifier: the chats identifier
+        :param clients_last_message: number of the last message the client has
+        :param index: the index in ENCODINGS of the encoding the page is
+                      serialized in
+        :param page_size: the maximum length of the page in bytes
+        :return: the messages with their numbers, ordered by number, encoded by
+                 encode_chat_message
+        """
+        new_msgs = []
+        length = protocol.new_messages_length([])
+        with self.reader() as connection:
+            messages_available_in_db = self.total_message_amount(
+                connection,
+                chat_identifier)
+            first_message = clients_last_message + 1
+            # a page holds at least one message, however small it is
+            while first_message <= messages_available_in_db and \
+                    (length <= page_size or not new_msgs):
+                msg_rows = self.get_chat_messages(
+                    connection,
+                    chat_identifier,
+                    first_message,
+                    min(messages_available_in_db,
+                        first_message + self.READ_CHUNK_SIZE - 1))
+                if not msg_rows:
+                    break
+                for msg_row in msg_rows:
+                    encoded_msgs = encode_chat_message(
+                        database.table_row_to_msg(msg_row))
+                    new_msgs.append((msg_row[0], encoded_msgs))
+                    length += len(encoded_msgs[index]) + 2
+                first_message = msg_rows[-1][0] + 1
+        if first_message > messages_available_in_db:
+            self.hot_tail_cache.fill(chat_identifier,
+                                     messages_available_in_db,
+                                     new_msgs)
+        return new_msgs
+
+
+def _page(new_msgs: typing.List[typing.Tuple[int, typing.Tuple[bytes, ...]]],
+          index: int,
+          page_size: int
+          ) -> typing.List[typing.Tuple[int, typing.Tuple[bytes, ...]]]:
+    """
+    Returns the first of the messages that fit in a page, at least one.
+    
+    :param new_msgs: the messages with their numbers, encoded by
+                     encode_chat_message
+    :param index: the index in ENCODINGS of the encoding the page is
+                  serialized in
+    :param page_size: the maximum length of the page in bytes
+    :return: the messages of the page
+    """
+    length = protocol.new_messages_length([])
+    for i, (_, encoded_msgs) in enumerate(new_msgs):
+        # the elements are separated by ", " in version 1
+        length += len(encoded_msgs[index]) + (2 if i else 0)
+        if length > page_size and i > 0:
+            return new_msgs[:i]
+    return new_msgs
+
+
+class ConnectionFormat(typing.NamedTuple):
+    """
+    The format of the messages sent on a connection, which a session may
+    negotiate.
+    
+    Attributes
+        header_size -- the size of the fixed length header of the messages\n
+        page_size -- the maximum length in bytes of a NEW_MESSAGES message\n
+        batch_format -- True if NEW_MESSAGES messages are sent in the batch
+                        format\n
+        compression -- True if long messages are sent compressed\n
+        pipelining -- True if the messages have request ids and are answered
+                      in any order\n
+        not_modified -- True if a request for new messages is answered with a
+                        NOT_MODIFIED message when there are none\n
+    """
+    header_size: int = protocol.HEADER_SIZE
+    page_size: int = protocol.max_message_length(protocol.HEADER_SIZE)
+    batch_format: bool = False
+    compression: bool = False
+    pipelining: bool = False
+    not_modified: bool = False
+
+
+class HotTailCache:
+    """
+    Class that keeps the most recent messages of the active chats in memory.
+    
+    Most requests for new messages ask for the last few messages of a chat,
+    those are answered from the cache without reading the database. The
+    messages are cached encoded by encode_chat_message, so a response is
+    serialized by joining them. Every chat keeps a ring of at most ring_size
+    messages, and the chats used least recently are evicted when the
+    estimated size of the cache exceeds memory_budget bytes. A chat is only
+    cached together with the number of its newest message, so the cache knows
+    when a chat has nothing new.
+    
+    The hits and misses attributes count the requests answered from the cache
+    and the ones that had to read the database.
+    """
+    # estimated bytes used by a cached message besides its encoding, and by a
+    # cached chat besides its messages, so that chats without messages count
+    # toward the budget too
+    MESSAGE_OVERHEAD = 100
+    CHAT_OVERHEAD = 1000
+    
+    def __init__(self, ring_size: int = 64, memory_budget: int = 2**24):
+        self.ring_size = ring_size
+        self.memory_budget = memory_budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # chat identifier -> [newest message number, deque of
+        # (message_number, encoded messages), estimated size]
+        self._chats = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def messages_since(self,
+                       chat_identifier: str,
+                       last_message: int
+                       ) -> typing.Optional[typing.List[
+                           typing.Tuple[int, typing.Tuple[bytes, ...]]]]:
+        """
+        Looks up the messages of a chat newer than the message number given.
+        
+        :param chat_identifier: the chats identifier
+        :param last_message: number of the last message the client has
+        :return: the newer encoded messages with their numbers, ordered by
+                 number, or None if the cache does not hold all of them
+        """
+        with self._lock:
+            chat = self._chats.get(chat_identifier)
+            if chat is None or last_message + 1 < chat[0] - len(chat[1]) + 1:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._chats.move_to_end(chat_identifier)
+            ring = chat[1]
+            new_amount = max(chat[0] - last_message, 0)
+            return [ring[i] for i in range(len(ring) - new_amount, len(ring))]
+    
+    def add(self,
+            chat_identifier: str,
+            message_number: int,
+            message: protocol.Message,
+            encoded_message: typing.Tuple[bytes, ...] = None) -> None:
+        """
+        Adds a message that has just been stored in the database, encoded
+        once for all of the responses it will be part of.
+        
+        :param chat_identifier: the chats identifier
+        :param message_number: the number of the message
+        :param message: the message
+        :param encoded_message: the message encoded by encode_chat_message,
+                                if None it is encoded here
+        :return: None
+        """
+        if self.ring_size == 0:
+            return
+        if encoded_message is None:
+            encoded_message = encode_chat_message(message)
+        with self._lock:
+            chat = self._chats.get(chat_identifier)
+            if chat is not None and message_number <= chat[0]:
+                # added after a newer message of a concurrent write, which
+                # already made the cache skip it
+                return
+            if chat is not None and chat[0] + 1 != message_number:
+                # the messages in between are not known to the cache
+                self._evict(chat_identifier)
+                chat = None
+            if chat is None:
+                chat = self._new_chat(chat_identifier, message_number - 1)
+            self._append(chat, message_number, encoded_message)
+            self._chats.move_to_end(chat_identifier)
+            self._enforce_budget()
+    
+    def fill(self,
+             chat_identifier: str,
+             newest_message: int,
+             messages: typing.List[
+                 typing.Tuple[int, typing.Tuple[bytes, ...]]]) -> None:
+        """
+        Caches a chat that is not cached yet with messages read from the
+        database.
+        
+        :param chat_identifier: the chats identifier
+        :param newest_message: the number of the newest message of the chat
+        :param messages: the newest encoded messages of the chat with their
+                         numbers, ordered by number, may be empty
+        :return: None
+        """
+        if self.ring_size == 0:
+            return
+        with self._lock:
+            if chat_identifier in self._chats:
+                # a writer has been faster and knows better
+                return
+            chat = self._new_chat(chat_identifier,
+                                  newest_message - len(messages))
+            for message_number, encoded_message in messages:
+                self._append(chat, message_number, encoded_message)
+            self._enforce_budget()
+    
+    def _new_chat(self, chat_identifier: str, newest_message: int) -> list:
+        """
+        Adds a chat without messages to the cache.
+        
+        Is not thread safe, the caller should hold the lock.
+        :param chat_identifier: the chats identifier
+        :param newest_message: the number of the newest message of the chat
+        :return: the cached chat
+        """
+        chat = [newest_message, collections.deque(), self.CHAT_OVERHEAD]
+        self._chats[chat_identifier] = chat
+        self.size += self.CHAT_OVERHEAD
+        return chat
+    
+    def _append(self,
+                chat: list,
+                message_number: int,
+                encoded_message: typing.Tuple[bytes, ...]) -> None:
+        """
+        Appends a message to the ring of a chat and drops the oldest message
+        of the ring if it is full.
+        
+        Is not thread safe, the caller should hold the lock.
+        :param chat: the cached chat
+        :param message_number: the number of the message
+        :param encoded_message: the encoded message
+        :return: None
+        """
+        message_size = self._message_size(encoded_message)
+        chat[0] = message_number
+        chat[1].append((message_number, encoded_message))
+        chat[2] += message_size
+        self.size += message_size
+        if len(chat[1]) > self.ring_size:
+            _, dropped = chat[1].popleft()
+            dropped_size = self._message_size(dropped)
+            chat[2] -= dropped_size
+            self.size -= dropped_size
+    
+    def _enforce_budget(self) -> None:
+        """
+        Evicts the chats used least recently until the cache fits the memory
+        budget.
+        
+        Is not thread safe, the caller should hold the lock.
+        :return: None
+        """
+        while self.size > self.memory_budget and self._chats:
+            self._evict(next(iter(self._chats)))
+    
+    def _evict(self, chat_identifier: str) -> None:
+        """
+        Removes a chat from the cache.
+        
+        Is not thread safe, the caller should hold the lock.
+        :param chat_identifier: the chats identifier
+        :return: None
+        """
+        chat = self._chats.pop(chat_identifier)
+        self.size -= chat[2]
+    
+    def _message_size(self, encoded_message: typing.Tuple[bytes, ...]) -> int:
+        """Estimates the bytes used by a cached message."""
+        return sum(len(each) for each in encoded_message) + \
+            self.MESSAGE_OVERHEAD
+
+
+# the versions and formats a chat message is encoded in by encode_chat_message,
+# version 2 is always in the batch format
+ENCODINGS = ((protocol.VERSION_1, False),
+             (protocol.VERSION_1, True),
+             (protocol.VERSION_2, True))
+
+
+def encoding_index(version: int, batch_format: bool) -> int:
+    """
+    Returns the index in ENCODINGS of the encoding used for a NEW_MESSAGES
+    message.
+    
+    :param version: the version of the protocol the message is serialized in
+    :param batch_format: True if the message is serialized in the batch format
+    :return: the index of the encoding
+    """
+    return ENCODINGS.index((version, batch_format or
+                            version == protocol.VERSION_2))
+
+
+def encode_chat_message(message: protocol.Message) -> typing.Tuple[bytes, ...]:
+    """
+    Encodes a chat message as an element of a NEW_MESSAGES message in every
+    encoding in ENCODINGS.
+    
+    Only the chat message is encoded, whatever else the message holds.
+    :param message: the chat message
+    :return: the encoded message of every encoding in ENCODINGS
+    """
+    message = protocol.Message(protocol.Message.CHAT_MESSAGE,
+                               message.content,
+                               message.sender,
+                               message.receiver)
+    return tuple(protocol.encode_new_messages_element(message,
+                                                      version,
+                                                      batch_format)
+                 for version, batch_format in ENCODINGS)
+
+
+def validate_chat_message_length(message: protocol.Message
+                                 ) -> typing.Tuple[bytes, ...]:
+    """
+    Validates that a chat message fits in a NEW_MESSAGES message of the
+    default header size, uncompressed and in every encoding in ENCODINGS.
+    
+    Every client can then receive it, whatever the header size of the
+    connection it was sent on. The encodings are returned so that the hot
+    tail cache does not have to encode the message again.
+    :raises protocol.MessageCorruptError: if the message is too long
+    :param message: the chat message that should be validated
+    :return: the message encoded by encode_chat_message
+    """
+    encoded_message = encode_chat_message(message)
+    if protocol.new_messages_length(
+            [max(len(each) for each in encoded_message)]) > \
+            protocol.max_message_length(protocol.HEADER_SIZE):
+        raise protocol.MessageCorruptError(
+            "Chat message is too long to be sent to every client.")
+    return encoded_message
+
+
+class ChatMessageObserver:
+    """
+    Class that observes the chat messages added to a ServerDBHandler.
+    """
+    def chat_message_added(self, chat_identifier: str):
+        raise NotImplementedError
+
+
+class ChatMessageNotifier(ChatMessageObserver):
+    """
+    Class that wakes the coroutines waiting for new messages in a chat.
+    
+    The coroutines register an asyncio.Event for the chat they wait for, which
+    is set when a message is added to the chat. Messages may be added from any
+    thread, the events are set on the event loop of the coroutines.
+    """
+    def __init__(self):
+        self._events = dict()
+        self._loop = None
+    
+    def register(self, chat_identifier: str, event: asyncio.Event) -> None:
+        """
+        Registers an event that should be set when a message is added to a chat.
+        
+        Must be called from a coroutine.
+        :param chat_identifier: the chats identifier
+        :param event: the event that should be set
+        :return: None
+        """
+        self._loop = asyncio.get_running_loop()
+        self._events.setdefault(chat_identifier, set()).add(event)
+    
+    def unregister(self, chat_identifier: str, event: asyncio.Event) -> None:
+        """
+        Unregisters an event registered with register.
+        
+        :param chat_identifier: the chats identifier
+        :param event: the event that should no longer be set
+        :return: None
+        """
+        events = self._events.get(chat_identifier)
+        if events is not None:
+            events.discard(event)
+            if len(events) == 0:
+                del self._events[chat_identifier]
+    
+    def chat_message_added(self, chat_identifier: str) -> None:
+        if chat_identifier in self._events:
+            self._loop.call_soon_threadsafe(self._set_events, chat_identifier)
+    
+    def _set_events(self, chat_identifier: str) -> None:
+        for event in self._events.get(chat_identifier, ()):
+            event.set()
+
+
+class ChatMessageWriter(threading.Thread):
+    """
+    Class that writes incoming chat messages to the database in batches.
+    
+    Submitted messages are queued, and a batch is written in a single
+    transaction when it holds batch_size messages or flush_interval
+    milliseconds have passed since its first message was submitted, whichever
+    comes first. The callback of every message is called once its batch has
+    been committed, so insert throughput grows with the load instead of being
+    bound by the time of a commit.
+    """
+    def __init__(self,
+                 db_handler: ServerDBHandler,
+                 batch_size: int = 256,
+                 flush_interval: float = 2):
+        threading.Thread.__init__(self, daemon=True)
+        self.db_handler = db_handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+    
+    def submit(self,
+               message: protocol.Message,
+               callback: typing.Callable[[bool], None],
+               encoded_message: typing.Tuple[bytes, ...] = None) -> None:
+        """
+        Queues a chat message to be written to the database.
+        
+        The callback is called from the thread of the writer.
+        :param message: the chat message that should be saved
+        :param callback: called with True when the message has been committed,
+                         or with False if its batch could not be written
+        :param encoded_message: the message encoded by encode_chat_message, if
+                                it was encoded already
+        :return: None
+        """
+        self._queue.put((message, encoded_message, callback))
+    
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            flush_time = time.monotonic() + self.flush_interval / 1000
+            while len(batch) < self.batch_size:
+                remaining_time = flush_time - time.monotonic()
+                if remaining_time <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining_time))
+                except queue.Empty:
+                    break
+            self._write(batch)
+    
+    def _write(self, batch: typing.List[typing.Tuple[
+            protocol.Message,
+            typing.Optional[typing.Tuple[bytes, ...]],
+            typing.Callable[[bool], None]]]) -> None:
+        """
+        Writes a batch of chat messages and calls their callbacks.
+        
+        Any error is reported and fails the batch, so that the writer keeps
+        serving the batches after it.
+        :param batch: the chat messages with their encodings and callbacks
+        :return: None
+        """
+        try:
+            self.db_handler.add_chat_messages_to_database(
+                self.db_handler.connection,
+                [message for message, _, _ in batch],
+                [encoded_message for _, encoded_message, _ in batch])
+            committed = True
+        except Exception as error:
+            print("Could not write a batch of chat messages,", repr(error))
+            committed = False
+        for _, _, callback in batch:
+            callback(committed)
+
+
+def respond_to_message(db_handler: ServerDBHandler,
+                       message: protocol.Message,
+                       in_session: bool = False,
+                       connection_format: ConnectionFormat = ConnectionFormat()
+                       ) -> typing.Optional[protocol.Message]:
+    """
+    Determines what action should be taken for a message and carries it out.
+    
+    Is shared by the connection controllers so that the blocking and the
+    asyncio server behave the same. In a session every message is answered,
+    outside of one only the messages that have something to answer with are.
+    The wait timeout of a request for new messages is not waited for here,
+    since that would block the blocking server for every other client.
+    :raises NotImplementedError: if the message type is not implemented
+    :raises protocol.MessageCorruptError: if a chat message is malformed
+                or too long
+    :param db_handler: the database handler of the server
+    :param message: the message received from the client
+    :param in_session: True if the message was received in a session
+    :param connection_format: the format of the connection the response is
+                              sent on
+    :return: the message that should be sent back to the client, or None if
+             nothing should be sent back
+    """
+    if message.msg_type == protocol.Message.CHAT_MESSAGE:
+        protocol.validate_chat_message_format(message)
+        encoded_message = validate_chat_message_length(message)
+        connection = db_handler.connection
+        db_handler.add_chat_messages_to_database(connection, [message],
+                                                 [encoded_message])
+        if in_session:
+            return protocol.Message(protocol.Message.ACKNOWLEDGE)
+        return None
+    
+    elif message.msg_type == protocol.Message.CHAT_MESSAGE_BATCH:
+        protocol.validate_chat_message_batch_format(message)
+        chat_messages = protocol.unpack_new_messages(message)
+        encoded_messages = [validate_chat_message_length(chat_message)
+                            for chat_message in chat_messages]
+        connection = db_handler.connection
+        db_handler.add_chat_messages_to_database(connection, chat_messages,
+                                                 encoded_messages)
+        if in_session:
+            return protocol.Message(protocol.Message.ACKNOWLEDGE)
+        return None
+    
+    elif message.msg_type == protocol.Message.REQUEST_NEW_MESSAGES:
+        try:
+            return db_handler.get_new_messages(message, connection_format)
+        except database.NotPresentInDatabase:
+            if in_session and connection_format.not_modified:
+                return protocol.Message(protocol.Message.NOT_MODIFIED)
+            if in_session:
+                return protocol.Message(protocol.Message.NEW_MESSAGES,
+                                        json.dumps([]))
+            return None
+    
+    elif message.msg_type == protocol.Message.KEEPALIVE:
+        if in_session:
+            return protocol.Message(protocol.Message.KEEPALIVE)
+        return None
+    
+    elif message.msg_type in (protocol.Message.OPEN_SESSION,
+                              protocol.Message.SUBSCRIBE) and not in_session:
+        # sessions and subscriptions are served by the connection controllers
+        # that support them
+        return None
+    else:
+        raise NotImplementedError(
+            "Message type with value {} is not implemented".format(
+                message.msg_type))
 
 
 class ServerConnectionController():
@@ -93,7 +852,8 @@ class ServerConnectionController():
                 received_message = self._receive_client_message()
                 self._determine_action(received_message)
     
-        except protocol.ProtocolViolationError as error:
+        except (protocol.ProtocolViolationError,
+                protocol.MessageCorruptError) as error:
             print("Dropped a message due to violation of protocol.")
 
     def _receive_client_message(self) -> protocol.Message:
@@ -104,45 +864,12 @@ class ServerConnectionController():
                 not follow protocol
         :return:
         """
-        # fetch fixed header
-        fixed_header_size = 2
-        buffer = self._receive_bytes(fixed_header_size)
-        if len(buffer) < 2:
+        message = protocol.FrameDecoder().receive_message(self.current_socket)
+        if message is None:
             raise protocol.ProtocolViolationError(
                 "Message received not correct length.")
-    
-        header = buffer[:fixed_header_size]
-        msg_len = protocol.deserialize_two_byte_header(header)
-        # fetch rest of message
-        buffer = buffer[fixed_header_size:]
-        buffer = self._receive_bytes(msg_len, buffer)
-        if len(buffer) < msg_len:
-            raise protocol.ProtocolViolationError(
-                "Message received not correct length.")
-    
-        msg_content = protocol.deserialize_json_object(buffer)
-        message = protocol.reassemble_message(msg_content)
         return message
 
-    def _receive_bytes(self, qty_bytes: int, buffer=b''):
-        """
-        Receives at least the specified amount of bytes.
-        
-        The bytes will be added to the buffer, if any is passed otherwise a new
-        buffer, and then returned.
-        :param qty_bytes: amount of bytes to receive at minimum
-        :param buffer: buffer that will be appended with the received bytes
-        :return: buffer containing at least the specified amount of bytes
-        """
-        buffer_length = len(buffer)
-        while buffer_length < qty_bytes:
-            data = self.current_socket.recv(4096)
-            if not data:
-                break
-            buffer += data
-            buffer_length = len(buffer)
-        return buffer
-
     def _determine_action(self, message: protocol.Message):
         """
         Determines what action should be taken for a message.
@@ -150,18 +877,659 @@ class ServerConnectionController():
         :param message:
         :return:
         """
-        if message.msg_type == protocol.Message.CHAT_MESSAGE:
-            connection = self.db_handler.connection
-            self.db_handler.add_chat_message_to_database(connection, message)
-            
-        elif message.msg_type == protocol.Message.REQUEST_NEW_MESSAGES:
+        response = respond_to_message(self.db_handler, message)
+        if response is None:
+            self.current_socket.close()
+        else:
+            serialized_response = protocol.serialize_message(response,
+                                                             message.version)
+            self.current_socket.sendall(serialized_response)
+
+
+class AsyncServerConnectionController:
+    """
+    Class that controls the connections being made to the server when the
+    server runs on an asyncio event loop.
+    
+    Every connection is served by its own coroutine, so a slow or stalled
+    client only holds up itself and not every other client. A connection that
+    starts with a message of msg_type OPEN_SESSION is kept open as a session.
+    
+    Attributes
+        CLIENT_TIMEOUT -- seconds a client may take to deliver its message
+        before the connection is dropped\n
+        SESSION_IDLE_TIMEOUT -- seconds a session may stay idle before it is
+        closed, clients keep their sessions open with KEEPALIVE messages\n
+        SUBSCRIPTION_KEEPALIVE_INTERVAL -- seconds a subscription may stay
+        idle before a KEEPALIVE message is pushed\n
+        MAX_WAIT_TIMEOUT -- milliseconds a request for new messages is held
+        at most, no matter the wait timeout asked for\n
+        MAX_PAGE_SIZE -- bytes a page of new messages holds at most, no
+        matter the page size asked for\n
+        MAX_MESSAGE_LENGTH -- bytes a message of a client may be long at most
+        in a session with the wide header\n
+        MAX_PIPELINED_REQUESTS -- the amount of messages of a pipelined
+        session that are answered at a time, further messages are not read
+        until one of them is answered\n
+    """
+    CLIENT_TIMEOUT = 30
+    SESSION_IDLE_TIMEOUT = 60
+    SUBSCRIPTION_KEEPALIVE_INTERVAL = 20
+    MAX_WAIT_TIMEOUT = 30000
+    MAX_PAGE_SIZE = 2**22
+    MAX_MESSAGE_LENGTH = 2**22
+    MAX_PIPELINED_REQUESTS = 64
+    
+    def __init__(self,
+                 db_handler: ServerDBHandler,
+                 chat_message_writer: ChatMessageWriter = None):
+        """
+        Initializes the controller.
+        
+        :param db_handler: the database handler of the server
+        :param chat_message_writer: writer that chat messages are written
+                                    through, if None they are written one
+                                    at a time as they arrive
+        """
+        self.db_handler = db_handler
+        self.chat_message_writer = chat_message_writer
+        self.notifier = ChatMessageNotifier()
+        db_handler.add_chat_message_observer(self.notifier)
+    
+    async def receive_process(self,
+                              reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter) -> None:
+        """
+        Receives and processes a message from a connection.
+        
+        Is used as the client connected callback of asyncio.start_server. If
+        the message protocol is not followed the message will be dropped.
+        :param reader: stream that the message is read from
+        :param writer: stream that any response is written to
+        :return: None
+        """
+        try:
+            received_message = await asyncio.wait_for(
+                self._receive_client_message(reader),
+                self.CLIENT_TIMEOUT)
+            if received_message.msg_type == protocol.Message.OPEN_SESSION:
+                await self._serve_session(reader, writer, received_message)
+            else:
+                response = await self._respond(received_message)
+                if response is not None:
+                    writer.write(protocol.serialize_message(
+                        response, received_message.version))
+                    await writer.drain()
+        except (protocol.ProtocolViolationError, protocol.MessageCorruptError):
+            print("Dropped a message due to violation of protocol.")
+        except NotImplementedError as error:
+            print("Dropped a message,", error)
+        except (EOFError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except sqlite3.Error as error:
+            print("Dropped a connection,", error)
+        finally:
+            writer.close()
             try:
-                new_msgs = self.db_handler.get_new_messages(message)
-                serialized_new_msgs = protocol.serialize_message(new_msgs)
-                self.current_socket.sendall(serialized_new_msgs)
-            except database.NotPresentInDatabase:
-                self.current_socket.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    
+    async def _serve_session(self,
+                             reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter,
+                             message: protocol.Message) -> None:
+        """
+        Confirms a session and then answers its messages until the client
+        closes it or it has been idle for too long.
+        
+        Every message is answered in the version of the protocol it was
+        received in, and in the format negotiated for the session.
+        :raises protocol.ProtocolViolationError: if a received message does
+                not follow protocol
+        :param reader: stream that the messages are read from
+        :param writer: stream that the responses are written to
+        :param message: the message of msg_type OPEN_SESSION
+        :return: None
+        """
+        session_options, connection_format = self._session_options(message)
+        confirmation = protocol.Message(protocol.Message.OPEN_SESSION,
+                                        json.dumps(session_options))
+        writer.write(protocol.serialize_message(confirmation,
+                                                message.version))
+        await writer.drain()
+        if connection_format.pipelining:
+            await self._serve_pipelined_session(reader,
+                                                writer,
+                                                connection_format)
+            return
+        header_size = connection_format.header_size
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    self._receive_client_message(reader, header_size),
+                    self.SESSION_IDLE_TIMEOUT)
+            except EOFError:
+                return
+            if message.msg_type == protocol.Message.SUBSCRIBE:
+                await self._serve_subscription(reader,
+                                               writer,
+                                               message,
+                                               connection_format)
+                return
+            response = await self._respond_in_session(message,
+                                                      connection_format)
+            writer.write(protocol.serialize_message(
+                response,
+                message.version,
+                header_size,
+                connection_format.batch_format,
+                connection_format.compression))
+            await writer.drain()
+    
+    async def _serve_pipelined_session(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            connection_format: ConnectionFormat) -> None:
+        """
+        Answers the messages of a pipelined session until the client closes
+        it or it has been idle for too long.
+        
+        Every message is answered by a task of its own, so a response is sent
+        as soon as it is ready, with the request id of the message it answers,
+        and a request for new messages that is held does not hold up the
+        messages after it. At most MAX_PIPELINED_REQUESTS messages are
+        answered at a time, and the chat messages are stored in the order
+        they were received.
+        :raises protocol.ProtocolViolationError: if a received message does
+                not follow protocol
+        :param reader: stream that the messages are read from
+        :param writer: stream that the responses are written to
+        :param connection_format: the format of the connection
+        :return: None
+        """
+        answering = set()
+        in_flight = asyncio.Semaphore(self.MAX_PIPELINED_REQUESTS)
+        failures = []
+        # chat messages are stored in the order they were received, since the
+        # lock is acquired by the tasks in the order they were created
+        storing = asyncio.Lock()
+        
+        def answered(task: asyncio.Task) -> None:
+            answering.discard(task)
+            in_flight.release()
+            if not task.cancelled() and task.exception() is not None:
+                failures.append(task.exception())
+                # ends the receiving of further messages
+                writer.transport.abort()
+        
+        try:
+            while True:
+                await in_flight.acquire()
+                try:
+                    if failures:
+                        raise failures[0]
+                    request_id, message = await asyncio.wait_for(
+                        self._receive_client_request(
+                            reader,
+                            connection_format.header_size,
+                            request_ids=True),
+                        self.SESSION_IDLE_TIMEOUT)
+                except (EOFError, ConnectionError,
+                        protocol.ProtocolViolationError):
+                    if failures:
+                        raise failures[0]
+                    raise
+                if message.msg_type == protocol.Message.SUBSCRIBE:
+                    raise protocol.ProtocolViolationError(
+                        "A pipelined session cannot subscribe.")
+                task = asyncio.create_task(
+                    self._answer_request(writer,
+                                         request_id,
+                                         message,
+                                         connection_format,
+                                         storing))
+                answering.add(task)
+                task.add_done_callback(answered)
+        except EOFError:
+            return
+        finally:
+            for task in list(answering):
+                task.cancel()
+    
+    async def _answer_request(self,
+                              writer: asyncio.StreamWriter,
+                              request_id: int,
+                              message: protocol.Message,
+                              connection_format: ConnectionFormat,
+                              storing: asyncio.Lock) -> None:
+        """
+        Answers a message of a pipelined session.
+        
+        :param writer: stream that the response is written to
+        :param request_id: the request id of the message
+        :param message: the message received from the client
+        :param connection_format: the format of the connection
+        :param storing: lock held while a chat message of the session is
+                        stored
+        :return: None
+        """
+        if message.msg_type in (protocol.Message.CHAT_MESSAGE,
+                                protocol.Message.CHAT_MESSAGE_BATCH):
+            async with storing:
+                response = await self._respond_in_session(message,
+                                                          connection_format)
         else:
-            raise NotImplementedError(
-                "Message type with value {} is not implemented".format(
-                    message.msg_type))
+            response = await self._respond_in_session(message,
+                                                      connection_format)
+        writer.write(protocol.add_request_id(
+            protocol.serialize_message(response,
+                                       message.version,
+                                       connection_format.header_size,
+                                       connection_format.batch_format,
+                                       connection_format.compression),
+            connection_format.header_size,
+            request_id))
+        await writer.drain()
+    
+    def _session_options(self, message: protocol.Message
+                         ) -> typing.Tuple[typing.Dict[str, typing.Any],
+                                           ConnectionFormat]:
+        """
+        Determines the options of a session from the options the client asked
+        for in its OPEN_SESSION message.
+        
+        Options that the client did not ask for, or asked for in an incorrect
+        format, are left at what a client that knows nothing about them
+        expects.
+        :param message: the message of msg_type OPEN_SESSION
+        :return: the options of the session, that confirm it, and the format
+                 of the connection they result in
+        """
+        try:
+            client_options = json.loads(message.content)
+        except ValueError:
+            client_options = None
+        if not isinstance(client_options, dict):
+            client_options = dict()
+        session_options = {"idle_timeout": self.SESSION_IDLE_TIMEOUT,
+                           "database_id": self.db_handler.database_id}
+        versions = client_options.get("versions")
+        if isinstance(versions, list):
+            common_versions = [version for version in protocol.VERSIONS
+                               if version in versions]
+            if common_versions:
+                session_options["version"] = max(common_versions)
+        header_size = protocol.HEADER_SIZE
+        if client_options.get("header_size") in protocol.HEADER_SIZES:
+            header_size = client_options["header_size"]
+            session_options["header_size"] = header_size
+        page_size = min(self.MAX_PAGE_SIZE,
+                        protocol.max_message_length(header_size))
+        requested_page_size = client_options.get("page_size")
+        if isinstance(requested_page_size, int) and requested_page_size > 0:
+            page_size = min(page_size, requested_page_size)
+            session_options["page_size"] = page_size
+        batch_format = client_options.get("batch") is True
+        if batch_format:
+            session_options["batch"] = True
+        compressions = client_options.get("compression")
+        compression = isinstance(compressions, list) and \
+            protocol.COMPRESSION in compressions
+        if compression:
+            session_options["compression"] = protocol.COMPRESSION
+        pipelining = client_options.get("pipelining") is True
+        if pipelining:
+            session_options["pipelining"] = True
+        not_modified = client_options.get("not_modified") is True
+        if not_modified:
+            session_options["not_modified"] = True
+        return session_options, ConnectionFormat(header_size,
+                                                 page_size,
+                                                 batch_format,
+                                                 compression,
+                                                 pipelining,
+                                                 not_modified)
+    
+    async def _respond_in_session(self,
+                                  message: protocol.Message,
+                                  connection_format: ConnectionFormat
+                                  ) -> protocol.Message:
+        """
+        Carries out the action of a message received in a session like
+        _respond does, and answers a chat message that was not stored with a
+        REJECTED message instead of ending the session.
+        
+        :raises NotImplementedError: if the message type is not implemented
+        :raises sqlite3.Error: if a chat message could not be written
+        :param message: the message received from the client
+        :param connection_format: the format of the connection the response is
+                                  sent on
+        :return: the message that should be sent back to the client
+        """
+        try:
+            return await self._respond(message,
+                                       in_session=True,
+                                       connection_format=connection_format)
+        except protocol.MessageCorruptError:
+            print("Rejected a chat message that was malformed or too long.")
+            return protocol.Message(protocol.Message.REJECTED)
+    
+    async def _respond(self,
+                       message: protocol.Message,
+                       in_session: bool = False,
+                       connection_format: ConnectionFormat = ConnectionFormat()
+                       ) -> typing.Optional[protocol.Message]:
+        """
+        Carries out the action of a message like respond_to_message does,
+        except that a request for new messages with a wait timeout is held
+        until a new message arrives in the chat or the timeout ends, and that
+        chat messages are written through the chat message writer, if any.
+        The chat messages of a CHAT_MESSAGE_BATCH message are a batch already
+        and are written directly.
+        
+        :raises NotImplementedError: if the message type is not implemented
+        :raises protocol.MessageCorruptError: if a chat message is malformed
+                or too long
+        :raises sqlite3.Error: if a chat message could not be written
+        :param message: the message received from the client
+        :param in_session: True if the message was received in a session
+        :param connection_format: the format of the connection the response is
+                                  sent on
+        :return: the message that should be sent back to the client, or None
+                 if nothing should be sent back
+        """
+        if message.msg_type == protocol.Message.CHAT_MESSAGE and \
+                self.chat_message_writer is not None:
+            protocol.validate_chat_message_format(message)
+            encoded_message = validate_chat_message_length(message)
+            loop = asyncio.get_running_loop()
+            committed = loop.create_future()
+            self.chat_message_writer.submit(
+                message,
+                lambda result: loop.call_soon_threadsafe(committed.set_result,
+                                                         result),
+                encoded_message)
+            if not await committed:
+                raise sqlite3.Error("The chat message could not be written.")
+            if in_session:
+                return protocol.Message(protocol.Message.ACKNOWLEDGE)
+            return None
+        
+        if message.msg_type == protocol.Message.REQUEST_NEW_MESSAGES and \
+                message.wait_timeout > 0:
+            protocol.validate_request_message_format(message)
+            chat_identifier = database.create_chat_identifier(message.sender,
+                                                              message.receiver)
+            wait_timeout = min(message.wait_timeout, self.MAX_WAIT_TIMEOUT)
+            wake_up = asyncio.Event()
+            # registered before looking so that no message is missed
+            self.notifier.register(chat_identifier, wake_up)
+            try:
+                return await asyncio.wait_for(
+                    self._wait_for_new_messages(message,
+                                                connection_format,
+                                                wake_up),
+                    wait_timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.notifier.unregister(chat_identifier, wake_up)
+        return await self._run_database_call(respond_to_message,
+                                             self.db_handler,
+                                             message,
+                                             in_session,
+                                             connection_format)
+    
+    async def _wait_for_new_messages(self,
+                                     message: protocol.Message,
+                                     connection_format: ConnectionFormat,
+                                     wake_up: asyncio.Event
+                                     ) -> protocol.Message:
+        """
+        Waits until there are new messages for a request and returns them.
+        
+        :param message: the message of msg_type REQUEST_NEW_MESSAGES
+        :param connection_format: the format of the connection the response is
+                                  sent on
+        :param wake_up: the event that is set when a message is added to the
+                        chat, registered before the request was looked at
+        :return: the message with the new messages
+        """
+        while True:
+            wake_up.clear()
+            try:
+                return await self._run_database_call(
+                    self.db_handler.get_new_messages,
+                    message,
+                    connection_format)
+            except database.NotPresentInDatabase:
+                await wake_up.wait()
+    
+    async def _run_database_call(self,
+                                 function: typing.Callable[..., typing.Any],
+                                 *args) -> typing.Any:
+        """
+        Calls a function that accesses the database.
+        
+        When the database has a pool of read only connections the function is
+        called in a thread of the default executor, so that the event loop
+        serves other connections meanwhile and reads run concurrently. A
+        database in RAM is accessed through a single locked connection anyway,
+        so there the function is called directly.
+        :param function: the function that should be called
+        :param args: the arguments of the function
+        :return: the return value of the function
+        """
+        if self.db_handler.reader_amount == 0:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+    
+    async def _serve_subscription(self,
+                                  reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter,
+                                  message: protocol.Message,
+                                  connection_format: ConnectionFormat) -> None:
+        """
+        Confirms a subscription and then pushes the new messages of the
+        subscribed chats until the client closes the connection.
+        
+        :raises protocol.MessageCorruptError: if the subscription message has
+                an incorrect format
+        :param reader: stream that further subscriptions are read from
+        :param writer: stream that the new messages are pushed to
+        :param message: the message of msg_type SUBSCRIBE that started the
+                        subscription
+        :param connection_format: the format of the connection
+        :return: None
+        """
+        header_size = connection_format.header_size
+        # the number of the last message the client has, by chat identifier
+        last_messages = dict()
+        wake_up = asyncio.Event()
+        receiving = None
+        try:
+            self._add_subscription(message, last_messages, wake_up)
+            writer.write(protocol.serialize_message(
+                protocol.Message(protocol.Message.SUBSCRIBE),
+                message.version,
+                header_size))
+            await writer.drain()
+            receiving = asyncio.create_task(
+                self._receive_subscriptions(reader,
+                                            last_messages,
+                                            wake_up,
+                                            header_size))
+            while not receiving.done():
+                wake_up.clear()
+                pushed = await self._push_new_messages(writer,
+                                                       last_messages,
+                                                       message.version,
+                                                       connection_format)
+                if pushed:
+                    continue
+                try:
+                    await asyncio.wait_for(
+                        wake_up.wait(),
+                        self.SUBSCRIPTION_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(protocol.serialize_message(
+                        protocol.Message(protocol.Message.KEEPALIVE),
+                        message.version,
+                        header_size))
+                    await writer.drain()
+        finally:
+            if receiving is not None:
+                receiving.cancel()
+            for chat_identifier in last_messages:
+                self.notifier.unregister(chat_identifier, wake_up)
+    
+    def _add_subscription(self,
+                          message: protocol.Message,
+                          last_messages: typing.Dict[str, int],
+                          wake_up: asyncio.Event) -> None:
+        """
+        Adds the chat of a SUBSCRIBE message to the chats of a subscription.
+        
+        :raises protocol.MessageCorruptError: if the message has an incorrect
+                format
+        :param message: the message of msg_type SUBSCRIBE
+        :param last_messages: the chats of the subscription
+        :param wake_up: the event of the subscription
+        :return: None
+        """
+        protocol.validate_subscribe_message_format(message)
+        chat_identifier = database.create_chat_identifier(message.sender,
+                                                          message.receiver)
+        last_messages[chat_identifier] = int(message.content)
+        self.notifier.register(chat_identifier, wake_up)
+        wake_up.set()
+    
+    async def _receive_subscriptions(self,
+                                     reader: asyncio.StreamReader,
+                                     last_messages: typing.Dict[str, int],
+                                     wake_up: asyncio.Event,
+                                     header_size: int) -> None:
+        """
+        Receives further SUBSCRIBE messages of a subscription until the client
+        closes the connection.
+        
+        :param reader: stream that the messages are read from
+        :param last_messages: the chats of the subscription
+        :param wake_up: the event of the subscription, set when this returns
+        :param header_size: the size of the fixed length header of the messages
+        :return: None
+        """
+        try:
+            while True:
+                message = await self._receive_client_message(reader,
+                                                             header_size)
+                if message.msg_type == protocol.Message.SUBSCRIBE:
+                    self._add_subscription(message, last_messages, wake_up)
+                elif message.msg_type != protocol.Message.KEEPALIVE:
+                    return
+        except (EOFError, ConnectionError, protocol.ProtocolViolationError,
+                protocol.MessageCorruptError):
+            pass
+        finally:
+            wake_up.set()
+    
+    async def _push_new_messages(self,
+                                 writer: asyncio.StreamWriter,
+                                 last_messages: typing.Dict[str, int],
+                                 version: int,
+                                 connection_format: ConnectionFormat) -> bool:
+        """
+        Pushes a page of the new messages of every chat of a subscription.
+        
+        :param writer: stream that the new messages are pushed to
+        :param last_messages: the chats of the subscription, updated with the
+                              numbers of the messages pushed
+        :param version: the version of the protocol of the subscription
+        :param connection_format: the format of the connection
+        :return: True if any messages were pushed
+        """
+        pushed = False
+        for chat_identifier, last_message in list(last_messages.items()):
+            try:
+                new_msgs, newest = await self._run_database_call(
+                    self.db_handler.new_messages_since,
+                    chat_identifier,
+                    last_message,
+                    version,
+                    connection_format)
+            except database.NotPresentInDatabase:
+                continue
+            writer.write(protocol.serialize_message(
+                new_msgs,
+                version,
+                connection_format.header_size,
+                connection_format.batch_format,
+                connection_format.compression))
+            await writer.drain()
+            last_messages[chat_identifier] = newest
+            pushed = True
+        return pushed
+    
+    async def _receive_client_message(
+            self,
+            reader: asyncio.StreamReader,
+            fixed_header_size: int = protocol.HEADER_SIZE
+    ) -> protocol.Message:
+        """
+        Receives an incoming message and turns it into a protocol.Message.
+        
+        :raises protocol.ProtocolViolationError: if the received message does
+                not follow protocol
+        :raises EOFError: if the client closed the connection before sending
+                anything of a message
+        :param reader: stream that the message is read from
+        :param fixed_header_size: the size of the fixed length header
+        :return: the received message
+        """
+        _, message = await self._receive_client_request(reader,
+                                                        fixed_header_size)
+        return message
+    
+    async def _receive_client_request(
+            self,
+            reader: asyncio.StreamReader,
+            fixed_header_size: int = protocol.HEADER_SIZE,
+            request_ids: bool = False
+    ) -> typing.Tuple[int, protocol.Message]:
+        """
+        Receives an incoming message, and its request id if it has one.
+        
+        :raises protocol.ProtocolViolationError: if the received message does
+                not follow protocol
+        :raises EOFError: if the client closed the connection before sending
+                anything of a message
+        :param reader: stream that the message is read from
+        :param fixed_header_size: the size of the fixed length header
+        :param request_ids: True if a request id follows the header
+        :return: the request id, 0 if there is none, and the received message
+        """
+        prefix_size = fixed_header_size
+        if request_ids:
+            prefix_size += protocol.REQUEST_ID_SIZE
+        try:
+            prefix = await reader.readexactly(prefix_size)
+        except asyncio.IncompleteReadError as error:
+            if not error.partial:
+                raise EOFError("The connection was closed by the client.")
+            raise protocol.ProtocolViolationError(
+                "Message received not correct length.")
+        header = prefix[:fixed_header_size]
+        request_id = protocol.deserialize_header(prefix[fixed_header_size:])
+        msg_len = protocol.deserialize_header(header)
+        if msg_len > self.MAX_MESSAGE_LENGTH:
+            raise protocol.ProtocolViolationError("Message is too long.")
+        try:
+            buffer = await reader.readexactly(msg_len)
+        except asyncio.IncompleteReadError:
+            raise protocol.ProtocolViolationError(
+                "Message received not correct length.")
+        
+        return request_id, protocol.deserialize_message(buffer)
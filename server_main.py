@@ -1,9 +1,35 @@
 #!/bin/usr/python3
+import asyncio
 import socket
 import typing
 import server
 
 
+SERVER_MODE = "asyncio"
+# SERVER_MODE = "blocking"
+
+PATH_TO_DATABASE = "./server.db"
+# PATH_TO_DATABASE = ":memory:"
+
+# the amount of read only connections to a database on disk
+READER_AMOUNT = 4
+
+# the amount of recent messages of every chat that are kept in memory, in a
+# cache that may use at most HOT_TAIL_BUDGET bytes
+HOT_TAIL_SIZE = 64
+HOT_TAIL_BUDGET = 2**24
+
+# the amount of connections that may wait to be accepted by the asyncio server
+CONNECTION_BACKLOG = 4096
+
+# with WRITE_BEHIND the asyncio server writes chat messages in batches of at
+# most WRITE_BATCH_SIZE messages, that wait at most WRITE_FLUSH_INTERVAL ms,
+# which pays off when a commit is expensive
+WRITE_BEHIND = False
+WRITE_BATCH_SIZE = 256
+WRITE_FLUSH_INTERVAL = 2
+
+
 def open_connection(address: typing.Tuple[str, int],
                     db_handler: server.ServerDBHandler) -> None:
     """
@@ -27,14 +53,61 @@ def open_connection(address: typing.Tuple[str, int],
         server_socket.close()
 
 
+def open_async_connection(address: typing.Tuple[str, int],
+                          db_handler: server.ServerDBHandler) -> None:
+    """
+    Opens the server to listen for incoming messages on an asyncio event loop.
+    
+    Unlike open_connection the connections are served concurrently.
+    :param address: the address that the server should open at.
+    :param db_handler: the database handler for the server
+    :return: None
+    """
+    try:
+        asyncio.run(_serve_async(address, db_handler))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_async(address: typing.Tuple[str, int],
+                       db_handler: server.ServerDBHandler) -> None:
+    """
+    Serves connections until the task is cancelled.
+    
+    :param address: the address that the server should open at.
+    :param db_handler: the database handler for the server
+    :return: None
+    """
+    chat_message_writer = None
+    if WRITE_BEHIND:
+        chat_message_writer = server.ChatMessageWriter(db_handler,
+                                                       WRITE_BATCH_SIZE,
+                                                       WRITE_FLUSH_INTERVAL)
+        chat_message_writer.start()
+    controller = server.AsyncServerConnectionController(db_handler,
+                                                        chat_message_writer)
+    async_server = await asyncio.start_server(controller.receive_process,
+                                              address[0],
+                                              address[1],
+                                              backlog=CONNECTION_BACKLOG)
+    async with async_server:
+        await async_server.serve_forever()
+
+
 def main():
     """Starts the server."""
     # hostname = socket.gethostname()
     hostname = "127.0.0.1"
     port_number = 55678
     address = (hostname, port_number)
-    db_handler = server.ServerDBHandler()
-    open_connection(address, db_handler)
+    db_handler = server.ServerDBHandler(PATH_TO_DATABASE,
+                                        READER_AMOUNT,
+                                        HOT_TAIL_SIZE,
+                                        HOT_TAIL_BUDGET)
+    if SERVER_MODE == "asyncio":
+        open_async_connection(address, db_handler)
+    else:
+        open_connection(address, db_handler)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+import client
+import protocol
+
+
+class ServerDatabaseResetTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "client.db")
+        self.db_handler = client.DBHandler(self.path)
+    
+    def store(self, *texts: str) -> None:
+        self.db_handler.store_new_messages(
+            [protocol.Message(protocol.Message.CHAT_MESSAGE, text, "bob",
+                              "alice") for text in texts])
+    
+    def test_reset_deletes_the_chats(self):
+        self.store("old 1", "old 2", "old 3")
+        self.db_handler.reset("second")
+        self.store("new 1")
+        self.assertEqual(self.db_handler.message_amount("alice:bob"), 1)
+        self.assertEqual([message.content for message in
+                          self.db_handler.messages("alice:bob", 1, 10)],
+                         ["new 1"])
+    
+    def test_server_database_id_is_kept(self):
+        self.assertIsNone(self.db_handler.server_database_id())
+        self.db_handler.reset("first")
+        self.store("hello")
+        self.db_handler.connection.close()
+        db_handler = client.DBHandler(self.path)
+        self.assertEqual(db_handler.server_database_id(), "first")
+        self.assertEqual(db_handler.message_amount("alice:bob"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
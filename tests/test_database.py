@@ -0,0 +1,88 @@
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+import client
+import database
+import protocol
+import server
+
+
+LEGACY_MESSAGES = (("alice:bob:1", "hello", "alice"),
+                   ("alice:bob:2", "hi", "bob"),
+                   ("alice:bob:3", "how are you?", "alice"),
+                   ("bob:carol:1", "hey", "carol"),
+                   ("bob:carol:2", "hey you", "bob"),
+                   # a user name that was valid before ':' was reserved
+                   ("a:b:carol:1", "lost", "a:b"))
+
+
+def create_legacy_database() -> str:
+    path = os.path.join(tempfile.mkdtemp(), "legacy.db")
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE chat_message_amount
+        (chat_identifier VARCHAR PRIMARY KEY NOT NULL,
+        total_message_amount INTEGER)""")
+    connection.execute("""CREATE TABLE chat_messages
+        (message_identifier VARCHAR PRIMARY KEY NOT NULL ,
+        message VARCHAR,
+        sender VARCHAR)""")
+    connection.executemany("INSERT INTO chat_messages VALUES (?, ?, ?)",
+                           LEGACY_MESSAGES)
+    connection.executemany("INSERT INTO chat_message_amount VALUES (?, ?)",
+                           (("alice:bob", 3), ("bob:carol", 2),
+                            ("a:b:carol", 1)))
+    connection.commit()
+    connection.close()
+    return path
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    
+    def assertMigrated(self, db_handler: database.Handler, report: str):
+        connection = db_handler.connection
+        self.assertEqual(db_handler.total_message_amount(connection,
+                                                         "alice:bob"), 3)
+        self.assertEqual(db_handler.total_message_amount(connection,
+                                                         "bob:carol"), 2)
+        rows = db_handler.get_chat_messages(connection, "alice:bob", 1, 3)
+        self.assertEqual([row[0] for row in rows], [1, 2, 3])
+        messages = [database.table_row_to_msg(row) for row in rows]
+        self.assertEqual([(message.content, message.sender)
+                          for message in messages],
+                         [("hello", "alice"), ("hi", "bob"),
+                          ("how are you?", "alice")])
+        rows = db_handler.get_chat_messages(connection, "bob:carol", 2, 2)
+        self.assertEqual(database.table_row_to_msg(rows[0]).content,
+                         "hey you")
+        self.assertEqual(connection.execute(
+            "PRAGMA user_version").fetchone()[0], database.SCHEMA_VERSION)
+        self.assertIn("Left out 1 messages", report)
+    
+    def test_server_database(self):
+        path = create_legacy_database()
+        with contextlib.redirect_stdout(io.StringIO()) as report:
+            db_handler = server.ServerDBHandler(path)
+        self.assertMigrated(db_handler, report.getvalue())
+    
+    def test_client_database(self):
+        path = create_legacy_database()
+        with contextlib.redirect_stdout(io.StringIO()) as report:
+            db_handler = client.DBHandler(path)
+        self.assertMigrated(db_handler, report.getvalue())
+    
+    def test_migrated_chat_continues_numbering(self):
+        path = create_legacy_database()
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_handler = client.DBHandler(path)
+        db_handler.store_new_messages([protocol.Message(
+            protocol.Message.CHAT_MESSAGE, "fine", "bob", "alice")])
+        self.assertEqual(db_handler.message_amount("alice:bob"), 4)
+        self.assertEqual(db_handler.messages("alice:bob", 4, 4)[0].content,
+                         "fine")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+import json
+import struct
+import unittest
+import zlib
+import protocol
+
+
+FORMATS = ((protocol.VERSION_1, False),
+           (protocol.VERSION_1, True),
+           (protocol.VERSION_2, True))
+
+
+def chat_message(number: int, text: str = "hello") -> protocol.Message:
+    return protocol.Message(protocol.Message.CHAT_MESSAGE,
+                            "{} {}".format(text, number),
+                            "alice",
+                            "bøb")
+
+
+def fields(message: protocol.Message) -> tuple:
+    """Returns what a message carries, with the chat messages it batches."""
+    chat_messages = None
+    if message.msg_type in (protocol.Message.NEW_MESSAGES,
+                            protocol.Message.CHAT_MESSAGE_BATCH):
+        chat_messages = [fields(each)
+                         for each in protocol.unpack_new_messages(message)]
+        return message.msg_type, chat_messages
+    return (message.msg_type, message.content, message.sender,
+            message.receiver, message.wait_timeout)
+
+
+def decode(serialized: bytes, header_size: int) -> protocol.Message:
+    decoder = protocol.FrameDecoder(header_size)
+    decoder.feed(serialized)
+    body = decoder.next_frame()
+    if body is None:
+        raise protocol.ProtocolViolationError("Frame is incomplete.")
+    return protocol.deserialize_message(body)
+
+
+def v2_header(msg_type: int, content_len: int) -> bytes:
+    return struct.pack("!BBBIHH", protocol.VERSION_2, msg_type, 0,
+                       content_len, 0, 0)
+
+
+class TestRoundTrip(unittest.TestCase):
+    
+    def messages(self):
+        return [
+            chat_message(1, "ünïcode ✓"),
+            protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES, "12",
+                             "alice", "bob", wait_timeout=25000),
+            protocol.Message(protocol.Message.KEEPALIVE),
+            protocol.Message(protocol.Message.NOT_MODIFIED),
+            protocol.Message(protocol.Message.NEW_MESSAGES,
+                             batch=[chat_message(i) for i in range(3)]),
+            protocol.Message(protocol.Message.NEW_MESSAGES, batch=[]),
+            protocol.Message(protocol.Message.CHAT_MESSAGE_BATCH,
+                             batch=[chat_message(i) for i in range(2)]),
+        ]
+    
+    def test_every_format(self):
+        for version, batch_format in FORMATS:
+            for header_size in protocol.HEADER_SIZES:
+                for compression in (False, True):
+                    for message in self.messages():
+                        serialized = protocol.serialize_message(
+                            message, version, header_size, batch_format,
+                            compression)
+                        decoded = decode(serialized, header_size)
+                        self.assertEqual(fields(decoded), fields(message))
+                        self.assertEqual(decoded.version, version)
+    
+    def test_long_messages_are_compressed(self):
+        message = protocol.Message(
+            protocol.Message.NEW_MESSAGES,
+            batch=[chat_message(i) for i in range(200)])
+        for version, batch_format in FORMATS:
+            serialized = protocol.serialize_message(
+                message, version, protocol.WIDE_HEADER_SIZE, batch_format,
+                True)
+            body = serialized[protocol.WIDE_HEADER_SIZE:]
+            self.assertEqual(body[:1], b"\x01")
+            self.assertLess(len(serialized), len(protocol.serialize_message(
+                message, version, protocol.WIDE_HEADER_SIZE, batch_format)))
+            self.assertEqual(fields(decode(serialized,
+                                           protocol.WIDE_HEADER_SIZE)),
+                             fields(message))
+    
+    def test_short_messages_are_not_compressed(self):
+        serialized = protocol.serialize_message(chat_message(1),
+                                                compression=True)
+        self.assertNotEqual(serialized[protocol.HEADER_SIZE:][:1], b"\x01")
+    
+    def test_serialize_new_messages_matches_serialize_message(self):
+        chat_messages = [chat_message(i) for i in range(5)]
+        message = protocol.Message(protocol.Message.NEW_MESSAGES,
+                                   batch=chat_messages)
+        for version, batch_format in FORMATS:
+            for compression in (False, True):
+                elements = [protocol.encode_new_messages_element(
+                                each, version, batch_format)
+                            for each in chat_messages]
+                serialized = protocol.serialize_new_messages(
+                    elements, version, protocol.HEADER_SIZE, batch_format,
+                    compression)
+                self.assertEqual(serialized.serialized,
+                                 protocol.serialize_message(
+                                     message, version, protocol.HEADER_SIZE,
+                                     batch_format, compression))
+                self.assertEqual(fields(serialized), fields(message))
+    
+    def test_new_messages_length_is_an_upper_bound(self):
+        for amount in (0, 1, 7):
+            chat_messages = [chat_message(i) for i in range(amount)]
+            for version, batch_format in FORMATS:
+                elements = [protocol.encode_new_messages_element(
+                                each, version, batch_format)
+                            for each in chat_messages]
+                serialized = protocol.serialize_new_messages(
+                    elements, version, protocol.HEADER_SIZE, batch_format)
+                self.assertGreaterEqual(
+                    protocol.new_messages_length(len(each)
+                                                 for each in elements),
+                    len(serialized.serialized) - protocol.HEADER_SIZE)
+    
+    def test_frames_split_anywhere(self):
+        serialized = b"".join(protocol.serialize_message(message)
+                              for message in self.messages())
+        decoder = protocol.FrameDecoder()
+        decoded = []
+        for i in range(len(serialized)):
+            decoder.feed(serialized[i:i + 1])
+            body = decoder.next_frame()
+            if body is not None:
+                decoded.append(fields(protocol.deserialize_message(body)))
+        self.assertEqual(decoded, [fields(each) for each in self.messages()])
+    
+    def test_request_ids(self):
+        serialized = protocol.add_request_id(
+            protocol.serialize_message(chat_message(1)),
+            protocol.HEADER_SIZE, 77)
+        decoder = protocol.FrameDecoder(request_ids=True)
+        decoder.feed(serialized)
+        self.assertEqual(fields(protocol.deserialize_message(
+            decoder.next_frame())), fields(chat_message(1)))
+        self.assertEqual(decoder.request_id, 77)
+
+
+class TestMalformedInput(unittest.TestCase):
+    
+    def assertViolation(self, body: bytes):
+        with self.assertRaises(protocol.ProtocolViolationError):
+            protocol.deserialize_message(body)
+    
+    def test_truncated_messages(self):
+        message = protocol.Message(protocol.Message.NEW_MESSAGES,
+                                   batch=[chat_message(i) for i in range(3)])
+        for version, batch_format in FORMATS:
+            body = protocol.serialize_message(
+                message, version, protocol.HEADER_SIZE,
+                batch_format)[protocol.HEADER_SIZE:]
+            for end in range(len(body)):
+                self.assertViolation(body[:end])
+    
+    def test_trailing_bytes(self):
+        body = protocol.serialize_message(
+            chat_message(1), protocol.VERSION_2)[protocol.HEADER_SIZE:]
+        self.assertViolation(body + b"\x00")
+    
+    def test_deeply_nested_v2_batch(self):
+        body = protocol.serialize_message(
+            chat_message(1), protocol.VERSION_2)[protocol.HEADER_SIZE:]
+        for _ in range(2000):
+            body = v2_header(protocol.Message.NEW_MESSAGES, len(body)) + body
+        self.assertViolation(body)
+    
+    def test_v2_batch_of_other_messages(self):
+        element = protocol.serialize_message(
+            protocol.Message(protocol.Message.KEEPALIVE),
+            protocol.VERSION_2)[protocol.HEADER_SIZE:]
+        for msg_type in (protocol.Message.NEW_MESSAGES,
+                         protocol.Message.CHAT_MESSAGE_BATCH):
+            self.assertViolation(v2_header(msg_type, len(element)) + element)
+    
+    def test_v2_element_longer_than_batch(self):
+        element = protocol.serialize_message(
+            chat_message(1), protocol.VERSION_2)[protocol.HEADER_SIZE:]
+        body = v2_header(protocol.Message.NEW_MESSAGES,
+                         len(element) - 1) + element[:-1]
+        self.assertViolation(body + element[-1:])
+    
+    def test_v2_invalid_utf8(self):
+        body = struct.pack("!BBBIHH", protocol.VERSION_2,
+                           protocol.Message.KEEPALIVE, 0, 1, 0, 0) + b"\xff"
+        self.assertViolation(body)
+    
+    def test_deeply_nested_v1_batch(self):
+        nested = {"msg_type": 0, "content": "x", "sender": "a",
+                  "receiver": "b"}
+        depth = 100000
+        body = '{"msg_type": 2, "content": "", "sender": "", ' \
+               '"receiver": "", "batch": [' * depth + json.dumps(nested) + \
+               ']}' * depth
+        self.assertViolation(body.encode("UTF-8"))
+        self.assertViolation(b"[" * 100000 + b"]" * 100000)
+    
+    def test_v1_batch_of_other_messages(self):
+        for batch_format in (False, True):
+            message = protocol.Message(
+                protocol.Message.NEW_MESSAGES,
+                batch=[protocol.Message(protocol.Message.KEEPALIVE)])
+            body = protocol.serialize_message(
+                message, protocol.VERSION_1, protocol.HEADER_SIZE,
+                batch_format)[protocol.HEADER_SIZE:]
+            with self.assertRaises(protocol.ProtocolViolationError):
+                protocol.unpack_new_messages(
+                    protocol.deserialize_message(body))
+    
+    def test_v1_batch_that_is_not_a_list(self):
+        body = json.dumps({"msg_type": 2, "content": "", "sender": "",
+                           "receiver": "", "batch": 5}).encode("UTF-8")
+        self.assertViolation(body)
+    
+    def test_v1_invalid_wait_timeout(self):
+        for wait_timeout in (float("inf"), float("nan"), True, 1.5, "5", -1,
+                             protocol.MAX_WAIT_TIMEOUT + 1):
+            body = json.dumps({"msg_type": "1", "content": "0",
+                               "sender": "a", "receiver": "b",
+                               "wait_timeout": wait_timeout}).encode("UTF-8")
+            self.assertViolation(body)
+    
+    def test_v1_longest_wait_timeout(self):
+        body = json.dumps({"msg_type": "1", "content": "0", "sender": "a",
+                           "receiver": "b",
+                           "wait_timeout": protocol.MAX_WAIT_TIMEOUT})
+        message = protocol.deserialize_message(body.encode("UTF-8"))
+        self.assertEqual(message.wait_timeout, protocol.MAX_WAIT_TIMEOUT)
+    
+    def test_corrupt_compression(self):
+        self.assertViolation(b"\x01" + b"not zlib")
+        compressed = zlib.compress(b'{"msg_type": 4}')
+        self.assertViolation(b"\x01" + compressed[:-2])
+        self.assertViolation(b"\x01" + compressed + b"trailing")
+    
+    def test_compressed_twice(self):
+        once = b"\x01" + zlib.compress(b'{"msg_type": 4}')
+        self.assertViolation(b"\x01" + zlib.compress(once))
+    
+    def test_decompression_is_bounded(self):
+        bomb = b"\x01" + zlib.compress(
+            b" " * (protocol.MAX_DECOMPRESSED_LENGTH + 1))
+        self.assertViolation(bomb)
+    
+    def test_frame_longer_than_maximum(self):
+        decoder = protocol.FrameDecoder(max_length=10)
+        decoder.feed(protocol.serialize_message(chat_message(1)))
+        with self.assertRaises(protocol.ProtocolViolationError):
+            decoder.next_frame()
+    
+    def test_message_too_long_for_header(self):
+        message = chat_message(1, "x" * protocol.max_message_length(
+            protocol.HEADER_SIZE))
+        with self.assertRaises(protocol.ProtocolViolationError):
+            protocol.serialize_message(message)
+
+
+if __name__ == "__main__":
+    unittest.main()
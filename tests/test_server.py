@@ -0,0 +1,237 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+import protocol
+import server
+
+
+def chat_message(text: str) -> protocol.Message:
+    return protocol.Message(protocol.Message.CHAT_MESSAGE,
+                            text,
+                            "alice",
+                            "bob")
+
+
+def request_new_messages() -> protocol.Message:
+    return protocol.Message(protocol.Message.REQUEST_NEW_MESSAGES,
+                            "0",
+                            "bob",
+                            "alice")
+
+
+class HotTailCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.cache = server.HotTailCache(ring_size=3)
+    
+    def add(self, *message_numbers: int) -> None:
+        for message_number in message_numbers:
+            self.cache.add("alice:bob", message_number,
+                           chat_message("hello {}".format(message_number)))
+    
+    def numbers_since(self, last_message: int):
+        messages = self.cache.messages_since("alice:bob", last_message)
+        if messages is None:
+            return None
+        return [message_number for message_number, _ in messages]
+    
+    def test_added_messages_are_cached(self):
+        self.cache.fill("alice:bob", 0, [])
+        self.add(1, 2)
+        self.assertEqual(self.numbers_since(0), [1, 2])
+        self.assertEqual(self.numbers_since(2), [])
+    
+    def test_add_out_of_order_is_skipped(self):
+        self.cache.fill("alice:bob", 0, [])
+        self.add(2)
+        self.assertIsNone(self.numbers_since(0))
+        self.add(1)
+        self.assertIsNone(self.numbers_since(0))
+        self.assertEqual(self.numbers_since(1), [2])
+        self.add(3)
+        self.assertEqual(self.numbers_since(1), [2, 3])
+    
+    def test_add_of_a_cached_message_is_skipped(self):
+        self.cache.fill("alice:bob", 0, [])
+        self.add(1, 2, 1)
+        self.assertEqual(self.numbers_since(0), [1, 2])
+    
+    def test_fill_after_concurrent_add_is_skipped(self):
+        self.add(5)
+        self.cache.fill("alice:bob", 4,
+                        [(4, server.encode_chat_message(chat_message("x")))])
+        self.assertEqual(self.numbers_since(4), [5])
+        self.assertIsNone(self.numbers_since(3))
+    
+    def test_lower_boundary_of_the_ring(self):
+        self.cache.fill("alice:bob", 0, [])
+        self.add(1, 2, 3, 4, 5)
+        self.assertEqual(self.numbers_since(2), [3, 4, 5])
+        self.assertIsNone(self.numbers_since(1))
+        self.assertEqual(self.numbers_since(5), [])
+    
+    def test_chats_without_messages_count_toward_the_budget(self):
+        cache = server.HotTailCache(
+            memory_budget=3 * server.HotTailCache.CHAT_OVERHEAD)
+        for i in range(3):
+            cache.fill("chat{}".format(i), 0, [])
+        cache.messages_since("chat0", 0)
+        cache.fill("chat3", 0, [])
+        self.assertEqual(cache.size, 3 * server.HotTailCache.CHAT_OVERHEAD)
+        # the chat used least recently is evicted
+        self.assertIsNone(cache.messages_since("chat1", 0))
+        for chat_identifier in ("chat0", "chat2", "chat3"):
+            self.assertEqual(cache.messages_since(chat_identifier, 0), [])
+    
+    def test_budget_counts_the_messages(self):
+        cache = server.HotTailCache(
+            memory_budget=2 * server.HotTailCache.CHAT_OVERHEAD)
+        cache.fill("chat0", 0, [])
+        cache.fill("chat1", 0, [])
+        cache.add("chat1", 1, chat_message("hello"))
+        self.assertIsNone(cache.messages_since("chat0", 0))
+        self.assertEqual(len(cache.messages_since("chat1", 0)), 1)
+        self.assertLessEqual(cache.size, cache.memory_budget)
+    
+    def test_hits_and_misses_are_counted(self):
+        self.assertIsNone(self.numbers_since(0))
+        self.cache.fill("alice:bob", 0, [])
+        self.add(1, 2, 3, 4)
+        self.numbers_since(3)
+        self.numbers_since(0)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+
+class ChatMessageFormatTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.db_handler = server.ServerDBHandler()
+    
+    def test_malformed_message_is_rejected(self):
+        for sender, receiver in (("a:b", "bob"), ("alice", ""),
+                                 ("", "bob")):
+            message = protocol.Message(protocol.Message.CHAT_MESSAGE,
+                                       "hello", sender, receiver)
+            with self.assertRaises(protocol.MessageCorruptError):
+                server.respond_to_message(self.db_handler, message,
+                                          in_session=True)
+        self.assertEqual(self.db_handler.connection.execute(
+            "SELECT COUNT(*) FROM chat_messages").fetchone()[0], 0)
+    
+    def test_message_is_acknowledged_once_stored(self):
+        response = server.respond_to_message(self.db_handler,
+                                             chat_message("hello"),
+                                             in_session=True)
+        self.assertEqual(response.msg_type, protocol.Message.ACKNOWLEDGE)
+        self.assertEqual(self.db_handler.total_message_amount(
+            self.db_handler.connection, "alice:bob"), 1)
+
+
+class ChatMessageLengthTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.db_handler = server.ServerDBHandler()
+    
+    def test_message_that_fits_a_page_is_stored(self):
+        text = "x" * 30000
+        server.respond_to_message(self.db_handler, chat_message(text))
+        response = server.respond_to_message(self.db_handler,
+                                             request_new_messages())
+        self.assertEqual([each.content for each in
+                          protocol.unpack_new_messages(response)], [text])
+    
+    def test_message_too_long_for_a_page_is_rejected(self):
+        with self.assertRaises(protocol.MessageCorruptError):
+            server.respond_to_message(self.db_handler,
+                                      chat_message("x" * 100000))
+        self.assertIsNone(server.respond_to_message(self.db_handler,
+                                                    request_new_messages()))
+    
+    def test_escaped_message_too_long_for_a_page_is_rejected(self):
+        # every quote is escaped twice in a version 1 NEW_MESSAGES message
+        with self.assertRaises(protocol.MessageCorruptError):
+            server.respond_to_message(self.db_handler,
+                                      chat_message('"' * 20000))
+    
+    def test_batch_with_a_message_too_long_is_rejected(self):
+        batch = protocol.Message(protocol.Message.CHAT_MESSAGE_BATCH,
+                                 batch=[chat_message("hello"),
+                                        chat_message("x" * 100000)])
+        with self.assertRaises(protocol.MessageCorruptError):
+            server.respond_to_message(self.db_handler, batch)
+        self.assertIsNone(server.respond_to_message(self.db_handler,
+                                                    request_new_messages()))
+
+    def test_validated_message_is_encoded_once(self):
+        batch = protocol.Message(protocol.Message.CHAT_MESSAGE_BATCH,
+                                 batch=[chat_message("hello"),
+                                        chat_message("world")])
+        with mock.patch.object(server, "encode_chat_message",
+                               wraps=server.encode_chat_message) as encode:
+            server.respond_to_message(self.db_handler, chat_message("hi"))
+            server.respond_to_message(self.db_handler, batch)
+        self.assertEqual(encode.call_count, 3)
+        self.assertEqual(
+            self.db_handler.hot_tail_cache.messages_since("alice:bob", 2),
+            [(3, server.encode_chat_message(chat_message("world")))])
+
+
+class PagingTest(unittest.TestCase):
+    
+    def test_small_page_holds_one_message(self):
+        for hot_tail_size in (0, 64):
+            db_handler = server.ServerDBHandler(hot_tail_size=hot_tail_size)
+            for i in range(3):
+                server.respond_to_message(db_handler,
+                                          chat_message("hello {}".format(i)))
+            for page_size in (1, 10, 60, 1000):
+                connection_format = server.ConnectionFormat(
+                    page_size=page_size)
+                response, newest = db_handler.new_messages_since(
+                    "alice:bob", 0, connection_format=connection_format)
+                self.assertGreaterEqual(newest, 1)
+                self.assertEqual(
+                    protocol.unpack_new_messages(response)[0].content,
+                    "hello 0")
+
+
+class DatabaseIdTest(unittest.TestCase):
+    
+    def test_database_on_disk_keeps_its_id(self):
+        path = os.path.join(tempfile.mkdtemp(), "server.db")
+        database_id = server.ServerDBHandler(path).database_id
+        self.assertEqual(server.ServerDBHandler(path).database_id,
+                         database_id)
+    
+    def test_database_in_ram_gets_a_new_id(self):
+        self.assertNotEqual(server.ServerDBHandler().database_id,
+                            server.ServerDBHandler().database_id)
+
+
+class SessionRejectionTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.controller = server.AsyncServerConnectionController(
+            server.ServerDBHandler())
+    
+    def respond(self, message: protocol.Message) -> protocol.Message:
+        return asyncio.run(self.controller._respond_in_session(
+            message, server.ConnectionFormat()))
+    
+    def test_rejected_messages_are_answered(self):
+        batch = protocol.Message(protocol.Message.CHAT_MESSAGE_BATCH,
+                                 batch=[chat_message("x" * 100000)])
+        for message in (chat_message("x" * 100000),
+                        protocol.Message(protocol.Message.CHAT_MESSAGE,
+                                         "hello", "a:b", "bob"),
+                        batch):
+            self.assertEqual(self.respond(message).msg_type,
+                             protocol.Message.REJECTED)
+        self.assertEqual(self.respond(chat_message("hello")).msg_type,
+                         protocol.Message.ACKNOWLEDGE)
+
+
+if __name__ == "__main__":
+    unittest.main()